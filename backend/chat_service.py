@@ -0,0 +1,223 @@
+from shared.models import Log, TokenUsage, Session
+from backend.llm_interface import load_settings, provider_from_settings, PROVIDER_SETTING_KEYS
+from backend.memory_manager import MemoryManager
+from backend.short_term_memory import ShortTermMemory
+from backend.conversation_summary import conversation_summarizer
+from backend.rate_limiter import record_usage, MODE_SLEEPY, SLEEPY_NOTICE
+from backend.metrics import span
+from backend.write_queue import write_queue
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import os
+from typing import List, Dict, Any, Optional, Callable
+
+# Threads used to fetch a turn's settings, memories and history side by side
+CONTEXT_WORKERS = int(os.getenv('CHAT_CONTEXT_WORKERS', '16'))
+MEMORY_CONTEXT_LIMIT = 5
+DEFAULT_PERSONALITY = 'You are a helpful AI assistant.'
+# Default prompt layout, overridable with the prompt_layout setting:
+# 'classic' puts everything in one system message; 'stable' keeps an unchanging prefix
+# first and per-turn content last, so provider prompt caches can reuse the prefix
+DEFAULT_PROMPT_LAYOUT = os.getenv('PROMPT_LAYOUT', 'classic')
+PROMPT_LAYOUTS = ('classic', 'stable')
+
+TURN_SETTING_KEYS = ['personality', 'prompt_layout'] + PROVIDER_SETTING_KEYS
+
+_context_pool = ThreadPoolExecutor(max_workers=CONTEXT_WORKERS, thread_name_prefix='turn-context')
+
+
+def _submit(fn: Callable, *args):
+    # Run in a copy of the caller's context so queries count towards its request trace
+    return _context_pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+def build_turn_context(user_id: str, channel_id: str = '', include_history: bool = True) -> Dict[str, Any]:
+    """
+    Gather everything a chat turn needs before the LLM call. All settings
+    (personality and provider) come from one query, and that query, the
+    relevant memories and the conversation summary and history are fetched
+    concurrently rather than one round-trip after another.
+    """
+    settings = _submit(load_settings, TURN_SETTING_KEYS)
+    memories = _submit(MemoryManager.get_relevant_memories, user_id, MEMORY_CONTEXT_LIMIT)
+    summary = history = None
+    if include_history:
+        summary = _submit(conversation_summarizer.get_summary, user_id, channel_id)
+        history = _submit(ShortTermMemory.get_history, user_id, channel_id)
+
+    values = settings.result()
+    return {
+        'provider': provider_from_settings(values),
+        'extraction_provider': provider_from_settings(values, 'extraction'),
+        'personality': values.get('personality') or DEFAULT_PERSONALITY,
+        'prompt_layout': values.get('prompt_layout') or DEFAULT_PROMPT_LAYOUT,
+        # (id, content) in relevance order: importance, then recency
+        'memories': [(m.id, m.content) for m in memories.result()],
+        'summary': summary.result() if summary else None,
+        'history': history.result() if history else []
+    }
+
+
+def build_messages(context: Dict[str, Any], message: str) -> List[Dict[str, str]]:
+    """Prompt messages for a turn in the context's prompt layout"""
+    if context['prompt_layout'] == 'stable':
+        return _build_stable_messages(context, message)
+
+    long_term_memory = '\n'.join(content for _, content in context['memories'])
+    system_prompt = f"{context['personality']}\n\nLong-term memory:\n{long_term_memory if long_term_memory else 'No previous memories.'}"
+    if context['summary']:
+        system_prompt += f"\n\nSummary of the earlier conversation:\n{context['summary']}"
+    system_prompt += "\n\nConversation history:"
+
+    messages = [{'role': 'system', 'content': system_prompt}]
+    messages.extend(context['history'])
+    messages.append({'role': 'user', 'content': message})
+    return messages
+
+
+def _build_stable_messages(context: Dict[str, Any], message: str) -> List[Dict[str, str]]:
+    """
+    Order content from least to most volatile so consecutive turns share the
+    longest possible prefix: personality (same for everyone), then memories
+    in id order (so a new memory appends instead of reshuffling), then the
+    summary, then the append-only history and the new message.
+    """
+    messages = [{'role': 'system', 'content': context['personality']}]
+    memories = sorted(context['memories'])
+    memory_text = '\n'.join(content for _, content in memories) if memories else 'No previous memories.'
+    messages.append({'role': 'system', 'content': f"Long-term memory:\n{memory_text}"})
+    if context['summary']:
+        messages.append({'role': 'system', 'content': f"Summary of the earlier conversation:\n{context['summary']}"})
+    messages.extend(context['history'])
+    messages.append({'role': 'user', 'content': message})
+    return messages
+
+
+class ChatService:
+    """The chat turn pipeline shared by the Discord bot and the web chat"""
+
+    @staticmethod
+    def run_turn(user_id: str, username: str, channel_id: str, message: str,
+                 decision: Dict[str, Any], include_history: bool = True,
+                 suggestions: bool = True, suggestion_tags: Optional[List[str]] = None,
+                 claim: Optional[Callable[[], bool]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Run one chat turn: gather context, call the LLM, extract memory
+        suggestions, then save history and logs. `decision` comes from the
+        admission check. With message coalescing on, claim() is checked once
+        the reply is generated; if a newer message has superseded this turn,
+        nothing is saved and None is returned.
+        """
+        with span('context'):
+            context = build_turn_context(user_id, channel_id, include_history)
+
+        with span('llm'):
+            response_data = context['provider'].chat_completion(
+                messages=build_messages(context, message),
+                max_tokens=decision['max_tokens'],
+                temperature=0.7
+            )
+
+        model = context['provider'].model
+        bot_response = response_data['content']
+        input_tokens = response_data['input_tokens']
+        output_tokens = response_data['output_tokens']
+        cache_tokens = {'cache_hit_tokens': response_data.get('cache_hit_tokens', 0),
+                        'cache_miss_tokens': response_data.get('cache_miss_tokens', 0)}
+
+        if claim is not None and not claim():
+            ChatService.log_discarded_usage(user_id, input_tokens, output_tokens, model=model, **cache_tokens)
+            return None
+
+        # Generate memory suggestions, skipped while the token budget is running low
+        if suggestions and decision['allow_suggestions']:
+            with span('suggestion_extraction'):
+                extractor = context['extraction_provider']
+                suggested, usage = extractor.extract_memory_suggestions_with_usage(message, bot_response)
+                if usage is not None:
+                    ChatService.log_task_usage(user_id, usage, 'extraction', extractor.model)
+                for suggestion in suggested:
+                    # Add memory suggestions to the database as unapproved memories
+                    MemoryManager.add_memory_suggestion(
+                        user_id=user_id,
+                        content=suggestion,
+                        importance=1,  # Default low importance for suggestions
+                        tags=suggestion_tags or ['suggested']
+                    )
+
+        with span('logging'):
+            if include_history:
+                ShortTermMemory.append(user_id, [{'role': 'user', 'content': message},
+                                                 {'role': 'assistant', 'content': bot_response}],
+                                       channel_id)
+                # Fold older turns into the summary in the background once the history grows too long
+                conversation_summarizer.schedule(user_id, channel_id)
+            ChatService.log_interaction(user_id, username, channel_id, message, bot_response,
+                                        input_tokens, output_tokens, model=model, **cache_tokens)
+
+        if decision['mode'] == MODE_SLEEPY:
+            bot_response += SLEEPY_NOTICE
+        return {
+            'response': bot_response,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': response_data['total_tokens'],
+            **cache_tokens
+        }
+
+    @staticmethod
+    def log_interaction(user_id: str, username: str, channel_id: str, user_msg: str, bot_resp: str,
+                        input_tokens: int, output_tokens: int,
+                        cache_hit_tokens: int = 0, cache_miss_tokens: int = 0,
+                        model: Optional[str] = None):
+        """Log the interaction and its token usage (on the writer thread when writes are queued)"""
+        write_queue.submit(ChatService._write_interaction, user_id, username, channel_id, user_msg, bot_resp,
+                           input_tokens, output_tokens, cache_hit_tokens, cache_miss_tokens, model, wait=False)
+
+    @staticmethod
+    def _write_interaction(user_id: str, username: str, channel_id: str, user_msg: str, bot_resp: str,
+                           input_tokens: int, output_tokens: int,
+                           cache_hit_tokens: int, cache_miss_tokens: int, model: Optional[str]):
+        session = Session()
+        try:
+            session.add(Log(user_id=user_id, username=username, channel_id=channel_id,
+                            user_message=user_msg, bot_response=bot_resp,
+                            input_tokens=input_tokens, output_tokens=output_tokens,
+                            cache_hit_tokens=cache_hit_tokens, cache_miss_tokens=cache_miss_tokens))
+            session.add(TokenUsage(total_tokens=input_tokens + output_tokens,
+                                   input_tokens=input_tokens, output_tokens=output_tokens,
+                                   cache_hit_tokens=cache_hit_tokens, cache_miss_tokens=cache_miss_tokens,
+                                   task='chat', model=model))
+            session.commit()
+        finally:
+            session.close()
+        record_usage(user_id, input_tokens + output_tokens)
+
+    @staticmethod
+    def log_discarded_usage(user_id: str, input_tokens: int, output_tokens: int,
+                            cache_hit_tokens: int = 0, cache_miss_tokens: int = 0,
+                            model: Optional[str] = None):
+        """Account for tokens spent on a reply that was superseded and never sent"""
+        ChatService.log_task_usage(user_id, {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                                             'cache_hit_tokens': cache_hit_tokens,
+                                             'cache_miss_tokens': cache_miss_tokens}, 'chat', model)
+
+    @staticmethod
+    def log_task_usage(user_id: str, usage: Dict[str, Any], task: str, model: Optional[str] = None):
+        """Account for the tokens of an LLM call that is not itself a logged interaction"""
+        write_queue.submit(ChatService._write_task_usage, user_id, usage, task, model, wait=False)
+
+    @staticmethod
+    def _write_task_usage(user_id: str, usage: Dict[str, Any], task: str, model: Optional[str]):
+        total_tokens = usage['input_tokens'] + usage['output_tokens']
+        session = Session()
+        try:
+            session.add(TokenUsage(total_tokens=total_tokens,
+                                   input_tokens=usage['input_tokens'], output_tokens=usage['output_tokens'],
+                                   cache_hit_tokens=usage.get('cache_hit_tokens', 0),
+                                   cache_miss_tokens=usage.get('cache_miss_tokens', 0),
+                                   task=task, model=model))
+            session.commit()
+        finally:
+            session.close()
+        record_usage(user_id, total_tokens)
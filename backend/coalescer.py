@@ -0,0 +1,99 @@
+from backend.metrics import register_collector
+import itertools
+import os
+import threading
+from typing import List, Dict, Any, Optional, Hashable
+
+# Seconds to wait for follow-up messages before answering; 0 turns coalescing off.
+# The web chat waits in its request thread, so each message in flight holds a Flask
+# worker for at least this long; size the worker pool for it before enabling it there.
+CHAT_COALESCE_WINDOW = float(os.getenv('CHAT_COALESCE_WINDOW', '0'))
+
+MERGED_NOTICE = "*(Answered together with your next message.)*"
+
+
+class MessageCoalescer:
+    """
+    Merges bursts of messages from one conversation into a single LLM turn.
+
+    Each message gets a ticket. After waiting out the window, only the holder
+    of the newest ticket takes the buffered messages and runs the turn; older
+    holders are told their message was merged. If a newer message arrives
+    while a turn is generating, claim() fails for the older turn, its reply
+    is dropped and the newer turn answers every buffered message at once.
+    """
+
+    def __init__(self, window: float = CHAT_COALESCE_WINDOW):
+        self.window = window
+        self._conversations: Dict[Hashable, Dict[str, Any]] = {}
+        self._tickets = itertools.count(1)
+        self._lock = threading.Lock()
+        self.merged = 0
+        self.superseded = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def add(self, key: Hashable, message: str) -> int:
+        """Buffer a message and return its ticket"""
+        with self._lock:
+            conversation = self._conversations.setdefault(key, {'messages': [], 'ticket': 0})
+            conversation['messages'].append(message)
+            conversation['ticket'] = next(self._tickets)
+            return conversation['ticket']
+
+    def has_pending(self, key: Hashable) -> bool:
+        """Whether a message for this conversation is already waiting to be answered"""
+        with self._lock:
+            return key in self._conversations
+
+    def is_current(self, key: Hashable, ticket: int) -> bool:
+        with self._lock:
+            conversation = self._conversations.get(key)
+            return conversation is not None and conversation['ticket'] == ticket
+
+    def take(self, key: Hashable, ticket: int) -> Optional[str]:
+        """
+        After the window: the merged text for the newest ticket, or None if a
+        later message arrived and will answer for this one. Messages stay
+        buffered until claim() so a superseding turn still includes them.
+        """
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None or conversation['ticket'] != ticket:
+                self.merged += 1
+                return None
+            return '\n'.join(conversation['messages'])
+
+    def claim(self, key: Hashable, ticket: int) -> bool:
+        """
+        Called once a reply is generated, before anything is saved. True means
+        the turn is still current and its messages are now consumed.
+        """
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None or conversation['ticket'] != ticket:
+                self.superseded += 1
+                return False
+            del self._conversations[key]
+            return True
+
+    def abandon(self, key: Hashable, ticket: int):
+        """Drop the buffer after a failed turn, unless a newer message now owns it"""
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is not None and conversation['ticket'] == ticket:
+                del self._conversations[key]
+
+    def metrics(self) -> List[str]:
+        with self._lock:
+            merged, superseded = self.merged, self.superseded
+        return ['# TYPE luma_chat_messages_merged_total counter',
+                f'luma_chat_messages_merged_total {merged}',
+                '# TYPE luma_chat_generations_superseded_total counter',
+                f'luma_chat_generations_superseded_total {superseded}']
+
+
+chat_coalescer = MessageCoalescer()
+register_collector(chat_coalescer.metrics)
@@ -0,0 +1,175 @@
+from sqlalchemy import and_
+from shared.models import ConversationSummary, ShortTermMessage, TokenUsage, Session
+from backend.metrics import register_collector
+from backend.short_term_memory import ShortTermMemory
+from backend.llm_interface import get_provider_for_task
+from backend.rate_limiter import record_usage
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from typing import List, Dict, Optional
+
+# Estimated history tokens at which older turns get folded into the summary; 0 disables summarization
+SUMMARY_TRIGGER_TOKENS = int(os.getenv('SUMMARY_TRIGGER_TOKENS', '1200'))
+# Most recent messages always kept verbatim in the prompt
+SUMMARY_KEEP_MESSAGES = int(os.getenv('SUMMARY_KEEP_MESSAGES', '6'))
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '250'))
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Update the summary with the new messages below. Keep names, facts, preferences, open "
+    "questions and anything the assistant promised; drop small talk. Write at most {words} words "
+    "of plain prose and reply with the summary only.\n\n"
+    "Current summary:\n{summary}\n\nNew messages:\n{messages}"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token), good enough for thresholds"""
+    return len(text) // 4 + 1
+
+
+def history_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(m['content']) for m in messages)
+
+
+class ConversationSummarizer:
+    """
+    Keeps prompt size roughly constant over long conversations. Once a
+    conversation's raw history passes SUMMARY_TRIGGER_TOKENS, everything but
+    the newest few messages is folded into a persisted running summary.
+    Summaries are written in a background thread, never on the reply path.
+    """
+
+    def __init__(self, trigger_tokens: int = SUMMARY_TRIGGER_TOKENS,
+                 keep_messages: int = SUMMARY_KEEP_MESSAGES):
+        self.trigger_tokens = trigger_tokens
+        self.keep_messages = keep_messages
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='summarizer')
+        self.runs = 0
+        self.folded_messages = 0
+        self.errors = 0
+
+    @staticmethod
+    def get_summary(user_id: str, channel_id: str = '') -> Optional[str]:
+        session = Session()
+        try:
+            row = session.query(ConversationSummary).filter(
+                and_(ConversationSummary.user_id == user_id, ConversationSummary.channel_id == channel_id)
+            ).first()
+            return row.summary if row else None
+        finally:
+            session.close()
+
+    def schedule(self, user_id: str, channel_id: str = ''):
+        """Queue a summarization check for a conversation; at most one runs per conversation"""
+        if self.trigger_tokens <= 0:
+            return
+        key = (user_id, channel_id)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._pool.submit(self._run, user_id, channel_id)
+
+    def _run(self, user_id: str, channel_id: str):
+        try:
+            self.summarize(user_id, channel_id)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            print(f"Error summarizing conversation for user {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard((user_id, channel_id))
+
+    def summarize(self, user_id: str, channel_id: str = '', force: bool = False) -> int:
+        """
+        Fold older messages into the summary if the history is over the
+        threshold (or force is set). Returns the number of messages folded.
+        """
+        messages = ShortTermMemory.get_messages(user_id, channel_id)
+        if len(messages) <= self.keep_messages:
+            return 0
+        if not force and history_tokens(messages) < self.trigger_tokens:
+            return 0
+
+        # Keep at most keep_messages verbatim, and no more than half the trigger's worth of
+        # tokens, so the next summarization only happens after real growth
+        keep = 0
+        kept_tokens = 0
+        # messages[-0:] would be the whole history, so keep_messages <= 0 keeps nothing
+        recent = messages[-self.keep_messages:] if self.keep_messages > 0 else []
+        for message in reversed(recent):
+            kept_tokens += estimate_tokens(message['content'])
+            if keep >= 2 and kept_tokens > self.trigger_tokens // 2:
+                break
+            keep += 1
+        older = messages[:len(messages) - keep]
+        previous = self.get_summary(user_id, channel_id)
+        transcript = '\n'.join(f"{m['role'].capitalize()}: {m['content']}" for m in older)
+        prompt = SUMMARY_PROMPT.format(words=int(SUMMARY_MAX_TOKENS * 0.75),
+                                       summary=previous or '(none yet)', messages=transcript)
+
+        provider = get_provider_for_task('summarization')
+        response = provider.chat_completion(
+            messages=[{'role': 'user', 'content': prompt}],
+            max_tokens=SUMMARY_MAX_TOKENS,
+            temperature=0.3,
+            task='summarization'
+        )
+        summary = (response['content'] or '').strip()
+        if not summary:
+            return 0
+
+        session = Session()
+        try:
+            # Only keep the result if nobody else folded these messages in the meantime
+            older_ids = [m['id'] for m in older]
+            removed = session.query(ShortTermMessage).filter(
+                ShortTermMessage.id.in_(older_ids)
+            ).delete(synchronize_session=False)
+            if removed != len(older_ids):
+                session.rollback()
+                return 0
+
+            row = session.query(ConversationSummary).filter(
+                and_(ConversationSummary.user_id == user_id, ConversationSummary.channel_id == channel_id)
+            ).first()
+            if row is None:
+                row = ConversationSummary(user_id=user_id, channel_id=channel_id, message_count=0)
+                session.add(row)
+            row.summary = summary
+            row.message_count = (row.message_count or 0) + len(older)
+
+            session.add(TokenUsage(total_tokens=response['total_tokens'],
+                                   input_tokens=response['input_tokens'],
+                                   output_tokens=response['output_tokens'],
+                                   cache_hit_tokens=response.get('cache_hit_tokens', 0),
+                                   cache_miss_tokens=response.get('cache_miss_tokens', 0),
+                                   task='summarization', model=provider.model))
+            session.commit()
+        finally:
+            session.close()
+
+        record_usage(user_id, response['total_tokens'])
+        with self._lock:
+            self.runs += 1
+            self.folded_messages += len(older)
+        return len(older)
+
+    def metrics(self) -> List[str]:
+        with self._lock:
+            runs, folded, errors = self.runs, self.folded_messages, self.errors
+        return ['# TYPE luma_summary_runs_total counter',
+                f'luma_summary_runs_total {runs}',
+                '# TYPE luma_summary_folded_messages_total counter',
+                f'luma_summary_folded_messages_total {folded}',
+                '# TYPE luma_summary_errors_total counter',
+                f'luma_summary_errors_total {errors}']
+
+
+conversation_summarizer = ConversationSummarizer()
+register_collector(conversation_summarizer.metrics)
@@ -0,0 +1,241 @@
+from sqlalchemy import and_
+from shared.models import Memory, Document, DocumentChunk, Session
+from backend.memory_manager import commit_memory_changes
+import json
+import hashlib
+import re
+from typing import List, Dict, Any, Optional, Tuple
+
+DEFAULT_CHUNK_SIZE = 2000
+# A paragraph ends its chunk when the chunk is at least chunk_size / CHUNK_MIN_FRACTION long
+# and the paragraph's hash is divisible by CHUNK_BOUNDARY_MODULUS. Boundaries then depend on
+# the text around them rather than on offsets, so an edit only moves the chunks next to it.
+CHUNK_MIN_FRACTION = 4
+CHUNK_BOUNDARY_MODULUS = 4
+
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+
+def hash_text(text: str) -> str:
+    """Return the SHA-256 hex digest of a piece of text"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _units(content: str, chunk_size: int) -> List[Tuple[str, str]]:
+    """
+    (text, separator before it) pieces to pack into chunks: paragraphs, or
+    the lines of a paragraph too long for one chunk, with overlong lines cut
+    at chunk_size
+    """
+    units = []
+    for paragraph in _PARAGRAPH_BREAK.split(content):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= chunk_size:
+            units.append((paragraph, '\n\n'))
+            continue
+        separator = '\n\n'
+        for line in paragraph.splitlines():
+            for start in range(0, max(len(line), 1), chunk_size):
+                units.append((line[start:start+chunk_size], separator))
+                separator = '\n'
+    return units
+
+
+def split_into_chunks(content: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[str]:
+    """
+    Split content into chunks of at most chunk_size characters along
+    paragraph (or, inside very long paragraphs, line) breaks. Headings always
+    start a new chunk; otherwise a chunk ends after a piece picked by its
+    content hash, so the same text produces the same chunks wherever it sits
+    in the document.
+    """
+    chunks, current = [], ''
+    for text, separator in _units(content, chunk_size):
+        if current and (text.startswith('#') or len(current) + len(separator) + len(text) > chunk_size):
+            chunks.append(current)
+            current = ''
+        current = current + separator + text if current else text
+        if len(current) >= chunk_size // CHUNK_MIN_FRACTION and \
+                int(hash_text(text)[:8], 16) % CHUNK_BOUNDARY_MODULUS == 0:
+            chunks.append(current)
+            current = ''
+    if current.strip():
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def _chunk_tags(file_type: Optional[str], index: int) -> str:
+    return json.dumps(['document', f'doc-{file_type}', f'chunk-{index+1}'])
+
+
+class DocumentManager:
+    """Class to handle uploaded documents and their memory chunks"""
+
+    @staticmethod
+    def get_documents(user_id: Optional[str] = None) -> List[Document]:
+        """Get documents, newest first, optionally for a single user"""
+        session = Session()
+        try:
+            query = session.query(Document)
+            if user_id:
+                query = query.filter(Document.user_id == user_id)
+            return query.order_by(Document.updated_at.desc()).all()
+        finally:
+            session.close()
+
+    @staticmethod
+    def get_document(document_id: int) -> Optional[Document]:
+        """Get a single document by id"""
+        session = Session()
+        try:
+            return session.query(Document).filter(Document.id == document_id).first()
+        finally:
+            session.close()
+
+    @staticmethod
+    def ingest_document(user_id: str, filename: str, content: str,
+                        file_type: Optional[str] = None,
+                        metadata: Optional[Dict[str, Any]] = None,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE) -> Dict[str, Any]:
+        """
+        Store a document as ordered memory chunks.
+
+        A document whose full-text hash already exists for the user is skipped.
+        Re-uploading a changed file with the same name re-indexes it chunk by
+        chunk: chunks are matched to the stored ones by hash wherever they
+        moved, changed chunks take over the memories of chunks that no longer
+        exist, and whatever is left over is added or removed.
+        """
+        content_hash = hash_text(content)
+        chunks = split_into_chunks(content, chunk_size)
+        result = {
+            'status': 'skipped',
+            'document_id': None,
+            'chunks_total': len(chunks),
+            'chunks_added': 0,
+            'chunks_updated': 0,
+            'chunks_removed': 0,
+            'chunks_unchanged': 0
+        }
+
+        session = Session()
+        try:
+            duplicate = session.query(Document).filter(
+                and_(Document.user_id == user_id, Document.content_hash == content_hash)
+            ).first()
+            if duplicate and len(duplicate.chunks) == duplicate.chunk_count:
+                result['document_id'] = duplicate.id
+                result['chunks_unchanged'] = duplicate.chunk_count
+                return result
+
+            document = session.query(Document).filter(
+                and_(Document.user_id == user_id, Document.filename == filename)
+            ).first()
+            if document:
+                result['status'] = 'updated'
+            else:
+                result['status'] = 'created'
+                document = Document(user_id=user_id, filename=filename)
+                session.add(document)
+
+            document.file_type = file_type
+            document.content_hash = content_hash
+            document.chunk_count = len(chunks)
+            document.doc_metadata = json.dumps(metadata) if metadata else None
+
+            memories = {}
+            if document.chunks:
+                memories = {memory.id: memory for memory in session.query(Memory).filter(
+                    Memory.id.in_([chunk.memory_id for chunk in document.chunks]))}
+            # Stored chunks by hash, skipping any whose backing memory was removed by hand
+            by_hash: Dict[str, List[DocumentChunk]] = {}
+            for chunk in list(document.chunks):
+                if chunk.memory_id in memories:
+                    by_hash.setdefault(chunk.chunk_hash, []).append(chunk)
+                else:
+                    document.chunks.remove(chunk)
+
+            # First pass: unchanged text keeps its chunk and memory, even if it moved
+            pending = []
+            for index, text in enumerate(chunks):
+                chunk_hash = hash_text(text)
+                matches = by_hash.get(chunk_hash)
+                if matches:
+                    chunk = matches.pop(0)
+                    if chunk.chunk_index != index:
+                        chunk.chunk_index = index
+                        memories[chunk.memory_id].tags = _chunk_tags(file_type, index)
+                    result['chunks_unchanged'] += 1
+                else:
+                    pending.append((index, text, chunk_hash))
+            leftovers = [chunk for matches in by_hash.values() for chunk in matches]
+            leftovers.sort(key=lambda chunk: chunk.chunk_index)
+
+            # Second pass: new text reuses a leftover chunk's memory, or gets a new one
+            for index, text, chunk_hash in pending:
+                if leftovers:
+                    chunk = leftovers.pop(0)
+                    memory = memories[chunk.memory_id]
+                    memory.content = text
+                    memory.tags = _chunk_tags(file_type, index)
+                    chunk.chunk_index = index
+                    chunk.chunk_hash = chunk_hash
+                    result['chunks_updated'] += 1
+                    continue
+
+                memory = Memory(
+                    user_id=user_id,
+                    memory_type='long',
+                    content=text,
+                    source='document_upload',
+                    importance=0,
+                    tags=_chunk_tags(file_type, index),
+                    approved=True
+                )
+                session.add(memory)
+                session.flush()
+                document.chunks.append(DocumentChunk(
+                    memory_id=memory.id, chunk_index=index, chunk_hash=chunk_hash
+                ))
+                result['chunks_added'] += 1
+
+            # Stored chunks whose text is gone and that no new chunk took over
+            stale_memory_ids = [chunk.memory_id for chunk in leftovers]
+            for chunk in leftovers:
+                document.chunks.remove(chunk)
+            session.flush()
+            if stale_memory_ids:
+                session.query(Memory).filter(Memory.id.in_(stale_memory_ids)).delete(
+                    synchronize_session=False
+                )
+            result['chunks_removed'] = len(stale_memory_ids)
+
+            commit_memory_changes(session, [user_id])
+            result['document_id'] = document.id
+            return result
+        finally:
+            session.close()
+
+    @staticmethod
+    def delete_document(document_id: int) -> bool:
+        """Delete a document together with all of its chunk memories"""
+        session = Session()
+        try:
+            document = session.query(Document).filter(Document.id == document_id).first()
+            if not document:
+                return False
+
+            memory_ids = [chunk.memory_id for chunk in document.chunks]
+            user_id = document.user_id
+            session.delete(document)
+            session.flush()
+            if memory_ids:
+                session.query(Memory).filter(Memory.id.in_(memory_ids)).delete(
+                    synchronize_session=False
+                )
+            commit_memory_changes(session, [user_id])
+            return True
+        finally:
+            session.close()
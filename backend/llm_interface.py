@@ -1,115 +1,192 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional
-from shared.models import Memory, Setting
+from typing import List, Dict, Any, Optional, Tuple
+from shared.models import Setting, Session
+from backend.ollama_discovery import DEFAULT_OLLAMA_ENDPOINT
+from backend.metrics import (record_llm_call, record_llm_error, record_llm_timings,
+                             record_prompt_cache)
 from openai import OpenAI
 import requests
 import json
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
 import os
+import threading
+import time
 
-DATABASE_URL = os.getenv('DATABASE_URL', 'postgresql://luma:lumapass@db:5432/luma')
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+DEEPSEEK_BASE_URL = os.getenv('DEEPSEEK_BASE_URL', 'https://api.deepseek.com/v1')
+# How long Ollama keeps the model loaded after a call, e.g. "30m", "-1" for forever; overridable in settings
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+DEFAULT_DEEPSEEK_MODEL = 'deepseek-chat'
+COLD_START_THRESHOLD = 0.5  # Reported load time (seconds) above which a call counts as a cold start
+# Seconds to wait for DeepSeek; the client's own default is ten minutes
+DEEPSEEK_TIMEOUT = float(os.getenv('DEEPSEEK_TIMEOUT', '60'))
+# Seconds to connect to Ollama, and to wait for its reply (loading a model from disk can take minutes)
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '5'))
+OLLAMA_READ_TIMEOUT = float(os.getenv('OLLAMA_READ_TIMEOUT', '300'))
+
+
+# Tasks that can each be routed to their own provider and model
+LLM_TASKS = ('chat', 'extraction', 'summarization')
+
+MEMORY_EXTRACTION_PROMPT = """
+        Analyze the following conversation and suggest important memories that should be retained:
+        
+        User: {user_message}
+        AI: {bot_response}
+        
+        Respond with a JSON array of memory suggestions. Each suggestion should be a concise statement about something important that should be remembered. Only return the JSON array with no other text.
+        """
 
 
 class LLMInterface(ABC):
     """Abstract interface for LLM providers"""
+
+    name = 'llm'
+    model = None
     
     @abstractmethod
     def chat_completion(self, messages: List[Dict[str, str]], 
                        max_tokens: int = 150, 
-                       temperature: float = 0.7) -> Dict[str, Any]:
-        """Generate chat completion"""
+                       temperature: float = 0.7,
+                       task: str = 'chat') -> Dict[str, Any]:
+        """Generate chat completion; task only labels metrics"""
         pass
 
-    @abstractmethod
-    def extract_memory_suggestions(self, user_message: str, bot_response: str) -> List[str]:
-        """Extract memory suggestions from conversation"""
-        pass
+    def extract_memory_suggestions_with_usage(self, user_message: str,
+                                              bot_response: str) -> Tuple[List[str], Optional[Dict[str, Any]]]:
+        """
+        Extract memory suggestions by asking the model to identify important
+        information that should be remembered. Also returns the call's
+        response (for token accounting), or None if the call failed.
+        """
+        messages = [{"role": "user", "content": MEMORY_EXTRACTION_PROMPT.format(
+            user_message=user_message, bot_response=bot_response)}]
+        try:
+            response = self.chat_completion(messages, max_tokens=200, temperature=0.3, task='extraction')
+        except Exception as e:
+            print(f"Error extracting memory suggestions: {e}")
+            return [], None
+
+        content = (response['content'] or '').strip()
+        # Remove any markdown formatting
+        if content.startswith('```json'):
+            content = content[7:content.rfind('```')]
+        elif content.startswith('```'):
+            content = content[3:content.rfind('```')]
+        try:
+            suggestions = json.loads(content)
+        except ValueError as e:
+            print(f"Error parsing memory suggestions from {self.name}: {e}")
+            return [], response
+        return (suggestions if isinstance(suggestions, list) else []), response
+
+    def warm_up(self, prefix: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Load the model ahead of the first turn; providers without a local model do nothing"""
+        return None
 
 
 class DeepSeekInterface(LLMInterface):
     """DeepSeek API implementation"""
+
+    name = 'deepseek'
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, model: str = DEFAULT_DEEPSEEK_MODEL):
         self.api_key = api_key
-        self.client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com/v1")
+        self.model = model
+        self.client = OpenAI(api_key=api_key, base_url=DEEPSEEK_BASE_URL, timeout=DEEPSEEK_TIMEOUT)
     
     def chat_completion(self, messages: List[Dict[str, str]], 
                        max_tokens: int = 150, 
-                       temperature: float = 0.7) -> Dict[str, Any]:
+                       temperature: float = 0.7,
+                       task: str = 'chat') -> Dict[str, Any]:
+        start = time.perf_counter()
         try:
             response = self.client.chat.completions.create(
-                model="deepseek-chat",
+                model=self.model,
                 messages=messages,
                 max_tokens=max_tokens,
                 temperature=temperature
             )
+            record_llm_call('deepseek', task, time.perf_counter() - start,
+                            response.usage.prompt_tokens, response.usage.completion_tokens)
+            cache_hit, cache_miss = self._cache_usage(response.usage)
             
             return {
                 'content': response.choices[0].message.content,
                 'input_tokens': response.usage.prompt_tokens,
                 'output_tokens': response.usage.completion_tokens,
-                'total_tokens': response.usage.prompt_tokens + response.usage.completion_tokens
+                'total_tokens': response.usage.prompt_tokens + response.usage.completion_tokens,
+                'cache_hit_tokens': cache_hit,
+                'cache_miss_tokens': cache_miss
             }
         except Exception as e:
+            record_llm_error('deepseek', task)
             raise Exception(f"DeepSeek API error: {str(e)}")
     
-    def extract_memory_suggestions(self, user_message: str, bot_response: str) -> List[str]:
-        """
-        Extract memory suggestions using the LLM by asking it to identify important
-        information that should be remembered.
-        """
-        prompt = f"""
-        Analyze the following conversation and suggest important memories that should be retained:
-        
-        User: {user_message}
-        AI: {bot_response}
-        
-        Respond with a JSON array of memory suggestions. Each suggestion should be a concise statement about something important that should be remembered. Only return the JSON array with no other text.
-        """
-        
-        messages = [
-            {"role": "user", "content": prompt}
-        ]
-        
-        try:
-            response = self.client.chat.completions.create(
-                model="deepseek-chat",
-                messages=messages,
-                max_tokens=200,
-                temperature=0.3
-            )
-            
-            # Extract JSON from response
-            content = response.choices[0].message.content.strip()
-            # Remove any markdown formatting
-            if content.startswith('```json'):
-                content = content[7:content.rfind('```')]
-            elif content.startswith('```'):
-                content = content[3:content.rfind('```')]
-            
-            suggestions = json.loads(content)
-            if isinstance(suggestions, list):
-                return suggestions
-            else:
-                return []
-        except Exception as e:
-            print(f"Error extracting memory suggestions: {e}")
-            return []
+    @staticmethod
+    def _cache_usage(usage) -> tuple:
+        """DeepSeek's context cache split of the prompt tokens, recorded for the hit ratio"""
+        hit = getattr(usage, 'prompt_cache_hit_tokens', None) or 0
+        miss = getattr(usage, 'prompt_cache_miss_tokens', None)
+        if miss is None:
+            miss = usage.prompt_tokens - hit
+        record_prompt_cache('deepseek', hit, miss)
+        return hit, miss
 
 
 class OllamaInterface(LLMInterface):
     """Ollama API implementation"""
+
+    name = 'ollama'
     
-    def __init__(self, base_url: str = "http://localhost:11434", model: str = "llama2"):
+    def __init__(self, base_url: str = DEFAULT_OLLAMA_ENDPOINT, model: str = "llama2",
+                 keep_alive: str = OLLAMA_KEEP_ALIVE):
         self.base_url = base_url.rstrip('/')
         self.model = model
+        # Ollama takes durations like "30m" or a number of seconds (-1 keeps the model loaded)
+        self.keep_alive = int(keep_alive) if str(keep_alive).lstrip('-').isdigit() else keep_alive
+        self.session = requests.Session()  # Reuse connections between turns
+        self.timeout = (OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)
+
+    def _record_timings(self, task: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Record Ollama's own timings (reported in nanoseconds) and return them in seconds"""
+        load = data.get('load_duration', 0) / 1e9
+        prompt_eval = data.get('prompt_eval_duration', 0) / 1e9
+        cold = load > COLD_START_THRESHOLD
+        record_llm_timings('ollama', task, prompt_eval_seconds=prompt_eval, load_seconds=load,
+                           cold_start=cold)
+        return {'load_seconds': load, 'prompt_eval_seconds': prompt_eval,
+                'prompt_eval_count': data.get('prompt_eval_count', 0), 'cold_start': cold}
+
+    def warm_up(self, prefix: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Load the model and refresh its keep_alive. With a prefix (the stable
+        start of the system prompt) the prefix is evaluated too, so Ollama
+        can reuse it from its prompt cache on the next turn.
+        """
+        start = time.perf_counter()
+        if prefix:
+            response = self.session.post(f"{self.base_url}/api/chat", json={
+                "model": self.model,
+                "messages": [{"role": "system", "content": prefix}],
+                "options": {"num_predict": 1},
+                "keep_alive": self.keep_alive,
+                "stream": False
+            }, timeout=self.timeout)
+        else:
+            # An empty prompt only loads the model
+            response = self.session.post(f"{self.base_url}/api/generate", json={
+                "model": self.model,
+                "keep_alive": self.keep_alive,
+                "stream": False
+            }, timeout=self.timeout)
+        response.raise_for_status()
+        timings = self._record_timings('warmup', response.json())
+        timings['total_seconds'] = time.perf_counter() - start
+        return timings
     
     def chat_completion(self, messages: List[Dict[str, str]], 
                        max_tokens: int = 150, 
-                       temperature: float = 0.7) -> Dict[str, Any]:
+                       temperature: float = 0.7,
+                       task: str = 'chat') -> Dict[str, Any]:
         url = f"{self.base_url}/api/chat"
         
         payload = {
@@ -119,75 +196,40 @@ class OllamaInterface(LLMInterface):
                 "temperature": temperature,
                 "num_predict": max_tokens
             },
+            "keep_alive": self.keep_alive,
             "stream": False
         }
         
+        start = time.perf_counter()
         try:
-            response = requests.post(url, json=payload)
+            response = self.session.post(url, json=payload, timeout=self.timeout)
             response.raise_for_status()
             
             data = response.json()
+            duration = time.perf_counter() - start
             
             # Calculate tokens - Ollama doesn't always provide exact token counts
             # We'll estimate based on character count as a fallback
             input_tokens = len(" ".join([msg.get("content", "") for msg in messages]))
             output_tokens = len(data.get('message', {}).get('content', ''))
+            record_llm_call('ollama', task, duration,
+                            data.get('prompt_eval_count', input_tokens // 4),
+                            data.get('eval_count', output_tokens // 4))
+            self._record_timings(task, data)
             
+            # prompt_eval_count counts the prompt, eval_count the generated tokens
             return {
                 'content': data['message']['content'],
-                'input_tokens': data.get('eval_count', input_tokens // 4),  # Rough estimation
-                'output_tokens': data.get('prompt_eval_count', output_tokens // 4),  # Rough estimation
-                'total_tokens': data.get('eval_count', input_tokens // 4) + data.get('prompt_eval_count', output_tokens // 4)
+                'input_tokens': data.get('prompt_eval_count', input_tokens // 4),  # Rough estimation
+                'output_tokens': data.get('eval_count', output_tokens // 4),  # Rough estimation
+                'total_tokens': data.get('prompt_eval_count', input_tokens // 4) + data.get('eval_count', output_tokens // 4),
+                # Ollama does not report prompt cache reuse per request
+                'cache_hit_tokens': 0,
+                'cache_miss_tokens': 0
             }
         except Exception as e:
+            record_llm_error('ollama', task)
             raise Exception(f"Ollama API error: {str(e)}")
-    
-    def extract_memory_suggestions(self, user_message: str, bot_response: str) -> List[str]:
-        """
-        Extract memory suggestions using the local Ollama model.
-        """
-        prompt = f"""
-        Analyze the following conversation and suggest important memories that should be retained:
-        
-        User: {user_message}
-        AI: {bot_response}
-        
-        Respond with a JSON array of memory suggestions. Each suggestion should be a concise statement about something important that should be remembered. Only return the JSON array with no other text.
-        """
-        
-        url = f"{self.base_url}/api/chat"
-        
-        payload = {
-            "model": self.model,
-            "messages": [{"role": "user", "content": prompt}],
-            "options": {
-                "temperature": 0.3,
-                "num_predict": 200
-            },
-            "stream": False
-        }
-        
-        try:
-            response = requests.post(url, json=payload)
-            response.raise_for_status()
-            
-            data = response.json()
-            content = data['message']['content'].strip()
-            
-            # Remove any markdown formatting
-            if content.startswith('```json'):
-                content = content[7:content.rfind('```')]
-            elif content.startswith('```'):
-                content = content[3:content.rfind('```')]
-            
-            suggestions = json.loads(content)
-            if isinstance(suggestions, list):
-                return suggestions
-            else:
-                return []
-        except Exception as e:
-            print(f"Error extracting memory suggestions from Ollama: {e}")
-            return []
 
 
 def create_llm_provider(provider_type: str, **kwargs) -> LLMInterface:
@@ -196,42 +238,91 @@ def create_llm_provider(provider_type: str, **kwargs) -> LLMInterface:
         api_key = kwargs.get('api_key')
         if not api_key:
             raise ValueError("DeepSeek API key is required")
-        return DeepSeekInterface(api_key)
+        return DeepSeekInterface(api_key, kwargs.get('model') or DEFAULT_DEEPSEEK_MODEL)
     elif provider_type.lower() == 'ollama':
-        base_url = kwargs.get('base_url', 'http://localhost:11434')
+        base_url = kwargs.get('base_url', DEFAULT_OLLAMA_ENDPOINT)
         model = kwargs.get('model', 'llama2')
-        return OllamaInterface(base_url, model)
+        keep_alive = kwargs.get('keep_alive') or OLLAMA_KEEP_ALIVE
+        return OllamaInterface(base_url, model, keep_alive)
     else:
         raise ValueError(f"Unsupported provider type: {provider_type}")
 
 
-def get_current_provider() -> LLMInterface:
-    """Get the currently configured LLM provider based on settings"""
+# Settings that decide which provider a turn uses, loaded together in one query.
+# <task>_provider and <task>_model route memory extraction and summarization to their
+# own provider and model; left empty, a task uses the chat provider and model.
+PROVIDER_SETTING_KEYS = ['model_provider', 'deepseek_api_key', 'ollama_endpoint', 'ollama_model',
+                         'ollama_keep_alive', 'extraction_provider', 'extraction_model',
+                         'summarization_provider', 'summarization_model']
+
+# Providers are reused while their settings are unchanged, so HTTP clients and their
+# connection pools survive between turns
+_providers: Dict[tuple, LLMInterface] = {}
+_providers_lock = threading.Lock()
+
+
+def load_settings(keys: List[str]) -> Dict[str, str]:
+    """Fetch several settings in a single query"""
     session = Session()
     try:
-        # Get provider type
-        provider_setting = session.query(Setting).filter_by(key='model_provider').first()
-        provider_type = provider_setting.value if provider_setting else 'deepseek'
+        rows = session.query(Setting.key, Setting.value).filter(Setting.key.in_(keys)).all()
+        return {key: value for key, value in rows}
+    finally:
+        session.close()
 
-        if provider_type == 'deepseek':
-            api_key_setting = session.query(Setting).filter_by(key='deepseek_api_key').first()
-            if not api_key_setting:
-                raise ValueError("DeepSeek API key not configured")
-            return create_llm_provider('deepseek', api_key=api_key_setting.value)
-        elif provider_type == 'ollama':
-            endpoint_setting = session.query(Setting).filter_by(key='ollama_endpoint').first()
-            model_setting = session.query(Setting).filter_by(key='ollama_model').first()
 
-            base_url = endpoint_setting.value if endpoint_setting else 'http://localhost:11434'
-            model = model_setting.value if model_setting else 'llama2'
+def task_settings(settings: Dict[str, str], task: str) -> Dict[str, str]:
+    """The provider settings with a task's own provider and model applied on top"""
+    if task == 'chat':
+        return settings
+    provider_type = settings.get(f'{task}_provider')
+    model = settings.get(f'{task}_model')
+    if not provider_type and not model:
+        return settings
 
-            return create_llm_provider('ollama', base_url=base_url, model=model)
+    routed = dict(settings)
+    if provider_type:
+        routed['model_provider'] = provider_type
+    if model:
+        if routed.get('model_provider') == 'ollama':
+            routed['ollama_model'] = model
         else:
-            # Default to DeepSeek if no provider is set
-            api_key_setting = session.query(Setting).filter_by(key='deepseek_api_key').first()
-            if api_key_setting:
-                return create_llm_provider('deepseek', api_key=api_key_setting.value)
+            routed['deepseek_model'] = model
+    return routed
+
+
+def provider_from_settings(settings: Dict[str, str], task: str = 'chat') -> LLMInterface:
+    """Build (or reuse) the provider a task uses, from already loaded settings"""
+    settings = task_settings(settings, task)
+    provider_type = settings.get('model_provider', 'deepseek')
+
+    if provider_type == 'ollama':
+        key = ('ollama', settings.get('ollama_endpoint') or DEFAULT_OLLAMA_ENDPOINT,
+               settings.get('ollama_model') or 'llama2', settings.get('ollama_keep_alive') or OLLAMA_KEEP_ALIVE)
+    else:
+        # Default to DeepSeek if no provider is set
+        if not settings.get('deepseek_api_key'):
+            if provider_type == 'deepseek':
+                raise ValueError("DeepSeek API key not configured")
+            raise ValueError("No LLM provider configured")
+        key = ('deepseek', settings['deepseek_api_key'], settings.get('deepseek_model') or DEFAULT_DEEPSEEK_MODEL)
+
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            if key[0] == 'ollama':
+                provider = create_llm_provider('ollama', base_url=key[1], model=key[2], keep_alive=key[3])
             else:
-                raise ValueError("No LLM provider configured")
-    finally:
-        session.close()
\ No newline at end of file
+                provider = create_llm_provider('deepseek', api_key=key[1], model=key[2])
+            _providers[key] = provider
+        return provider
+
+
+def get_provider_for_task(task: str) -> LLMInterface:
+    """Get the provider configured for a task ('chat', 'extraction' or 'summarization')"""
+    return provider_from_settings(load_settings(PROVIDER_SETTING_KEYS), task)
+
+
+def get_current_provider() -> LLMInterface:
+    """Get the currently configured LLM provider based on settings"""
+    return get_provider_for_task('chat')
@@ -0,0 +1,334 @@
+from sqlalchemy import text, func
+from shared.models import Log, TokenUsage, LogArchive, engine, Session
+from datetime import datetime, timedelta
+import os
+import re
+import json
+import gzip
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+# Months of logs kept in the live tables; older data is archived to disk. 0 keeps everything.
+LOG_RETENTION_MONTHS = int(os.getenv('LOG_RETENTION_MONTHS', '6'))
+LOG_ARCHIVE_DIR = os.getenv('LOG_ARCHIVE_DIR', '/app/archive')
+# Days of logs the admin pages query unless asked for everything
+LOG_QUERY_DAYS = int(os.getenv('LOG_QUERY_DAYS', '31'))
+PARTITION_MONTHS_AHEAD = 2
+MAINTENANCE_LOCK_ID = 7242001  # pg_advisory_xact_lock key shared by every process
+
+# Partitioned tables and the extra (column, timestamp) indexes each one gets
+PARTITIONED_TABLES = {
+    'logs': ['user_id'],
+    'token_usages': []
+}
+MODELS = {'logs': Log, 'token_usages': TokenUsage}
+
+_PARTITION_NAME = re.compile(r'^(?P<table>\w+)_y(?P<year>\d{4})m(?P<month>\d{2})$')
+
+
+def _month_start(moment: datetime) -> datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(moment: datetime, months: int) -> datetime:
+    month = moment.month - 1 + months
+    return moment.replace(year=moment.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def partition_name(table: str, month: datetime) -> str:
+    return f"{table}_y{month.year:04d}m{month.month:02d}"
+
+
+def recent_cutoff(days: Optional[int] = None) -> datetime:
+    """Oldest timestamp the admin pages show by default; keeps queries on recent partitions"""
+    return datetime.utcnow() - timedelta(days=LOG_QUERY_DAYS if days is None else days)
+
+
+def _is_postgres() -> bool:
+    return engine.dialect.name == 'postgresql'
+
+
+def _is_partitioned(connection, table: str) -> bool:
+    return connection.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = :table"
+    ), {'table': table}).first() is not None
+
+
+def _list_partitions(connection, table: str) -> List[Tuple[str, datetime]]:
+    """Monthly partitions of a table as (name, month start), oldest first"""
+    rows = connection.execute(text(
+        "SELECT child.relname FROM pg_inherits i "
+        "JOIN pg_class parent ON parent.oid = i.inhparent "
+        "JOIN pg_class child ON child.oid = i.inhrelid "
+        "WHERE parent.relname = :table"
+    ), {'table': table}).fetchall()
+    partitions = []
+    for (name,) in rows:
+        match = _PARTITION_NAME.match(name)
+        if match and match.group('table') == table:
+            partitions.append((name, datetime(int(match.group('year')), int(match.group('month')), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def _create_partition(connection, table: str, month: datetime):
+    """Create one monthly partition, moving any matching rows out of the default partition"""
+    name = partition_name(table, month)
+    start, end = month, _add_months(month, 1)
+    bounds = {'start': start, 'end': end}
+    connection.execute(text(f'CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)'))
+    connection.execute(text(
+        f'WITH moved AS (DELETE FROM {table}_default WHERE "timestamp" >= :start AND "timestamp" < :end '
+        f'RETURNING *) INSERT INTO {name} SELECT * FROM moved'
+    ), bounds)
+    connection.execute(text(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    ))
+
+
+def _convert_to_partitioned(connection, table: str):
+    """Swap a plain table for a monthly range-partitioned one holding the same rows"""
+    legacy = f'{table}_legacy'
+    extra_indexes = PARTITIONED_TABLES[table]
+
+    connection.execute(text(f'ALTER TABLE {table} RENAME TO {legacy}'))
+    connection.execute(text(f'ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey'))
+    sequence = connection.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"),
+                                  {'t': legacy}).scalar()
+    connection.execute(text(f'UPDATE {legacy} SET "timestamp" = now() WHERE "timestamp" IS NULL'))
+
+    connection.execute(text(
+        f'CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ("timestamp")'
+    ))
+    connection.execute(text(f'ALTER TABLE {table} ALTER COLUMN "timestamp" SET NOT NULL'))
+    connection.execute(text(f'ALTER TABLE {table} ADD PRIMARY KEY (id, "timestamp")'))
+    connection.execute(text(f'CREATE INDEX ON {table} ("timestamp")'))
+    for column in extra_indexes:
+        connection.execute(text(f'CREATE INDEX ON {table} ({column}, "timestamp")'))
+    connection.execute(text(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT'))
+
+    oldest = connection.execute(text(f'SELECT min("timestamp") FROM {legacy}')).scalar()
+    month = _month_start(oldest or datetime.utcnow())
+    last = _add_months(_month_start(datetime.utcnow()), PARTITION_MONTHS_AHEAD)
+    while month <= last:
+        _create_partition(connection, table, month)
+        month = _add_months(month, 1)
+
+    connection.execute(text(f'INSERT INTO {table} SELECT * FROM {legacy}'))
+    if sequence:
+        connection.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY {table}.id'))
+    connection.execute(text(f'DROP TABLE {legacy}'))
+    print(f"Converted {table} to a monthly partitioned table")
+
+
+def ensure_partitions() -> Dict[str, int]:
+    """
+    On Postgres, convert logs/token_usages to partitioned tables if needed and
+    make sure partitions exist for this month and the next few. Returns the
+    number of partitions created per table. A no-op on other databases.
+    """
+    created = {}
+    if not _is_postgres():
+        return created
+
+    with engine.begin() as connection:
+        # Only one process converts or adds partitions at a time
+        connection.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': MAINTENANCE_LOCK_ID})
+        for table in PARTITIONED_TABLES:
+            if not _is_partitioned(connection, table):
+                _convert_to_partitioned(connection, table)
+            _recover_detached_partitions(connection, table)
+            existing = {month for _, month in _list_partitions(connection, table)}
+            month = _month_start(datetime.utcnow())
+            created[table] = 0
+            for _ in range(PARTITION_MONTHS_AHEAD + 1):
+                if month not in existing:
+                    _create_partition(connection, table, month)
+                    created[table] += 1
+                month = _add_months(month, 1)
+    return created
+
+
+def _write_archive(rows, path: str) -> Tuple[int, int]:
+    """Write result rows as gzip JSON lines; returns (row count, token total)"""
+    count = tokens = 0
+    with open(path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as archive:
+            for row in rows:
+                record = dict(row._mapping)
+                tokens += record.get('total_tokens') or \
+                    (record.get('input_tokens') or 0) + (record.get('output_tokens') or 0)
+                archive.write((json.dumps(record, default=str) + '\n').encode('utf-8'))
+                count += 1
+        # Make sure the file is on disk before the rows are dropped
+        raw.flush()
+        os.fsync(raw.fileno())
+    return count, tokens
+
+
+def _archive_partition(table: str, name: str, month: datetime) -> Optional[LogArchive]:
+    """
+    Dump a partition to disk, then record the archive and drop the partition
+    in one transaction. The partition stays attached until the archive row
+    commits, so a failed write or insert leaves its rows in place for the
+    next run.
+    """
+    path = os.path.join(LOG_ARCHIVE_DIR, f'{name}.jsonl.gz')
+    with engine.connect() as connection:
+        rows = connection.execution_options(stream_results=True, yield_per=1000).execute(
+            text(f'SELECT * FROM {name} ORDER BY id'))
+        count, tokens = _write_archive(rows, path)
+
+    archive = LogArchive(table_name=table, partition_name=name, period_start=month,
+                         period_end=_add_months(month, 1), row_count=count,
+                         total_tokens=tokens, path=path)
+    session = Session()
+    try:
+        session.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': MAINTENANCE_LOCK_ID})
+        session.execute(text(f'ALTER TABLE {table} DETACH PARTITION {name}'))
+        # Late rows for an expired month would be lost with the partition; rolling back
+        # reattaches it and the next run archives them too
+        if session.execute(text(f'SELECT count(*) FROM {name}')).scalar() != count:
+            session.rollback()
+            print(f"Rows were added to {name} while it was archived, retrying next run")
+            return None
+        session.add(archive)
+        session.execute(text(f'DROP TABLE {name}'))
+        session.commit()
+        session.refresh(archive)
+        return archive
+    finally:
+        session.close()
+
+
+def _recover_detached_partitions(connection, table: str) -> int:
+    """
+    Earlier versions detached a partition before archiving it, so a failed
+    archive left a detached table that no longer showed up anywhere. Attach
+    such tables again, or drop them if their archive was recorded.
+    """
+    rows = connection.execute(text(
+        "SELECT c.relname FROM pg_class c WHERE c.relkind = 'r' AND c.relname LIKE :pattern "
+        "AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid)"
+    ), {'pattern': f'{table}_y%m%'}).fetchall()
+    archived = {name for (name,) in connection.execute(
+        text('SELECT partition_name FROM log_archives WHERE table_name = :table'), {'table': table})}
+    recovered = 0
+    for (name,) in rows:
+        match = _PARTITION_NAME.match(name)
+        if not match or match.group('table') != table:
+            continue
+        if name in archived:
+            connection.execute(text(f'DROP TABLE {name}'))
+            continue
+        start = datetime(int(match.group('year')), int(match.group('month')), 1)
+        end = _add_months(start, 1)
+        connection.execute(text(
+            f'WITH moved AS (DELETE FROM {table}_default WHERE "timestamp" >= :start AND "timestamp" < :end '
+            f'RETURNING *) INSERT INTO {name} SELECT * FROM moved'
+        ), {'start': start, 'end': end})
+        connection.execute(text(
+            f"ALTER TABLE {table} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+        print(f"Reattached detached partition {name}")
+        recovered += 1
+    return recovered
+
+
+def _archive_rows_before(table: str, cutoff: datetime) -> Optional[LogArchive]:
+    """Fallback for unpartitioned databases: dump and delete rows older than the cutoff"""
+    model = MODELS[table]
+    session = Session()
+    try:
+        if not session.query(model.id).filter(model.timestamp < cutoff).first():
+            return None
+        oldest = session.query(func.min(model.timestamp)).scalar()
+    finally:
+        session.close()
+
+    path = os.path.join(LOG_ARCHIVE_DIR, f"{table}_before_{cutoff.strftime('%Y%m%d')}_{int(time.time())}.jsonl.gz")
+    with engine.connect() as connection:
+        rows = connection.execute(model.__table__.select().where(model.timestamp < cutoff)
+                                  .order_by(model.id))
+        count, tokens = _write_archive(rows, path)
+
+    session = Session()
+    try:
+        session.query(model).filter(model.timestamp < cutoff).delete(synchronize_session=False)
+        archive = LogArchive(table_name=table, period_start=oldest, period_end=cutoff,
+                             row_count=count, total_tokens=tokens, path=path)
+        session.add(archive)
+        session.commit()
+        session.refresh(archive)
+        return archive
+    finally:
+        session.close()
+
+
+def apply_retention(retention_months: int = LOG_RETENTION_MONTHS) -> List[LogArchive]:
+    """Archive every month older than the retention window to LOG_ARCHIVE_DIR"""
+    if retention_months <= 0:
+        return []
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+    cutoff = _add_months(_month_start(datetime.utcnow()), -retention_months)
+
+    archives = []
+    for table in PARTITIONED_TABLES:
+        if _is_postgres():
+            with engine.connect() as connection:
+                expired = [(name, month) for name, month in _list_partitions(connection, table)
+                           if _add_months(month, 1) <= cutoff]
+            for name, month in expired:
+                try:
+                    archive = _archive_partition(table, name, month)
+                except Exception as e:
+                    # The partition is still attached, so nothing is lost; try again next run
+                    print(f"Error archiving partition {name}: {e}")
+                    continue
+                if archive:
+                    archives.append(archive)
+        else:
+            archive = _archive_rows_before(table, cutoff)
+            if archive:
+                archives.append(archive)
+    return archives
+
+
+def archived_token_total() -> int:
+    """Tokens recorded in token_usages rows that have since been archived"""
+    session = Session()
+    try:
+        return session.query(func.coalesce(func.sum(LogArchive.total_tokens), 0)).filter(
+            LogArchive.table_name == 'token_usages'
+        ).scalar()
+    finally:
+        session.close()
+
+
+def run_log_maintenance() -> Dict[str, Any]:
+    created = ensure_partitions()
+    archives = apply_retention()
+    return {'partitions_created': created,
+            'archived': [f'{a.table_name}:{a.partition_name or a.period_end}' for a in archives]}
+
+
+def start_log_maintenance_scheduler(interval_seconds: int) -> threading.Thread:
+    """Run partition upkeep and retention now and then every interval_seconds"""
+    def run():
+        while True:
+            try:
+                print(f"Log maintenance finished: {run_log_maintenance()}")
+            except Exception as e:
+                print(f"Error during log maintenance: {e}")
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=run, name='log-maintenance', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    print(run_log_maintenance())
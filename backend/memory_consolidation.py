@@ -0,0 +1,297 @@
+from sqlalchemy import and_
+from shared.models import Memory, MemoryArchive, MemorySignature, Setting, Session
+from backend.memory_manager import commit_memory_changes
+from datetime import datetime, timedelta
+import re
+import json
+import zlib
+import hashlib
+import random
+import threading
+import time
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+# MinHash / LSH parameters: 64 hashes in 16 bands of 4 rows catches pairs with
+# a Jaccard similarity of roughly 0.5 and above as candidates
+NUM_HASHES = 64
+LSH_BANDS = 16
+SHINGLE_SIZE = 4
+SIMILARITY_THRESHOLD = 0.6
+
+# Importance decay: memories older than DECAY_AFTER_DAYS lose one point of
+# importance for every DECAY_INTERVAL_DAYS that pass
+DECAY_AFTER_DAYS = 30
+DECAY_INTERVAL_DAYS = 30
+
+# Archival: stale, low-importance memories from these sources move to the cold table
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_MAX_IMPORTANCE = 0
+ARCHIVE_SOURCES = ('ai_suggested',)
+
+# Document chunks are owned by their document and never merged or archived here
+CONSOLIDATION_SOURCES = ('manual', 'ai_suggested')
+
+LAST_DECAY_SETTING = 'memory_last_decay'
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(1337)
+_HASH_PARAMS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                for _ in range(NUM_HASHES)]
+
+
+def _shingles(text: str) -> Set[int]:
+    """Character shingles of the normalised text, hashed to stable integers"""
+    normalised = re.sub(r'\s+', ' ', re.sub(r'[^\w\s]', '', text.lower())).strip()
+    if len(normalised) <= SHINGLE_SIZE:
+        return {zlib.crc32(normalised.encode('utf-8'))}
+    return {zlib.crc32(normalised[i:i+SHINGLE_SIZE].encode('utf-8'))
+            for i in range(len(normalised) - SHINGLE_SIZE + 1)}
+
+
+def _minhash(shingles: Set[int]) -> List[int]:
+    """MinHash signature of a shingle set"""
+    return [min((a * s + b) % _MERSENNE_PRIME for s in shingles) for a, b in _HASH_PARAMS]
+
+
+def _estimated_similarity(sig_a: List[int], sig_b: List[int]) -> float:
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / NUM_HASHES
+
+
+def cluster_near_duplicates(memories: List[Memory], threshold: float = SIMILARITY_THRESHOLD,
+                            signatures: Optional[List[List[int]]] = None) -> List[List[Memory]]:
+    """Group memories whose estimated Jaccard similarity passes the threshold"""
+    if signatures is None:
+        signatures = [_minhash(_shingles(m.content)) for m in memories]
+    parent = list(range(len(memories)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows = NUM_HASHES // LSH_BANDS
+    for band in range(LSH_BANDS):
+        buckets: Dict[tuple, List[int]] = {}
+        for i, sig in enumerate(signatures):
+            buckets.setdefault(tuple(sig[band*rows:(band+1)*rows]), []).append(i)
+        for candidates in buckets.values():
+            first = candidates[0]
+            for other in candidates[1:]:
+                if find(first) != find(other) and \
+                        _estimated_similarity(signatures[first], signatures[other]) >= threshold:
+                    parent[find(other)] = find(first)
+
+    clusters: Dict[int, List[Memory]] = {}
+    for i, memory in enumerate(memories):
+        clusters.setdefault(find(i), []).append(memory)
+    return list(clusters.values())
+
+
+def _archive(session, memory: Memory, reason: str, merged_into: Optional[int] = None):
+    session.add(MemoryArchive(
+        original_id=memory.id,
+        user_id=memory.user_id,
+        memory_type=memory.memory_type,
+        content=memory.content,
+        timestamp=memory.timestamp,
+        source=memory.source,
+        importance=memory.importance,
+        tags=memory.tags,
+        approved=memory.approved,
+        reason=reason,
+        merged_into=merged_into
+    ))
+    session.delete(memory)
+
+
+def _content_hash(memory: Memory) -> str:
+    return hashlib.sha1(memory.content.encode('utf-8')).hexdigest()
+
+
+def _load_signatures(session, memories: List[Memory]) -> Tuple[Dict[int, List[int]], int]:
+    """
+    MinHash signatures for a user's memories, reusing the stored ones and
+    computing (and storing) only those of new or edited memories. Also
+    returns how many memories had to be hashed or changed approval state.
+    """
+    stored = {row.memory_id: row for row in session.query(MemorySignature).filter(
+        MemorySignature.memory_id.in_([m.id for m in memories]))} if memories else {}
+    signatures = {}
+    changed = 0
+    for memory in memories:
+        digest = _content_hash(memory)
+        row = stored.get(memory.id)
+        if row is not None and row.content_hash == digest:
+            signatures[memory.id] = [int(value, 16) for value in row.signature.split(',')]
+            if row.approved != bool(memory.approved):
+                row.approved = bool(memory.approved)
+                changed += 1
+            continue
+        signature = _minhash(_shingles(memory.content))
+        signatures[memory.id] = signature
+        if row is None:
+            row = MemorySignature(memory_id=memory.id)
+            session.add(row)
+        row.content_hash = digest
+        row.approved = bool(memory.approved)
+        row.signature = ','.join(format(value, 'x') for value in signature)
+        changed += 1
+    # Store them before any merge deletes a memory (which cascades to its signature)
+    session.flush()
+    return signatures, changed
+
+
+def _consolidate_user(session, user_id: str, threshold: float) -> Tuple[int, int]:
+    """
+    Merge one user's near-duplicate memories; returns (rows merged away,
+    memories hashed or re-reviewed). Users with nothing new since the last
+    pass are skipped, as that pass already merged everything it could.
+    Approved memories and pending suggestions are clustered separately, so
+    an unreviewed suggestion never changes approved content.
+    """
+    memories = session.query(Memory).filter(
+        and_(Memory.user_id == user_id, Memory.source.in_(CONSOLIDATION_SOURCES))
+    ).all()
+    signatures, changed = _load_signatures(session, memories)
+    if not changed:
+        return 0, 0
+
+    merged = 0
+    for approved in (True, False):
+        group = [m for m in memories if bool(m.approved) == approved]
+        for cluster in cluster_near_duplicates(group, threshold, [signatures[m.id] for m in group]):
+            if len(cluster) > 1:
+                merged += _merge_cluster(session, cluster)
+    return merged, changed
+
+
+def _merge_cluster(session, cluster: List[Memory]) -> int:
+    """Fold a cluster into its best member and archive the rest; returns rows merged away"""
+    # Clusters are all approved or all pending; prefer the most important, then the most detailed
+    cluster.sort(key=lambda m: (m.importance or 0, len(m.content),
+                                m.timestamp or datetime.min), reverse=True)
+    keeper, duplicates = cluster[0], cluster[1:]
+
+    tags = []
+    for memory in cluster:
+        for tag in json.loads(memory.tags) if memory.tags else []:
+            if tag not in tags:
+                tags.append(tag)
+
+    keeper.importance = max(m.importance or 0 for m in cluster)
+    keeper.timestamp = max(m.timestamp or datetime.min for m in cluster)
+    keeper.tags = json.dumps(tags) if tags else None
+
+    for memory in duplicates:
+        _archive(session, memory, 'merged', merged_into=keeper.id)
+    return len(duplicates)
+
+
+def _apply_decay(session, now: datetime) -> Set[str]:
+    """Apply any importance decay steps that are due since the last run; returns affected users"""
+    setting = session.query(Setting).filter_by(key=LAST_DECAY_SETTING).first()
+    if not setting:
+        session.add(Setting(key=LAST_DECAY_SETTING, value=now.isoformat()))
+        return set()
+
+    last_decay = datetime.fromisoformat(setting.value)
+    interval = timedelta(days=DECAY_INTERVAL_DAYS)
+    steps = int((now - last_decay) / interval)
+    if steps <= 0:
+        return set()
+
+    decayed = set()
+    cutoff = now - timedelta(days=DECAY_AFTER_DAYS)
+    memories = session.query(Memory).filter(
+        and_(Memory.timestamp < cutoff, Memory.importance > 0,
+             Memory.source.in_(CONSOLIDATION_SOURCES))
+    ).all()
+    for memory in memories:
+        memory.importance = max(0, memory.importance - steps)
+        decayed.add(memory.user_id)
+
+    # Advance by whole steps only so partial intervals carry over to the next run
+    setting.value = (last_decay + steps * interval).isoformat()
+    return decayed
+
+
+def consolidate_memories(user_id: Optional[str] = None,
+                         threshold: float = SIMILARITY_THRESHOLD) -> Dict[str, Any]:
+    """
+    Run one consolidation pass: merge near-duplicate memories per user,
+    decay importance of old memories and archive stale low-importance rows.
+    Users are merged one at a time, each in its own transaction, and only
+    users with new, edited or newly reviewed memories are clustered again.
+    Decay runs on a single global schedule, so a pass limited to one user
+    only merges and archives; decay waits for the next all-user pass.
+    """
+    now = datetime.utcnow()
+    stats = {'users': 0, 'hashed': 0, 'merged': 0, 'decayed_users': 0, 'archived': 0}
+
+    if user_id:
+        user_ids = [user_id]
+    else:
+        session = Session()
+        try:
+            user_ids = [uid for (uid,) in session.query(Memory.user_id).filter(
+                Memory.source.in_(CONSOLIDATION_SOURCES)).distinct()]
+        finally:
+            session.close()
+
+    for uid in user_ids:
+        session = Session()
+        try:
+            merged, changed = _consolidate_user(session, uid, threshold)
+            stats['users'] += 1
+            stats['hashed'] += changed
+            stats['merged'] += merged
+            commit_memory_changes(session, [uid] if merged else [])
+        finally:
+            session.close()
+
+    touched_users: Set[str] = set()
+    session = Session()
+    try:
+        if not user_id:
+            decayed_users = _apply_decay(session, now)
+            stats['decayed_users'] = len(decayed_users)
+            touched_users |= decayed_users
+            session.flush()
+
+        stale_query = session.query(Memory).filter(
+            and_(Memory.timestamp < now - timedelta(days=ARCHIVE_AFTER_DAYS),
+                 Memory.importance <= ARCHIVE_MAX_IMPORTANCE,
+                 Memory.source.in_(ARCHIVE_SOURCES))
+        )
+        if user_id:
+            stale_query = stale_query.filter(Memory.user_id == user_id)
+        for memory in stale_query.all():
+            touched_users.add(memory.user_id)
+            _archive(session, memory, 'stale')
+            stats['archived'] += 1
+
+        commit_memory_changes(session, touched_users)
+        return stats
+    finally:
+        session.close()
+
+
+def start_consolidation_scheduler(interval_seconds: int) -> threading.Thread:
+    """Run consolidate_memories every interval_seconds in a daemon thread"""
+    def run():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                stats = consolidate_memories()
+                print(f"Memory consolidation finished: {stats}")
+            except Exception as e:
+                print(f"Error during memory consolidation: {e}")
+
+    thread = threading.Thread(target=run, name='memory-consolidation', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    print(consolidate_memories())
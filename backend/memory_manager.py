@@ -1,13 +1,238 @@
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine, and_, or_, func
-from shared.models import Memory, Setting
+from sqlalchemy import and_, text, column, Integer
+from sqlalchemy.pool import NullPool
+from shared.models import (Memory, DocumentChunk, DATABASE_URL, engine, Session, create_database_engine,
+                           has_memory_search_index, MEMORY_FTS_TABLE)
+from backend.metrics import register_collector
+from backend.read_replica import read_router
+from backend.write_queue import write_queue
+from collections import OrderedDict
 import os
 import json
-from typing import List, Dict, Any, Optional
+import time
+import select
+import threading
+from typing import List, Dict, Any, Optional, Iterable, Tuple
 
-DATABASE_URL = os.getenv('DATABASE_URL', 'postgresql://luma:lumapass@db:5432/luma')
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+MEMORY_CACHE_SIZE = int(os.getenv('MEMORY_CACHE_SIZE', '1024'))  # Cached (user, limit) entries
+MEMORY_CACHE_TTL = float(os.getenv('MEMORY_CACHE_TTL', '300'))  # Seconds before an entry expires
+INVALIDATION_CHANNEL = 'luma_memory_cache'
+# On SQLite, seconds between checks for memory changes made by other processes
+MEMORY_CACHE_POLL_INTERVAL = float(os.getenv('MEMORY_CACHE_POLL_INTERVAL', '1'))
+VERSION_COUNTER_KEY = '*'
+
+
+class MemoryCache:
+    """LRU + TTL cache of relevant memories per user"""
+
+    def __init__(self, capacity: int = MEMORY_CACHE_SIZE, ttl: float = MEMORY_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (user_id, limit) -> (expires_at, memories)
+        # Bumped by invalidate(), so a query that raced an invalidation isn't cached
+        self._generation = 0
+        self._user_generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, user_id: str, limit: int) -> Optional[List[Memory]]:
+        key = (user_id, limit)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def generation(self, user_id: str) -> Tuple[int, int]:
+        """Read before loading a user's memories and pass to put()"""
+        with self._lock:
+            return self._generation, self._user_generations.get(user_id, 0)
+
+    def put(self, user_id: str, limit: int, memories: List[Memory],
+            generation: Optional[Tuple[int, int]] = None):
+        """Cache memories, unless the user was invalidated since generation was read"""
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            if generation is not None and \
+                    generation != (self._generation, self._user_generations.get(user_id, 0)):
+                return
+            self._entries[(user_id, limit)] = (time.monotonic() + self.ttl, list(memories))
+            self._entries.move_to_end((user_id, limit))
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Drop every cached entry for a user, or everything when user_id is None"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._generation += 1
+                self._user_generations.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == user_id]:
+                    del self._entries[key]
+                self._user_generations[user_id] = self._user_generations.get(user_id, 0) + 1
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'capacity': self.capacity,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
+
+
+memory_cache = MemoryCache()
+
+
+def _cache_metrics() -> List[str]:
+    stats = memory_cache.stats()
+    lines = []
+    for name, kind in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'),
+                       ('invalidations', 'counter'), ('size', 'gauge'), ('hit_rate', 'gauge')):
+        metric = f'luma_memory_cache_{name}' + ('_total' if kind == 'counter' else '')
+        lines.append(f'# TYPE {metric} {kind}')
+        lines.append(f'{metric} {stats[name]}')
+    return lines
+
+
+register_collector(_cache_metrics)
+_listener_started = False
+_listener_lock = threading.Lock()
+
+
+def _listen_for_invalidations():
+    """Apply cache invalidations published by other processes (Postgres)"""
+    # A connection of its own, outside the pool: LISTEN needs autocommit, which must
+    # never leak into connections the sessions check out
+    listen_engine = create_database_engine(DATABASE_URL, poolclass=NullPool)
+    while True:
+        try:
+            raw = listen_engine.raw_connection()
+            try:
+                connection = raw.driver_connection
+                connection.set_isolation_level(0)  # Autocommit, required for LISTEN
+                cursor = connection.cursor()
+                cursor.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+                # Anything may have changed while we were not listening
+                memory_cache.invalidate()
+                while True:
+                    if select.select([connection], [], [], 30) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        payload = connection.notifies.pop(0).payload
+                        memory_cache.invalidate(payload or None)
+            finally:
+                raw.close()
+        except Exception as e:
+            print(f"Memory cache invalidation listener error: {e}")
+            memory_cache.invalidate()
+            time.sleep(5)
+
+
+def _poll_for_invalidations():
+    """
+    Apply cache invalidations made by other processes (SQLite). Writers are
+    serialised there, so versions commit in order and everything above the
+    highest version seen so far is new.
+    """
+    seen = None
+    while True:
+        try:
+            with engine.connect() as connection:
+                if seen is None:
+                    seen = connection.execute(text(
+                        "SELECT COALESCE(MAX(version), 0) FROM memory_cache_versions")).scalar()
+                    # Anything may have changed while we were not polling
+                    memory_cache.invalidate()
+                rows = connection.execute(text(
+                    "SELECT user_id, version FROM memory_cache_versions WHERE version > :seen"
+                ), {'seen': seen}).fetchall()
+            for user_id, version in rows:
+                if user_id != VERSION_COUNTER_KEY:
+                    memory_cache.invalidate(user_id)
+                seen = max(seen, version)
+        except Exception as e:
+            print(f"Memory cache invalidation poller error: {e}")
+            memory_cache.invalidate()
+            seen = None
+        time.sleep(MEMORY_CACHE_POLL_INTERVAL)
+
+
+def _ensure_invalidation_listener():
+    global _listener_started
+    if _listener_started or engine.dialect.name not in ('postgresql', 'sqlite'):
+        return
+    with _listener_lock:
+        if not _listener_started:
+            _listener_started = True
+            target = _listen_for_invalidations if engine.dialect.name == 'postgresql' else _poll_for_invalidations
+            threading.Thread(target=target, name='memory-cache-listener', daemon=True).start()
+
+
+def _bump_cache_versions(session, user_ids: Iterable[str]):
+    """Give each user a new change version in the session's transaction (SQLite)"""
+    session.execute(text(
+        "INSERT INTO memory_cache_versions (user_id, version) VALUES (:key, 1) "
+        "ON CONFLICT (user_id) DO UPDATE SET version = memory_cache_versions.version + 1"
+    ), {'key': VERSION_COUNTER_KEY})
+    version = session.execute(text("SELECT version FROM memory_cache_versions WHERE user_id = :key"),
+                              {'key': VERSION_COUNTER_KEY}).scalar()
+    for user_id in user_ids:
+        session.execute(text(
+            "INSERT INTO memory_cache_versions (user_id, version) VALUES (:user_id, :version) "
+            "ON CONFLICT (user_id) DO UPDATE SET version = excluded.version"
+        ), {'user_id': user_id, 'version': version})
+
+
+def commit_memory_changes(session, user_ids: Iterable[str]):
+    """
+    Commit a session that changed memories and invalidate the affected users'
+    cache entries, both locally and in every other process sharing the database.
+    """
+    user_ids = set(user_ids)
+    if engine.dialect.name == 'postgresql':
+        # NOTIFY is transactional, so other processes only hear about committed changes
+        for user_id in user_ids:
+            session.execute(text("SELECT pg_notify(:channel, :user_id)"),
+                            {'channel': INVALIDATION_CHANNEL, 'user_id': user_id})
+    elif engine.dialect.name == 'sqlite' and user_ids:
+        _bump_cache_versions(session, user_ids)
+    session.commit()
+    for user_id in user_ids:
+        memory_cache.invalidate(user_id)
+
+
+_has_search_index = None
+
+
+def _memory_search_index() -> bool:
+    global _has_search_index
+    if _has_search_index is None:
+        _has_search_index = has_memory_search_index(engine)
+    return _has_search_index
 
 
 class MemoryManager:
@@ -15,10 +240,10 @@ class MemoryManager:
     
     @staticmethod
     def get_memories(user_id: Optional[str] = None, approved: Optional[bool] = True, 
-                     source: Optional[str] = None, limit: Optional[int] = None) -> List[Memory]:
-        """Get memories with optional filters"""
-        session = Session()
-        try:
+                     source: Optional[str] = None, limit: Optional[int] = None,
+                     replica: bool = False) -> List[Memory]:
+        """Get memories with optional filters; replica=True allows reading from the read replica"""
+        def read(session) -> List[Memory]:
             query = session.query(Memory)
             
             if user_id:
@@ -34,6 +259,12 @@ class MemoryManager:
                 query = query.limit(limit)
                 
             return query.all()
+
+        if replica:
+            return read_router.run(read)
+        session = Session()
+        try:
+            return read(session)
         finally:
             session.close()
     
@@ -45,8 +276,14 @@ class MemoryManager:
         try:
             query = session.query(Memory)
             
-            # Search in content field
-            query = query.filter(Memory.content.ilike(f'%{query_text}%'))
+            # Search in content field, through the trigram index in embedded SQLite mode
+            if _memory_search_index():
+                query = query.filter(Memory.id.in_(
+                    text(f"SELECT rowid FROM {MEMORY_FTS_TABLE} WHERE content LIKE :pattern")
+                    .bindparams(pattern=f'%{query_text}%').columns(column('rowid', Integer))
+                ))
+            else:
+                query = query.filter(Memory.content.ilike(f'%{query_text}%'))
             
             if user_id:
                 query = query.filter(Memory.user_id == user_id)
@@ -64,6 +301,12 @@ class MemoryManager:
                    source: str = 'manual', importance: int = 0, 
                    tags: Optional[List[str]] = None, approved: bool = True) -> Memory:
         """Add a new memory"""
+        return write_queue.submit(MemoryManager._insert_memory, user_id, content, memory_type,
+                                  source, importance, tags, approved)
+
+    @staticmethod
+    def _insert_memory(user_id: str, content: str, memory_type: str, source: str,
+                       importance: int, tags: Optional[List[str]], approved: bool) -> Memory:
         session = Session()
         try:
             new_memory = Memory(
@@ -77,7 +320,7 @@ class MemoryManager:
             )
             
             session.add(new_memory)
-            session.commit()
+            commit_memory_changes(session, [user_id])
             
             return new_memory
         finally:
@@ -105,7 +348,7 @@ class MemoryManager:
             if approved is not None:
                 memory.approved = approved
                 
-            session.commit()
+            commit_memory_changes(session, [memory.user_id])
             return True
         finally:
             session.close()
@@ -119,8 +362,12 @@ class MemoryManager:
             if not memory:
                 return False
                 
+            # Detach the memory from its document, if it was an uploaded chunk
+            session.query(DocumentChunk).filter(DocumentChunk.memory_id == memory_id).delete(
+                synchronize_session=False
+            )
             session.delete(memory)
-            session.commit()
+            commit_memory_changes(session, [memory.user_id])
             return True
         finally:
             session.close()
@@ -138,7 +385,7 @@ class MemoryManager:
                 return False
                 
             memory.approved = True
-            session.commit()
+            commit_memory_changes(session, [memory.user_id])
             return True
         finally:
             session.close()
@@ -146,6 +393,12 @@ class MemoryManager:
     @staticmethod
     def get_relevant_memories(user_id: str, context_limit: int = 5) -> List[Memory]:
         """Get the most relevant memories for a user based on importance and recency"""
+        _ensure_invalidation_listener()
+        cached = memory_cache.get(user_id, context_limit)
+        if cached is not None:
+            return cached
+
+        generation = memory_cache.generation(user_id)
         session = Session()
         try:
             # Get approved memories for the user, ordered by importance and timestamp
@@ -159,10 +412,16 @@ class MemoryManager:
                 Memory.timestamp.desc()
             ).limit(context_limit).all()
             
+            memory_cache.put(user_id, context_limit, memories, generation)
             return memories
         finally:
             session.close()
     
+    @staticmethod
+    def get_cache_stats() -> Dict[str, Any]:
+        """Get hit/miss counters for the relevant-memory cache"""
+        return memory_cache.stats()
+    
     @staticmethod
     def add_memory_suggestion(user_id: str, content: str, importance: int = 0,
                               tags: Optional[List[str]] = None) -> Memory:
@@ -0,0 +1,369 @@
+from sqlalchemy import event
+from shared.models import engine
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import asyncio
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple, Callable
+
+# Bucket bounds in seconds, tuned for anything from a settings lookup to a slow LLM call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+RECENT_TRACES = 500  # Completed request traces kept for the dashboard panel
+TRACE_SQL_LIMIT = 200  # Statements kept per trace while slow-request capture is on
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: Tuple[Tuple[str, str], ...], extra: Optional[Dict[str, str]] = None) -> str:
+    pairs = list(key) + sorted((extra or {}).items())
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels"""
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series: Dict[Tuple, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                self._series[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series['counts']):
+                    lines.append(f'{self.name}_bucket{_format_labels(key, {"le": str(bound)})} {count}')
+                lines.append(f'{self.name}_bucket{_format_labels(key, {"le": "+Inf"})} {series["count"]}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {series["sum"]}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {series["count"]}')
+        return lines
+
+
+REQUEST_LATENCY = Histogram('luma_request_duration_seconds',
+                            'End-to-end duration of a request or chat turn')
+STAGE_LATENCY = Histogram('luma_stage_duration_seconds',
+                          'Duration of individual stages within a request')
+LLM_LATENCY = Histogram('luma_llm_duration_seconds',
+                        'LLM call duration per provider and task')
+LLM_TOKENS_PER_SECOND = Histogram('luma_llm_tokens_per_second',
+                                  'Output tokens per second per provider', TOKEN_RATE_BUCKETS)
+LLM_TOKENS = Counter('luma_llm_tokens_total', 'Tokens processed per provider and direction')
+LLM_ERRORS = Counter('luma_llm_errors_total', 'Failed LLM calls per provider and task')
+LLM_PROMPT_EVAL = Histogram('luma_llm_prompt_eval_seconds',
+                            'Time the model spent evaluating the prompt, as reported by the provider')
+LLM_LOAD = Histogram('luma_llm_model_load_seconds',
+                     'Time spent loading the model before a call, as reported by the provider')
+LLM_COLD_STARTS = Counter('luma_llm_cold_starts_total', 'Calls that had to load the model first')
+LLM_PROMPT_CACHE = Counter('luma_llm_prompt_cache_tokens_total',
+                           'Prompt tokens served from (hit) or missing (miss) the provider prompt cache')
+DB_QUERIES = Counter('luma_db_queries_total', 'SQL statements executed')
+DB_QUERIES_PER_REQUEST = Histogram('luma_db_queries_per_request',
+                                   'SQL statements executed per request', QUERY_COUNT_BUCKETS)
+
+REGISTRY = [REQUEST_LATENCY, STAGE_LATENCY, LLM_LATENCY, LLM_TOKENS_PER_SECOND,
+            LLM_TOKENS, LLM_ERRORS, LLM_PROMPT_EVAL, LLM_LOAD, LLM_COLD_STARTS, LLM_PROMPT_CACHE,
+            DB_QUERIES, DB_QUERIES_PER_REQUEST]
+_collectors: List[Callable[[], List[str]]] = []
+
+_current_trace: ContextVar[Optional[Dict[str, Any]]] = ContextVar('luma_trace', default=None)
+_recent_traces = deque(maxlen=RECENT_TRACES)
+_recent_lock = threading.Lock()
+# Finished-trace callbacks; while any are registered, traces also collect SQL and stack samples
+_trace_listeners: List[Callable[[Dict[str, Any]], None]] = []
+# Thread id -> the trace that thread is currently working on, for stack sampling
+_thread_traces: Dict[int, Dict[str, Any]] = {}
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def begin_trace(name: str, component: str):
+    """Start collecting stage timings and query counts for a request; returns a token for end_trace"""
+    trace = {'name': name, 'component': component, 'stages': {}, 'db_queries': 0,
+             'started_at': time.time(), 'start': time.perf_counter()}
+    if _trace_listeners:
+        trace['sql'] = []
+        trace['samples'] = {}
+    if not _in_event_loop():
+        # An event loop thread serves many requests at once, so only its worker threads are sampled
+        _thread_traces[threading.get_ident()] = trace
+    return _current_trace.set(trace)
+
+
+def end_trace(token) -> Optional[Dict[str, Any]]:
+    """Finish the trace started by begin_trace and record it"""
+    trace = _current_trace.get()
+    _current_trace.reset(token)
+    if trace is None:
+        return None
+    if _thread_traces.get(threading.get_ident()) is trace:
+        del _thread_traces[threading.get_ident()]
+    trace['duration'] = time.perf_counter() - trace.pop('start')
+    REQUEST_LATENCY.observe(trace['duration'], name=trace['name'], component=trace['component'])
+    DB_QUERIES_PER_REQUEST.observe(trace['db_queries'], name=trace['name'],
+                                   component=trace['component'])
+    for listener in _trace_listeners:
+        try:
+            listener(trace)
+        except Exception as e:
+            print(f"Error in trace listener: {e}")
+    trace.pop('sql', None)
+    trace.pop('samples', None)
+    with _recent_lock:
+        _recent_traces.append(trace)
+    return trace
+
+
+def register_trace_listener(listener: Callable[[Dict[str, Any]], None]):
+    """Call listener with every finished trace; traces then also collect SQL and stack samples"""
+    _trace_listeners.append(listener)
+
+
+def active_thread_traces() -> Dict[int, Dict[str, Any]]:
+    """Threads currently working on a traced request, for the stack sampler"""
+    return dict(_thread_traces)
+
+
+@contextmanager
+def trace_request(name: str, component: str):
+    """Time a whole request or chat turn and collect its stage timings and query count"""
+    token = begin_trace(name, component)
+    try:
+        yield _current_trace.get()
+    finally:
+        end_trace(token)
+
+
+@contextmanager
+def span(stage: str):
+    """Time one stage of the current request"""
+    start = time.perf_counter()
+    # Stages may run in worker threads (asyncio.to_thread, thread pools); attribute those to the trace too
+    thread_id = threading.get_ident()
+    trace = _current_trace.get()
+    adopted = trace is not None and thread_id not in _thread_traces and not _in_event_loop()
+    if adopted:
+        _thread_traces[thread_id] = trace
+    try:
+        yield
+    finally:
+        if adopted:
+            _thread_traces.pop(thread_id, None)
+        elapsed = time.perf_counter() - start
+        component = trace['component'] if trace else 'none'
+        STAGE_LATENCY.observe(elapsed, stage=stage, component=component)
+        if trace is not None:
+            trace['stages'][stage] = trace['stages'].get(stage, 0.0) + elapsed
+
+
+def record_llm_call(provider: str, task: str, duration: float,
+                    input_tokens: int = 0, output_tokens: int = 0):
+    """Record latency, token counts and generation rate of one LLM call"""
+    LLM_LATENCY.observe(duration, provider=provider, task=task)
+    LLM_TOKENS.inc(input_tokens, provider=provider, direction='input')
+    LLM_TOKENS.inc(output_tokens, provider=provider, direction='output')
+    if duration > 0 and output_tokens:
+        LLM_TOKENS_PER_SECOND.observe(output_tokens / duration, provider=provider)
+
+
+def record_llm_timings(provider: str, task: str, prompt_eval_seconds: Optional[float] = None,
+                       load_seconds: Optional[float] = None, cold_start: bool = False):
+    """Record provider-reported prompt evaluation and model load times for one call"""
+    if prompt_eval_seconds is not None:
+        LLM_PROMPT_EVAL.observe(prompt_eval_seconds, provider=provider, task=task)
+    if load_seconds is not None:
+        LLM_LOAD.observe(load_seconds, provider=provider, task=task)
+    if cold_start:
+        LLM_COLD_STARTS.inc(provider=provider, task=task)
+
+
+def record_prompt_cache(provider: str, hit_tokens: int, miss_tokens: int):
+    LLM_PROMPT_CACHE.inc(hit_tokens, provider=provider, result='hit')
+    LLM_PROMPT_CACHE.inc(miss_tokens, provider=provider, result='miss')
+
+
+def record_llm_error(provider: str, task: str):
+    LLM_ERRORS.inc(provider=provider, task=task)
+
+
+def instrument_engine(engine):
+    """Count every statement an engine executes, globally and for the current request"""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERIES.inc()
+        trace = _current_trace.get()
+        if trace is not None:
+            trace['db_queries'] += 1
+            # Kept on the execution context, which is discarded if the statement fails
+            if trace.get('sql') is not None and context is not None:
+                context.luma_query_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _capture_query(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, 'luma_query_start', None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        trace = _current_trace.get()
+        if trace is not None and trace.get('sql') is not None and len(trace['sql']) < TRACE_SQL_LIMIT:
+            trace['sql'].append({'statement': statement, 'ms': round(elapsed * 1000, 3)})
+    return engine
+
+
+# The engine every module shares; extra engines (the read replica) are instrumented where they are made
+instrument_engine(engine)
+
+
+def register_collector(collector: Callable[[], List[str]]):
+    """Add a callable that returns extra exposition lines, e.g. gauges read from another module"""
+    _collectors.append(collector)
+
+
+def render_prometheus() -> str:
+    """Render every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(name: Optional[str] = None) -> Dict[str, Any]:
+    """Per-stage p50/p95/mean over recent traces, for the dashboard latency panel"""
+    with _recent_lock:
+        traces = [t for t in _recent_traces if name is None or t['name'] == name]
+
+    samples: Dict[str, List[float]] = {}
+    for trace in traces:
+        samples.setdefault('total', []).append(trace['duration'])
+        for stage, elapsed in trace['stages'].items():
+            samples.setdefault(stage, []).append(elapsed)
+
+    stages = []
+    for stage, values in samples.items():
+        stages.append({
+            'stage': stage,
+            'count': len(values),
+            'mean_ms': 1000 * sum(values) / len(values),
+            'p50_ms': 1000 * _percentile(values, 0.5),
+            'p95_ms': 1000 * _percentile(values, 0.95)
+        })
+    stages.sort(key=lambda s: (s['stage'] != 'total', -s['mean_ms']))
+
+    queries = [trace['db_queries'] for trace in traces]
+    return {
+        'traces': len(traces),
+        'stages': stages,
+        'db_queries_mean': sum(queries) / len(queries) if queries else 0,
+        'db_queries_p95': _percentile(queries, 0.95) if queries else 0
+    }
+
+
+# (path prefix, handler) pairs served next to /metrics; a handler takes
+# (method, path, params, headers) and returns (status, content type, body, download filename)
+_http_handlers: List[Tuple[str, Callable]] = []
+
+
+def register_http_handler(prefix: str, handler: Callable):
+    """Serve extra paths from the metrics server, e.g. the bot's profiling endpoints"""
+    _http_handlers.append((prefix, handler))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def _send(self, status: int, content_type: str, body: bytes, filename: Optional[str] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if filename:
+            self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method: str):
+        path, _, query = self.path.partition('?')
+        for prefix, handler in _http_handlers:
+            if path == prefix or path.startswith(prefix + '/'):
+                params = {key: values[-1] for key, values in parse_qs(query).items()}
+                self._send(*handler(method, path, params, self.headers))
+                return
+        if method == 'GET' and path == '/metrics':
+            self._send(200, 'text/plain; version=0.0.4; charset=utf-8', render_prometheus().encode('utf-8'))
+            return
+        self._send(404, 'text/plain', b'not found')
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """Serve /metrics from a background thread, for processes without a web server"""
+    server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,165 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import threading
+import time
+import requests
+from typing import List, Dict, Any, Optional
+
+OLLAMA_MODELS_TTL = float(os.getenv('OLLAMA_MODELS_TTL', '60'))  # Seconds a model list stays fresh
+OLLAMA_PROBE_TIMEOUT = float(os.getenv('OLLAMA_PROBE_TIMEOUT', '3'))
+# Endpoint used when no ollama_endpoint setting has been saved
+DEFAULT_OLLAMA_ENDPOINT = 'http://localhost:11434'
+
+# Fallbacks tried alongside the configured endpoint
+DEFAULT_CANDIDATES = [
+    "http://ollama:11434",  # Default internal docker name
+    "http://host.docker.internal:11434"  # For Docker Desktop
+]
+
+
+def _normalise(endpoint: str) -> str:
+    endpoint = endpoint.strip().rstrip('/')
+    if endpoint.endswith('/api/tags'):
+        endpoint = endpoint[:-len('/api/tags')]
+    return endpoint
+
+
+def _human_size(size: Optional[int]) -> Optional[str]:
+    if not size:
+        return None
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+class OllamaModelDiscovery:
+    """Finds a reachable Ollama endpoint and caches its model list"""
+
+    def __init__(self, ttl: float = OLLAMA_MODELS_TTL, timeout: float = OLLAMA_PROBE_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self._cache: Dict[str, Dict[str, Any]] = {}  # configured endpoint -> discovery result
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='ollama-probe')
+
+    def candidates(self, endpoint: str) -> List[str]:
+        seen = []
+        for candidate in [endpoint] + DEFAULT_CANDIDATES:
+            candidate = _normalise(candidate) if candidate else ''
+            if candidate and candidate not in seen:
+                seen.append(candidate)
+        return seen
+
+    def _probe(self, base_url: str) -> Dict[str, Any]:
+        response = requests.get(f"{base_url}/api/tags", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def discover(self, endpoint: str) -> Dict[str, Any]:
+        """
+        Probe the configured endpoint, which is the one OllamaInterface talks
+        to. Only if it fails are the fallbacks probed, all at once, taking the
+        first that answers; result['endpoint'] says which one the list is from.
+        """
+        result = {'endpoint': None, 'models': [], 'fetched_at': time.time(), 'error': None}
+        candidates = self.candidates(endpoint)
+        configured = _normalise(endpoint) if endpoint else None
+        if configured:
+            try:
+                return self._found(result, configured, self._probe(configured))
+            except Exception:
+                candidates = [c for c in candidates if c != configured]
+
+        futures = {self._pool.submit(self._probe, c): c for c in candidates}
+        try:
+            for future in as_completed(futures, timeout=self.timeout + 1):
+                try:
+                    data = future.result()
+                except Exception:
+                    continue
+                self._found(result, futures[future], data)
+                break
+            else:
+                result['error'] = f"Could not connect to Ollama at {endpoint}"
+        except Exception:
+            result['error'] = f"Timed out connecting to Ollama at {endpoint}"
+        finally:
+            for future in futures:
+                future.cancel()
+        if result['error']:
+            print(result['error'])
+        return result
+
+    def _found(self, result: Dict[str, Any], endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        result['endpoint'] = endpoint
+        result['models'] = [self._model_info(m) for m in data.get('models', [])]
+        return result
+
+    @staticmethod
+    def _model_info(model: Dict[str, Any]) -> Dict[str, Any]:
+        details = model.get('details') or {}
+        return {
+            'name': model.get('name'),
+            'size': model.get('size'),
+            'size_human': _human_size(model.get('size')),
+            'parameter_size': details.get('parameter_size'),
+            'quantization': details.get('quantization_level'),
+            'family': details.get('family'),
+            'modified_at': model.get('modified_at')
+        }
+
+    def _refresh(self, endpoint: str) -> Dict[str, Any]:
+        result = self.discover(endpoint)
+        with self._lock:
+            # Keep the last good list if the endpoint is only briefly unreachable
+            previous = self._cache.get(endpoint)
+            if result['error'] and previous and previous['models']:
+                previous['error'] = result['error']
+                previous['fetched_at'] = result['fetched_at']
+                result = previous
+            else:
+                self._cache[endpoint] = result
+            self._refreshing.discard(endpoint)
+        return result
+
+    def refresh_in_background(self, endpoint: str):
+        with self._lock:
+            if endpoint in self._refreshing:
+                return
+            self._refreshing.add(endpoint)
+        threading.Thread(target=self._refresh, args=(endpoint,),
+                         name='ollama-discovery', daemon=True).start()
+
+    def get_cached(self, endpoint: str) -> Optional[Dict[str, Any]]:
+        """Return whatever is cached without probing, scheduling a refresh when stale"""
+        with self._lock:
+            cached = self._cache.get(endpoint)
+        if cached is None or time.time() - cached['fetched_at'] > self.ttl:
+            self.refresh_in_background(endpoint)
+        return cached
+
+    def get_models(self, endpoint: str, force_refresh: bool = False) -> Dict[str, Any]:
+        """
+        Get the model list for an endpoint. Fresh cache entries are returned
+        as-is, stale ones are returned immediately while a background refresh
+        runs, and only a cold cache (or force_refresh) blocks on probing.
+        """
+        with self._lock:
+            cached = self._cache.get(endpoint)
+            blocking = force_refresh or cached is None
+            if blocking:
+                self._refreshing.add(endpoint)
+
+        if blocking:
+            result = self._refresh(endpoint)
+            return dict(result, cached=False, age=0.0)
+
+        if time.time() - cached['fetched_at'] > self.ttl:
+            self.refresh_in_background(endpoint)
+        return dict(cached, cached=True, age=time.time() - cached['fetched_at'])
+
+
+ollama_discovery = OllamaModelDiscovery()
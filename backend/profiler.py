@@ -0,0 +1,315 @@
+from backend.metrics import (register_trace_listener, active_thread_traces, register_http_handler,
+                             register_collector)
+from collections import deque
+import hmac
+import itertools
+import json
+import marshal
+import os
+import sys
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+# Shared secret for the /admin/profiling endpoints, sent as an X-Profiling-Token header (never in
+# the URL, where request logs would record it); empty disables them
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+# Requests and chat turns slower than this (ms) keep their stack samples and SQL; 0 turns capture off
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '0'))
+# Seconds between stack samples for on-demand profiles and for slow-request capture
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+SLOW_REQUEST_SAMPLE_INTERVAL = float(os.getenv('SLOW_REQUEST_SAMPLE_INTERVAL', '0.02'))
+PROFILE_HISTORY = int(os.getenv('PROFILE_HISTORY', '20'))  # Finished profiles kept for download
+PROFILE_MAX_SECONDS = 300
+PROFILING_PATH = '/admin/profiling'
+
+Frame = Tuple[str, int, str]  # (filename, first line, function), the pstats function key
+THREAD_FILE = '<thread>'  # Root pseudo-frame naming the thread a stack was sampled from
+
+
+def _stack(frame, thread_name: str) -> Tuple[Frame, ...]:
+    """A frame's call stack, outermost call first, under a pseudo-frame for its thread"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+    stack.append((THREAD_FILE, 0, thread_name))
+    stack.reverse()
+    return tuple(stack)
+
+
+def _thread_names() -> Dict[int, str]:
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+class Profile:
+    """Wall-clock stack samples from an on-demand profile or a slow request"""
+
+    def __init__(self, kind: str, name: str, interval: float):
+        self.id = next(_profile_ids)
+        self.kind = kind  # 'sampling' or 'slow_request'
+        self.name = name
+        self.interval = interval
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.samples: Dict[Tuple[Frame, ...], int] = {}
+        self.sql: List[Dict[str, Any]] = []
+        self.stages: Dict[str, float] = {}
+        self.running = False
+
+    def summary(self) -> Dict[str, Any]:
+        return {'id': self.id, 'kind': self.kind, 'name': self.name, 'started_at': self.started_at,
+                'duration_ms': round(self.duration * 1000, 1), 'samples': sum(dict(self.samples).values()),
+                'sql_statements': len(self.sql), 'running': self.running}
+
+    def details(self, top: int = 25) -> Dict[str, Any]:
+        """Summary plus stage timings, captured SQL and the functions with the most self time"""
+        stats = self.function_stats()
+        hottest = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+        return dict(self.summary(),
+                    stages_ms={stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()},
+                    sql=self.sql,
+                    top_functions=[{'function': name, 'location': f'{filename}:{line}',
+                                    'self_ms': round(tt * 1000, 1), 'total_ms': round(ct * 1000, 1)}
+                                   for (filename, line, name), (_, _, tt, ct, _) in hottest])
+
+    def function_stats(self) -> Dict[Frame, tuple]:
+        """Samples folded into the pstats layout: func -> (cc, nc, tt, ct, callers)"""
+        stats: Dict[Frame, list] = {}
+        for stack, count in dict(self.samples).items():
+            frames = [frame for frame in stack if frame[0] != THREAD_FILE]
+            weight = count * self.interval
+            seen = set()
+            for i, func in enumerate(frames):
+                entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+                leaf = i == len(frames) - 1
+                first = func not in seen  # Count recursive frames once towards inclusive time
+                seen.add(func)
+                entry[0] += count if first else 0
+                entry[1] += count
+                entry[2] += weight if leaf else 0.0
+                entry[3] += weight if first else 0.0
+                if i > 0:
+                    caller = entry[4].setdefault(frames[i - 1], [0, 0, 0.0, 0.0])
+                    caller[0] += count
+                    caller[1] += count
+                    caller[2] += weight if leaf else 0.0
+                    caller[3] += weight if first else 0.0
+        return {func: (cc, nc, tt, ct, {caller: tuple(values) for caller, values in callers.items()})
+                for func, (cc, nc, tt, ct, callers) in stats.items()}
+
+    def to_pstats(self) -> bytes:
+        """Marshalled stats, loadable with pstats.Stats(path) or snakeviz"""
+        return marshal.dumps(self.function_stats())
+
+    def to_speedscope(self) -> bytes:
+        """A speedscope.app file with one sampled profile per thread"""
+        frames: List[Dict[str, Any]] = []
+        frame_index: Dict[Frame, int] = {}
+        threads: Dict[str, Dict[str, list]] = {}
+        for stack, count in sorted(self.samples.items()):
+            thread = threads.setdefault(stack[0][2], {'samples': [], 'weights': []})
+            indexes = []
+            for func in stack[1:]:
+                if func not in frame_index:
+                    frame_index[func] = len(frames)
+                    frames.append({'name': func[2], 'file': func[0], 'line': func[1]})
+                indexes.append(frame_index[func])
+            thread['samples'].append(indexes)
+            thread['weights'].append(count * self.interval)
+
+        profiles = [{'type': 'sampled', 'name': name, 'unit': 'seconds', 'startValue': 0,
+                     'endValue': sum(data['weights']), 'samples': data['samples'], 'weights': data['weights']}
+                    for name, data in sorted(threads.items())]
+        return json.dumps({
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': f'{self.kind} {self.name}',
+            'exporter': 'luma',
+            'shared': {'frames': frames},
+            'profiles': profiles
+        }).encode('utf-8')
+
+
+_profile_ids = itertools.count(1)
+_profiles = deque(maxlen=PROFILE_HISTORY)
+_profiles_lock = threading.Lock()
+
+
+def _store(profile: Profile):
+    with _profiles_lock:
+        _profiles.append(profile)
+
+
+def get_profile(profile_id: int) -> Optional[Profile]:
+    with _profiles_lock:
+        return next((p for p in _profiles if p.id == profile_id), None)
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    with _profiles_lock:
+        return [p.summary() for p in reversed(_profiles)]
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread in the process for a fixed time, one run at a time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.current: Optional[Profile] = None
+
+    def start(self, seconds: float, interval: float = PROFILE_SAMPLE_INTERVAL) -> Profile:
+        with self._lock:
+            if self.current is not None and self.current.running:
+                raise RuntimeError(f"Profile {self.current.id} is still running")
+            profile = Profile('sampling', f'{seconds:g}s', interval)
+            profile.running = True
+            self.current = profile
+            self._stop.clear()
+        _store(profile)
+        threading.Thread(target=self._run, args=(profile, seconds), name='profiler', daemon=True).start()
+        return profile
+
+    def stop(self) -> Optional[Profile]:
+        """End the running profile early"""
+        self._stop.set()
+        return self.current
+
+    def _run(self, profile: Profile, seconds: float):
+        own_id = threading.get_ident()
+        start = time.perf_counter()
+        deadline = start + seconds
+        try:
+            while time.perf_counter() < deadline and not self._stop.is_set():
+                names = _thread_names()
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    stack = _stack(frame, names.get(thread_id, str(thread_id)))
+                    profile.samples[stack] = profile.samples.get(stack, 0) + 1
+                self._stop.wait(profile.interval)
+        finally:
+            profile.duration = time.perf_counter() - start
+            profile.running = False
+
+
+sampling_profiler = SamplingProfiler()
+_slow_requests_captured = 0
+_slow_capture_started = False
+
+
+def _sample_active_requests(interval: float):
+    """Add a stack sample to every in-flight trace, so a slow one can be kept with its samples"""
+    own_id = threading.get_ident()
+    while True:
+        time.sleep(interval)
+        traces = active_thread_traces()
+        if not traces:
+            continue
+        frames = sys._current_frames()
+        names = _thread_names()
+        for thread_id, trace in traces.items():
+            frame = frames.get(thread_id)
+            samples = trace.get('samples')
+            if frame is None or samples is None or thread_id == own_id:
+                continue
+            stack = _stack(frame, names.get(thread_id, str(thread_id)))
+            samples[stack] = samples.get(stack, 0) + 1
+
+
+def _capture_slow_request(trace: Dict[str, Any]):
+    global _slow_requests_captured
+    if trace['duration'] * 1000 < SLOW_REQUEST_MS:
+        return
+    profile = Profile('slow_request', f"{trace['component']}:{trace['name']}", SLOW_REQUEST_SAMPLE_INTERVAL)
+    profile.started_at = trace['started_at']
+    profile.duration = trace['duration']
+    profile.samples = dict(trace.get('samples') or {})
+    profile.sql = list(trace.get('sql') or [])
+    profile.stages = dict(trace['stages'])
+    _store(profile)
+    _slow_requests_captured += 1
+
+
+def start_slow_request_capture(threshold_ms: float = SLOW_REQUEST_MS) -> bool:
+    """Keep stack samples and SQL of requests slower than threshold_ms; False if capture is off"""
+    global SLOW_REQUEST_MS, _slow_capture_started
+    if threshold_ms <= 0:
+        return False
+    SLOW_REQUEST_MS = threshold_ms
+    if not _slow_capture_started:
+        _slow_capture_started = True
+        register_trace_listener(_capture_slow_request)
+        threading.Thread(target=_sample_active_requests, args=(SLOW_REQUEST_SAMPLE_INTERVAL,),
+                         name='slow-request-sampler', daemon=True).start()
+    return True
+
+
+def _json(status: int, body: Dict[str, Any]) -> Tuple[int, str, bytes, Optional[str]]:
+    return status, 'application/json', json.dumps(body).encode('utf-8'), None
+
+
+def handle_profiling_request(method: str, path: str, params: Dict[str, str],
+                             headers) -> Tuple[int, str, bytes, Optional[str]]:
+    """
+    Serve the profiling endpoints for both the webapp and the bot's metrics server.
+    Returns (status, content type, body, download filename).
+
+      GET  /admin/profiling                        running profile, recent profiles
+      POST /admin/profiling/start?seconds=N        sample every thread for N seconds
+      POST /admin/profiling/stop                   end the running profile early
+      GET  /admin/profiling/<id>                   stages, SQL and hottest functions
+      GET  /admin/profiling/<id>.speedscope.json   download for speedscope.app
+      GET  /admin/profiling/<id>.pstats            download for pstats/snakeviz
+    """
+    if not PROFILING_TOKEN:
+        return _json(404, {'error': 'Profiling is disabled; set PROFILING_TOKEN to enable it'})
+    token = headers.get('X-Profiling-Token') or ''
+    if not hmac.compare_digest(token.encode('utf-8'), PROFILING_TOKEN.encode('utf-8')):
+        return _json(403, {'error': 'Invalid profiling token'})
+
+    action = path[len(PROFILING_PATH):].strip('/')
+    if action == '' and method == 'GET':
+        running = sampling_profiler.current
+        return _json(200, {'running': running.summary() if running and running.running else None,
+                           'slow_request_ms': SLOW_REQUEST_MS if _slow_capture_started else 0,
+                           'profiles': list_profiles()})
+    if action == 'start' and method == 'POST':
+        try:
+            seconds = min(max(float(params.get('seconds', 10)), 0.1), PROFILE_MAX_SECONDS)
+            interval = max(float(params.get('interval', PROFILE_SAMPLE_INTERVAL)), 0.001)
+        except ValueError:
+            return _json(400, {'error': 'seconds and interval must be numbers'})
+        try:
+            profile = sampling_profiler.start(seconds, interval)
+        except RuntimeError as e:
+            return _json(409, {'error': str(e)})
+        return _json(202, profile.summary())
+    if action == 'stop' and method == 'POST':
+        profile = sampling_profiler.stop()
+        return _json(200, profile.summary() if profile else {})
+
+    profile_id, _, extension = action.partition('.')
+    profile = get_profile(int(profile_id)) if profile_id.isdigit() and method == 'GET' else None
+    if profile is None:
+        return _json(404, {'error': 'Profile not found'})
+    if extension == '':
+        return _json(200, profile.details())
+    if profile.running:
+        return _json(409, {'error': f'Profile {profile.id} is still running'})
+    if extension == 'speedscope.json':
+        return (200, 'application/json', profile.to_speedscope(),
+                f'luma-{profile.kind}-{profile.id}.speedscope.json')
+    if extension == 'pstats':
+        return 200, 'application/octet-stream', profile.to_pstats(), f'luma-{profile.kind}-{profile.id}.pstats'
+    return _json(404, {'error': 'Unknown format; use .speedscope.json or .pstats'})
+
+
+def _profiler_metrics() -> List[str]:
+    return ['# TYPE luma_slow_requests_captured_total counter',
+            f'luma_slow_requests_captured_total {_slow_requests_captured}']
+
+
+register_collector(_profiler_metrics)
+register_http_handler(PROFILING_PATH, handle_profiling_request)
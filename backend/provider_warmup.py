@@ -0,0 +1,93 @@
+from backend.llm_interface import load_settings, provider_from_settings, PROVIDER_SETTING_KEYS, LLM_TASKS
+from backend.chat_service import DEFAULT_PERSONALITY
+import os
+import threading
+import time
+from typing import Dict, Any, Optional
+
+# Seconds between keep-alive pings to the configured local model; 0 disables them.
+# Keep this shorter than OLLAMA_KEEP_ALIVE so the model never unloads between pings.
+MODEL_PING_INTERVAL = int(os.getenv('MODEL_PING_INTERVAL', '240'))
+
+_last_warm_up: Dict[str, Any] = {}
+_lock = threading.Lock()
+
+
+def warm_up_current_provider() -> Optional[Dict[str, Any]]:
+    """
+    Load the configured model and prime its prompt cache with the personality,
+    the stable start of every system prompt. Models routed to other tasks are
+    loaded too, without a prompt. Returns the chat provider's timings, or None
+    for providers with nothing to warm up.
+    """
+    settings = load_settings(PROVIDER_SETTING_KEYS + ['personality'])
+    try:
+        provider = provider_from_settings(settings)
+    except ValueError:
+        return None  # No provider configured yet
+    _warm_up_task_providers(settings, provider)
+    personality = settings.get('personality') or DEFAULT_PERSONALITY
+    try:
+        timings = provider.warm_up(personality)
+    except Exception as e:
+        print(f"Error warming up model: {e}")
+        with _lock:
+            _last_warm_up.update({'error': str(e), 'at': time.time()})
+        return None
+    if timings is not None:
+        with _lock:
+            _last_warm_up.clear()
+            _last_warm_up.update(timings, model=getattr(provider, 'model', None), at=time.time())
+        if timings['cold_start']:
+            print(f"Loaded model {getattr(provider, 'model', '')} in {timings['load_seconds']:.1f}s")
+    return timings
+
+
+def _warm_up_task_providers(settings: Dict[str, str], chat_provider):
+    """Keep the extraction and summarization models loaded when they differ from the chat model"""
+    warmed = {id(chat_provider)}
+    for task in LLM_TASKS:
+        try:
+            provider = provider_from_settings(settings, task)
+        except ValueError:
+            continue
+        if id(provider) in warmed:
+            continue
+        warmed.add(id(provider))
+        try:
+            provider.warm_up()
+        except Exception as e:
+            print(f"Error warming up {task} model: {e}")
+
+
+def warm_up_in_background():
+    """Warm up without blocking, e.g. right after the model is changed in settings"""
+    def run():
+        try:
+            warm_up_current_provider()
+        except Exception as e:
+            print(f"Error warming up model: {e}")
+    threading.Thread(target=run, name='model-warmup', daemon=True).start()
+
+
+def start_model_keepalive(interval_seconds: int = MODEL_PING_INTERVAL) -> threading.Thread:
+    """Warm up now, then ping the model every interval_seconds so it stays loaded"""
+    def run():
+        while True:
+            try:
+                warm_up_current_provider()
+            except Exception as e:
+                print(f"Error pinging model: {e}")
+            if interval_seconds <= 0:
+                return
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=run, name='model-keepalive', daemon=True)
+    thread.start()
+    return thread
+
+
+def get_warm_up_status() -> Dict[str, Any]:
+    """The most recent warm-up or ping result, for the dashboard"""
+    with _lock:
+        return dict(_last_warm_up)
@@ -0,0 +1,286 @@
+from sqlalchemy import and_, case
+from sqlalchemy.exc import IntegrityError
+from shared.models import Setting, DailyTokenUsage, RateLimitBucket, Session
+from backend.metrics import register_collector
+from datetime import datetime, timedelta
+import os
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+# Chat turns allowed per minute and burst size, per user and per channel
+USER_RATE_PER_MINUTE = float(os.getenv('USER_RATE_PER_MINUTE', '6'))
+USER_RATE_BURST = float(os.getenv('USER_RATE_BURST', '3'))
+CHANNEL_RATE_PER_MINUTE = float(os.getenv('CHANNEL_RATE_PER_MINUTE', '30'))
+CHANNEL_RATE_BURST = float(os.getenv('CHANNEL_RATE_BURST', '10'))
+# 'local' keeps buckets in process memory, 'db' shares them between processes;
+# defaults to 'db' when the bot runs as several replicas
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND') or (
+    'db' if int(os.getenv('BOT_REPLICAS', '1')) > 1 else 'local')
+# Daily token limits, overridable from the settings page; 0 means unlimited
+DEFAULT_USER_DAILY_QUOTA = int(os.getenv('USER_DAILY_TOKEN_QUOTA', '0'))
+DEFAULT_DAILY_TOKEN_BUDGET = int(os.getenv('DAILY_TOKEN_BUDGET', '0'))
+SLEEPY_THRESHOLD = 0.8  # Fraction of the global budget at which Luma gets sleepy
+SLEEPY_MAX_TOKENS = 80  # Reply length cap while sleepy
+QUOTA_CACHE_TTL = 5  # Seconds quota settings are reused between checks; usage is always read fresh
+
+MODE_AWAKE = 'awake'
+MODE_SLEEPY = 'sleepy'
+MODE_ASLEEP = 'asleep'
+
+SLEEPY_NOTICE = "\n\n*Luma is getting sleepy... today's token budget is almost used up.*"
+
+
+def _today() -> str:
+    return datetime.utcnow().strftime('%Y-%m-%d')
+
+
+def seconds_until_reset() -> int:
+    """Seconds until the daily quotas reset at midnight UTC"""
+    now = datetime.utcnow()
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int((tomorrow - now).total_seconds()) + 1
+
+
+class LocalBuckets:
+    """In-process token buckets"""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def acquire(self, limits: List[Tuple[str, float, float]]) -> float:
+        """
+        Take one token from every (key, rate_per_second, burst) bucket, or none
+        of them. Returns 0 on success, otherwise seconds until a retry can succeed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            retry_after = 0.0
+            for key, rate, burst in limits:
+                tokens, updated = self._buckets.get(key, (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                levels.append((key, tokens))
+                if tokens < 1:
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+            if retry_after:
+                return retry_after
+            for key, tokens in levels:
+                self._buckets[key] = (tokens - 1, now)
+            return 0.0
+
+
+class DatabaseBuckets:
+    """Token buckets in the database, shared by every bot and webapp process"""
+
+    @staticmethod
+    def _level(rate: float, burst: float, now: float):
+        """SQL expression for a bucket's tokens after refilling up to now"""
+        elapsed = case((RateLimitBucket.updated_at < now, now - RateLimitBucket.updated_at), else_=0.0)
+        refilled = RateLimitBucket.tokens + elapsed * rate
+        return case((refilled > burst, burst), else_=refilled)
+
+    @staticmethod
+    def _create_missing(session, limits: List[Tuple[str, float, float]], now: float):
+        existing = {key for (key,) in session.query(RateLimitBucket.key).filter(
+            RateLimitBucket.key.in_([key for key, _, _ in limits]))}
+        for key, rate, burst in limits:
+            if key in existing:
+                continue
+            session.add(RateLimitBucket(key=key, tokens=burst, updated_at=now))
+            try:
+                session.commit()
+            except IntegrityError:
+                # Another process created the same bucket first
+                session.rollback()
+        session.commit()
+
+    def acquire(self, limits: List[Tuple[str, float, float]]) -> float:
+        now = time.time()
+        session = Session()
+        try:
+            self._create_missing(session, limits, now)
+            # Each bucket is refilled and debited by one conditional UPDATE, so the
+            # database checks the token against the current row: SELECT ... FOR UPDATE
+            # is a no-op on SQLite and let concurrent turns spend the same token.
+            # Keys go in a fixed order so concurrent turns cannot deadlock.
+            for key, rate, burst in sorted(limits):
+                level = self._level(rate, burst, now)
+                updated = session.query(RateLimitBucket).filter(
+                    RateLimitBucket.key == key, level >= 1
+                ).update({'tokens': level - 1, 'updated_at': now}, synchronize_session=False)
+                if not updated:
+                    # All or nothing: undo the buckets already debited
+                    session.rollback()
+                    return self._retry_after(session, limits, now)
+            session.commit()
+            return 0.0
+        finally:
+            session.close()
+
+    @staticmethod
+    def _retry_after(session, limits: List[Tuple[str, float, float]], now: float) -> float:
+        rows = {row.key: row for row in session.query(RateLimitBucket).filter(
+            RateLimitBucket.key.in_([key for key, _, _ in limits]))}
+        retry_after = 0.0
+        for key, rate, burst in limits:
+            row = rows.get(key)
+            if row is None:
+                continue
+            tokens = min(burst, row.tokens + max(0.0, now - row.updated_at) * rate)
+            if tokens < 1:
+                retry_after = max(retry_after, (1 - tokens) / rate)
+        # A token may have been refilled since the update missed; retry shortly
+        return retry_after or 1.0
+
+
+class AdmissionController:
+    """Rate limits and daily token quotas checked before any LLM call"""
+
+    def __init__(self, backend: str = RATE_LIMIT_BACKEND):
+        self.buckets = DatabaseBuckets() if backend == 'db' else LocalBuckets()
+        self._cache: Dict[str, Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {}
+
+    def _cached(self, key: str, loader) -> int:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+        value = loader()
+        with self._lock:
+            self._cache[key] = (now + QUOTA_CACHE_TTL, value)
+        return value
+
+    def _setting_int(self, key: str, default: int) -> int:
+        def load():
+            session = Session()
+            try:
+                setting = session.query(Setting).filter_by(key=key).first()
+                return int(setting.value) if setting and setting.value.strip() else default
+            except ValueError:
+                return default
+            finally:
+                session.close()
+        return self._cached(f'setting:{key}', load)
+
+    @staticmethod
+    def _usage(scope: str) -> int:
+        # Not cached: a burst of turns would all pass on a stale total
+        session = Session()
+        try:
+            row = session.query(DailyTokenUsage).filter(
+                and_(DailyTokenUsage.day == _today(), DailyTokenUsage.scope == scope)
+            ).first()
+            return row.total_tokens if row else 0
+        finally:
+            session.close()
+
+    def budget_status(self) -> Dict[str, Any]:
+        """Today's global usage against the daily budget and the resulting mode"""
+        budget = self._setting_int('daily_token_budget', DEFAULT_DAILY_TOKEN_BUDGET)
+        used = self._usage('global')
+        ratio = used / budget if budget else 0.0
+        if budget and ratio >= 1:
+            mode = MODE_ASLEEP
+        elif budget and ratio >= SLEEPY_THRESHOLD:
+            mode = MODE_SLEEPY
+        else:
+            mode = MODE_AWAKE
+        return {'mode': mode, 'used': used, 'budget': budget, 'ratio': ratio}
+
+    def _reject(self, reason: str, retry_after: float, mode: str, message: str) -> Dict[str, Any]:
+        with self._lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return {'allowed': False, 'reason': reason, 'retry_after': max(1, int(retry_after + 0.999)),
+                'mode': mode, 'message': message, 'max_tokens': 0, 'allow_suggestions': False}
+
+    def check(self, user_id: str, channel_id: Optional[str] = None,
+              max_tokens: int = 150, rate_limited: bool = True) -> Dict[str, Any]:
+        """
+        Decide whether a chat turn may go ahead. Rejections are cheap and
+        carry a retry_after in seconds; admitted turns may be degraded
+        (shorter replies, no memory extraction) when the budget runs low.
+        With rate_limited=False the budget and quota still apply but no rate
+        token is taken, for messages that join a turn already admitted.
+        """
+        budget = self.budget_status()
+        if budget['mode'] == MODE_ASLEEP:
+            return self._reject('budget', seconds_until_reset(), MODE_ASLEEP,
+                                "Luma is asleep... today's token budget is used up. "
+                                "She'll wake up when it resets at midnight UTC.")
+
+        quota = self._setting_int('user_daily_token_quota', DEFAULT_USER_DAILY_QUOTA)
+        if quota and self._usage(f'user:{user_id}') >= quota:
+            return self._reject('quota', seconds_until_reset(), budget['mode'],
+                                "You've used up your daily token quota. It resets at midnight UTC.")
+
+        limits = [(f'user:{user_id}', USER_RATE_PER_MINUTE / 60, USER_RATE_BURST)]
+        if channel_id:
+            limits.append((f'channel:{channel_id}', CHANNEL_RATE_PER_MINUTE / 60, CHANNEL_RATE_BURST))
+        retry_after = self.buckets.acquire(limits) if rate_limited else 0
+        if retry_after:
+            return self._reject('rate', retry_after, budget['mode'],
+                                f"You're sending messages too quickly. Try again in {int(retry_after + 0.999)}s.")
+
+        with self._lock:
+            self.admitted += 1
+        sleepy = budget['mode'] == MODE_SLEEPY
+        return {
+            'allowed': True,
+            'reason': None,
+            'retry_after': 0,
+            'mode': budget['mode'],
+            'message': None,
+            'max_tokens': min(max_tokens, SLEEPY_MAX_TOKENS) if sleepy else max_tokens,
+            'allow_suggestions': not sleepy
+        }
+
+    def metrics(self) -> List[str]:
+        with self._lock:
+            rejected = dict(self.rejected)
+            admitted = self.admitted
+        lines = ['# TYPE luma_admission_admitted_total counter',
+                 f'luma_admission_admitted_total {admitted}',
+                 '# TYPE luma_admission_rejected_total counter']
+        for reason, count in sorted(rejected.items()):
+            lines.append(f'luma_admission_rejected_total{{reason="{reason}"}} {count}')
+        return lines
+
+
+def record_usage(user_id: str, total_tokens: int):
+    """
+    Add tokens to today's global and per-user rollups used by the quota
+    checks. Every LLM call made for a user (chat replies, memory extraction,
+    summarization) must be recorded here, or it spends budget unseen.
+    """
+    day = _today()
+    session = Session()
+    try:
+        for scope in ('global', f'user:{user_id}'):
+            for attempt in range(2):
+                updated = session.query(DailyTokenUsage).filter(
+                    and_(DailyTokenUsage.day == day, DailyTokenUsage.scope == scope)
+                ).update({'total_tokens': DailyTokenUsage.total_tokens + total_tokens,
+                          'requests': DailyTokenUsage.requests + 1},
+                         synchronize_session=False)
+                if updated:
+                    session.commit()
+                    break
+                session.add(DailyTokenUsage(day=day, scope=scope, total_tokens=total_tokens, requests=1))
+                try:
+                    session.commit()
+                    break
+                except IntegrityError:
+                    # Created concurrently by another process; retry as an update
+                    session.rollback()
+    finally:
+        session.close()
+
+
+admission = AdmissionController()
+register_collector(admission.metrics)
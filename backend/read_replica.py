@@ -0,0 +1,226 @@
+from sqlalchemy.orm import sessionmaker, Session as OrmSession
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError, InterfaceError
+from shared.models import create_database_engine, Session
+from backend.metrics import instrument_engine, register_collector
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import List, Dict, Any, Optional, Callable, TypeVar
+
+# Optional hot standby for admin and analytics reads (dashboard, /logs, memory page).
+# Empty sends every read to the primary.
+READ_REPLICA_URL = os.getenv('READ_REPLICA_URL', '')
+# Replication lag (seconds) above which reads go back to the primary
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', '10'))
+# Seconds between replica lag checks, and before retrying a replica that failed
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', '5'))
+# Seconds without any message from the primary after which the standby counts as disconnected.
+# An idle primary still sends a keepalive every wal_sender_timeout / 2 (30s by default).
+REPLICA_MAX_SILENCE = float(os.getenv('REPLICA_MAX_SILENCE', '60'))
+# Cookie holding the Unix time of the browser's last write, for read-your-writes across processes
+LAST_WRITE_COOKIE = 'luma_last_write'
+
+T = TypeVar('T')
+
+# Seconds the standby is behind, or NULL when it is not streaming from the primary (a
+# standby that lost its connection has replayed everything it received, yet may be
+# arbitrarily stale). Zero when connected and fully replayed, since
+# pg_last_xact_replay_timestamp() stops advancing while the primary is idle.
+# pg_stat_wal_receiver only shows status and timings to superusers and members of
+# pg_read_all_stats; other roles see the receiver's pid alone, so for them a running
+# receiver counts as connected and hidden_details reports the weaker check.
+REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver) THEN NULL "
+    "WHEN EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status IS NOT NULL AND (status <> 'streaming' "
+    "OR last_msg_receipt_time <= now() - make_interval(secs => :max_silence))) THEN NULL "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END AS lag, "
+    "EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status IS NULL) AS hidden_details"
+)
+
+# The current client's writes while a request scope is open: {'wrote_at': unix time or None}
+_write_scope: ContextVar[Optional[Dict[str, Any]]] = ContextVar('luma_write_scope', default=None)
+
+
+class ReadRouter:
+    """
+    Sends read-only admin queries to the replica while it is reachable and
+    close enough to the primary, and to the primary otherwise. After a
+    client writes anything, that client's reads stay on the primary until
+    the replica has had time to replay the write, so a page reloaded after
+    a save shows the saved data. Clients are tracked per request scope (a
+    browser, through LAST_WRITE_COOKIE); other clients keep the replica.
+    """
+
+    def __init__(self, replica_url: str = READ_REPLICA_URL, max_lag: float = REPLICA_MAX_LAG,
+                 check_interval: float = REPLICA_CHECK_INTERVAL, max_silence: float = REPLICA_MAX_SILENCE):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.max_silence = max_silence
+        self.replica_engine = None
+        self.ReplicaSession = None
+        if replica_url:
+            self.replica_engine = instrument_engine(create_database_engine(replica_url, pool_pre_ping=True))
+            self.ReplicaSession = sessionmaker(bind=self.replica_engine)
+        self._lag: Optional[float] = None  # None while the replica is unreachable
+        self._checked_at = 0.0
+        self._warned_hidden = False
+        self._lock = threading.Lock()
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.fallbacks = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.replica_engine is not None
+
+    @staticmethod
+    def begin_scope(last_write: Optional[str] = None):
+        """Start tracking one client's writes, seeded from its LAST_WRITE_COOKIE value"""
+        try:
+            wrote_at = float(last_write) if last_write else None
+        except ValueError:
+            wrote_at = None
+        return _write_scope.set({'wrote_at': wrote_at, 'changed': False})
+
+    @staticmethod
+    def end_scope(token):
+        _write_scope.reset(token)
+
+    @staticmethod
+    def scope_write() -> Optional[float]:
+        """Unix time of a write made in the current scope, to hand back to the client; None if none"""
+        scope = _write_scope.get()
+        return scope['wrote_at'] if scope and scope['changed'] else None
+
+    @property
+    def write_window(self) -> int:
+        """Seconds a client's reads stay on the primary after it writes"""
+        return int(self.max_lag + self.check_interval) + 1
+
+    @staticmethod
+    def note_write():
+        """Record that the current client just committed to the primary"""
+        scope = _write_scope.get()
+        if scope is not None:
+            scope['wrote_at'] = time.time()
+            scope['changed'] = True
+
+    def replica_lag(self) -> Optional[float]:
+        """Replication lag in seconds, re-checked at most every check_interval; None if unreachable"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return self._lag
+            self._checked_at = now
+        try:
+            with self.replica_engine.connect() as connection:
+                if self.replica_engine.dialect.name == 'postgresql':
+                    lag, hidden = connection.execute(REPLICA_LAG_SQL, {'max_silence': self.max_silence}).one()
+                    if hidden and not self._warned_hidden:
+                        self._warned_hidden = True
+                        print("Read replica role cannot see pg_stat_wal_receiver details; grant it "
+                              "pg_read_all_stats so a stalled standby is detected")
+                    if lag is None:
+                        print("Read replica is not streaming from the primary, reading from the primary")
+                    else:
+                        lag = float(lag)
+                else:
+                    connection.execute(text('SELECT 1'))
+                    lag = 0.0
+        except Exception as e:
+            print(f"Read replica unavailable, reading from the primary: {e}")
+            lag = None
+        with self._lock:
+            self._lag = lag
+        return lag
+
+    def use_replica(self) -> bool:
+        if not self.enabled:
+            return False
+        lag = self.replica_lag()
+        if lag is None or lag > self.max_lag:
+            return False
+        # The lag may be up to check_interval old, so allow that much extra before
+        # trusting the replica to have this client's latest write
+        scope = _write_scope.get()
+        wrote_at = scope['wrote_at'] if scope else None
+        return wrote_at is None or time.time() - wrote_at > lag + self.check_interval
+
+    def _mark_unavailable(self, error: Exception):
+        print(f"Read replica query failed, retrying on the primary: {error}")
+        with self._lock:
+            self._lag = None
+            self._checked_at = time.monotonic()
+            self.fallbacks += 1
+
+    def run(self, query: Callable[[OrmSession], T]) -> T:
+        """Run query(session) on the replica when it is usable, otherwise on the primary"""
+        if self.use_replica():
+            session = self.ReplicaSession()
+            try:
+                result = query(session)
+                with self._lock:
+                    self.replica_reads += 1
+                return result
+            except (OperationalError, InterfaceError) as e:
+                self._mark_unavailable(e)
+            finally:
+                session.close()
+
+        session = Session()
+        try:
+            result = query(session)
+            with self._lock:
+                self.primary_reads += 1
+            return result
+        finally:
+            session.close()
+
+    def status(self) -> Dict[str, Any]:
+        """Replica state for the dashboard"""
+        if not self.enabled:
+            return {'enabled': False}
+        with self._lock:
+            lag = self._lag
+            replica_reads, primary_reads = self.replica_reads, self.primary_reads
+        return {'enabled': True, 'lag': lag, 'healthy': lag is not None and lag <= self.max_lag,
+                'replica_reads': replica_reads, 'primary_reads': primary_reads}
+
+    def metrics(self) -> List[str]:
+        with self._lock:
+            lag, replica_reads, primary_reads, fallbacks = (self._lag, self.replica_reads,
+                                                            self.primary_reads, self.fallbacks)
+        lines = ['# TYPE luma_db_routed_reads_total counter',
+                 f'luma_db_routed_reads_total{{target="replica"}} {replica_reads}',
+                 f'luma_db_routed_reads_total{{target="primary"}} {primary_reads}',
+                 '# TYPE luma_db_replica_fallbacks_total counter',
+                 f'luma_db_replica_fallbacks_total {fallbacks}']
+        if self.enabled:
+            lines += ['# TYPE luma_db_replica_lag_seconds gauge',
+                      f'luma_db_replica_lag_seconds {lag if lag is not None else "NaN"}']
+        return lines
+
+
+read_router = ReadRouter()
+register_collector(read_router.metrics)
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _flag_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(OrmSession, 'do_orm_execute')
+def _flag_bulk_write(orm_execute_state):
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        orm_execute_state.session.info['wrote'] = True
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _record_write(session):
+    if session.info.pop('wrote', False):
+        read_router.note_write()
@@ -0,0 +1,200 @@
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+from shared.models import BotShardLease, BotShardStatus, Session
+from datetime import datetime, timedelta
+import os
+import socket
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+# Total number of shards across all bot processes; unset lets Discord recommend a count
+SHARD_COUNT = os.getenv('SHARD_COUNT')
+# Explicit shards for this process, e.g. "0,1" or "0-3"; requires SHARD_COUNT
+SHARD_IDS = os.getenv('SHARD_IDS')
+# Number of identical bot replicas (docker-compose scale); each claims a slot in the database
+BOT_REPLICAS = int(os.getenv('BOT_REPLICAS', '1'))
+LEASE_TIMEOUT = 60  # Seconds without a heartbeat before another replica may take a slot
+HEARTBEAT_INTERVAL = 15
+
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def parse_shard_ids(spec: str) -> List[int]:
+    """Parse "0,2,4-7" into [0, 2, 4, 5, 6, 7]"""
+    shard_ids = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            shard_ids.extend(range(int(first), int(last) + 1))
+        else:
+            shard_ids.append(int(part))
+    return sorted(set(shard_ids))
+
+
+class ShardLeases:
+    """Replica slot leases, so identical containers split the shards between them"""
+
+    @staticmethod
+    def claim_slot(replicas: int, wait: bool = True) -> int:
+        """Claim a free or expired slot in [0, replicas), waiting for one if all are held"""
+        while True:
+            for slot in range(replicas):
+                if ShardLeases._try_claim(slot):
+                    return slot
+            if not wait:
+                raise RuntimeError(f"All {replicas} bot replica slots are taken")
+            print(f"All {replicas} bot replica slots are taken, retrying in {HEARTBEAT_INTERVAL}s")
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    @staticmethod
+    def _try_claim(slot: int) -> bool:
+        session = Session()
+        try:
+            now = datetime.utcnow()
+            lease = session.query(BotShardLease).filter(BotShardLease.slot == slot).first()
+            if lease is None:
+                session.add(BotShardLease(slot=slot, owner=PROCESS_ID, heartbeat=now))
+                try:
+                    session.commit()
+                    return True
+                except IntegrityError:
+                    session.rollback()
+                    return False
+
+            if lease.owner != PROCESS_ID and lease.heartbeat > now - timedelta(seconds=LEASE_TIMEOUT):
+                return False
+
+            # Conditional update so two replicas cannot take over the same expired lease
+            taken = session.query(BotShardLease).filter(
+                and_(BotShardLease.slot == slot, BotShardLease.owner == lease.owner,
+                     BotShardLease.heartbeat == lease.heartbeat)
+            ).update({'owner': PROCESS_ID, 'heartbeat': now}, synchronize_session=False)
+            session.commit()
+            return taken == 1
+        finally:
+            session.close()
+
+    @staticmethod
+    def heartbeat(slot: int) -> bool:
+        """Renew our lease; False means another process has taken the slot"""
+        session = Session()
+        try:
+            renewed = session.query(BotShardLease).filter(
+                and_(BotShardLease.slot == slot, BotShardLease.owner == PROCESS_ID)
+            ).update({'heartbeat': datetime.utcnow()}, synchronize_session=False)
+            session.commit()
+            return renewed == 1
+        finally:
+            session.close()
+
+    @staticmethod
+    def release(slot: int):
+        session = Session()
+        try:
+            session.query(BotShardLease).filter(
+                and_(BotShardLease.slot == slot, BotShardLease.owner == PROCESS_ID)
+            ).delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+
+def resolve_shard_assignment() -> Dict[str, Any]:
+    """
+    Work out which shards this process runs, from the environment:
+
+    - SHARD_IDS + SHARD_COUNT: exactly those shards
+    - BOT_REPLICAS > 1 + SHARD_COUNT: claim a replica slot and run every
+      shard where shard_id % BOT_REPLICAS == slot
+    - otherwise: every shard in this process (SHARD_COUNT or Discord's recommendation)
+    """
+    shard_count = int(SHARD_COUNT) if SHARD_COUNT else None
+
+    if SHARD_IDS:
+        if not shard_count:
+            raise ValueError("SHARD_IDS requires SHARD_COUNT")
+        shard_ids = parse_shard_ids(SHARD_IDS)
+        if any(shard_id >= shard_count for shard_id in shard_ids):
+            raise ValueError(f"SHARD_IDS {SHARD_IDS} out of range for SHARD_COUNT {shard_count}")
+        return {'shard_count': shard_count, 'shard_ids': shard_ids, 'slot': None}
+
+    if BOT_REPLICAS > 1:
+        if not shard_count or shard_count < BOT_REPLICAS:
+            raise ValueError("BOT_REPLICAS > 1 requires SHARD_COUNT >= BOT_REPLICAS")
+        slot = ShardLeases.claim_slot(BOT_REPLICAS)
+        shard_ids = [s for s in range(shard_count) if s % BOT_REPLICAS == slot]
+        return {'shard_count': shard_count, 'shard_ids': shard_ids, 'slot': slot}
+
+    return {'shard_count': shard_count, 'shard_ids': None, 'slot': None}
+
+
+class ShardMonitor:
+    """Per-shard connection status, gateway latency and guild counts for this process"""
+
+    def __init__(self):
+        self._shards: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def update(self, shard_id: int, status: Optional[str] = None,
+               latency: Optional[float] = None, guild_count: Optional[int] = None):
+        with self._lock:
+            shard = self._shards.setdefault(shard_id, {'status': 'connecting', 'latency': None,
+                                                       'guild_count': 0, 'events': 0})
+            if status is not None:
+                shard['status'] = status
+                shard['events'] += 1
+            if latency is not None and latency == latency:  # Skip NaN before first heartbeat
+                shard['latency'] = latency
+            if guild_count is not None:
+                shard['guild_count'] = guild_count
+            shard['updated_at'] = datetime.utcnow()
+
+    def snapshot(self) -> Dict[int, Dict[str, Any]]:
+        with self._lock:
+            return {shard_id: dict(shard) for shard_id, shard in self._shards.items()}
+
+    def persist(self):
+        """Write this process' shard status rows so the dashboard can show every shard"""
+        session = Session()
+        try:
+            for shard_id, shard in self.snapshot().items():
+                row = session.query(BotShardStatus).filter(BotShardStatus.shard_id == shard_id).first()
+                if row is None:
+                    row = BotShardStatus(shard_id=shard_id)
+                    session.add(row)
+                row.owner = PROCESS_ID
+                row.status = shard['status']
+                row.latency_ms = int(shard['latency'] * 1000) if shard['latency'] is not None else None
+                row.guild_count = shard['guild_count']
+                row.updated_at = shard['updated_at']
+            session.commit()
+        finally:
+            session.close()
+
+    def metrics(self) -> List[str]:
+        lines = ['# TYPE luma_bot_shard_up gauge',
+                 '# TYPE luma_bot_shard_latency_seconds gauge',
+                 '# TYPE luma_bot_shard_guilds gauge']
+        for shard_id, shard in sorted(self.snapshot().items()):
+            up = 1 if shard['status'] in ('ready', 'resumed') else 0
+            lines.append(f'luma_bot_shard_up{{shard="{shard_id}"}} {up}')
+            if shard['latency'] is not None:
+                lines.append(f'luma_bot_shard_latency_seconds{{shard="{shard_id}"}} {shard["latency"]}')
+            lines.append(f'luma_bot_shard_guilds{{shard="{shard_id}"}} {shard["guild_count"]}')
+        return lines
+
+
+shard_monitor = ShardMonitor()
+
+
+def get_shard_statuses() -> List[BotShardStatus]:
+    """Shard status rows reported by all bot processes"""
+    session = Session()
+    try:
+        return session.query(BotShardStatus).order_by(BotShardStatus.shard_id).all()
+    finally:
+        session.close()
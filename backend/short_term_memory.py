@@ -0,0 +1,76 @@
+from sqlalchemy import and_
+from shared.models import ShortTermMessage, ConversationSummary, Session
+from backend.write_queue import write_queue
+import os
+from typing import List, Dict, Any
+
+# Hard cap on raw messages kept per conversation. The rolling summarizer normally
+# folds older turns into a summary long before this is reached.
+SHORT_MEMORY_LIMIT = int(os.getenv('SHORT_MEMORY_LIMIT', '40'))
+
+
+def _conversation(user_id: str, channel_id: str):
+    return and_(ShortTermMessage.user_id == user_id, ShortTermMessage.channel_id == channel_id)
+
+
+class ShortTermMemory:
+    """Recent conversation history per user and channel, stored in the database so every bot process sees it"""
+
+    @staticmethod
+    def get_history(user_id: str, channel_id: str = '', limit: int = SHORT_MEMORY_LIMIT) -> List[Dict[str, str]]:
+        """Get the conversation's most recent messages, oldest first"""
+        return [{'role': m['role'], 'content': m['content']}
+                for m in ShortTermMemory.get_messages(user_id, channel_id, limit)]
+
+    @staticmethod
+    def get_messages(user_id: str, channel_id: str = '', limit: int = SHORT_MEMORY_LIMIT) -> List[Dict[str, Any]]:
+        """Like get_history, but including row ids so callers can remove specific messages"""
+        session = Session()
+        try:
+            rows = session.query(ShortTermMessage).filter(
+                _conversation(user_id, channel_id)
+            ).order_by(ShortTermMessage.id.desc()).limit(limit).all()
+            return [{'id': row.id, 'role': row.role, 'content': row.content} for row in reversed(rows)]
+        finally:
+            session.close()
+
+    @staticmethod
+    def append(user_id: str, messages: List[Dict[str, str]], channel_id: str = '',
+               limit: int = SHORT_MEMORY_LIMIT):
+        """Append messages and trim the conversation to the newest `limit` entries"""
+        write_queue.submit(ShortTermMemory._append, user_id, messages, channel_id, limit)
+
+    @staticmethod
+    def _append(user_id: str, messages: List[Dict[str, str]], channel_id: str, limit: int):
+        session = Session()
+        try:
+            for message in messages:
+                session.add(ShortTermMessage(user_id=user_id, channel_id=channel_id,
+                                             role=message['role'], content=message['content']))
+            session.flush()
+
+            cutoff = session.query(ShortTermMessage.id).filter(
+                _conversation(user_id, channel_id)
+            ).order_by(ShortTermMessage.id.desc()).offset(limit).first()
+            if cutoff:
+                session.query(ShortTermMessage).filter(
+                    and_(_conversation(user_id, channel_id), ShortTermMessage.id <= cutoff[0])
+                ).delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    @staticmethod
+    def clear(user_id: str):
+        """Forget all of a user's recent messages and conversation summaries"""
+        session = Session()
+        try:
+            session.query(ShortTermMessage).filter(
+                ShortTermMessage.user_id == user_id
+            ).delete(synchronize_session=False)
+            session.query(ConversationSummary).filter(
+                ConversationSummary.user_id == user_id
+            ).delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
@@ -0,0 +1,85 @@
+from shared.models import DATABASE_URL, is_sqlite_url
+from backend.metrics import register_collector
+from concurrent.futures import ThreadPoolExecutor, Future
+import contextvars
+import os
+import threading
+from typing import List, Any, Callable
+
+# 'auto' queues hot-path writes on SQLite, which allows one writer at a time; 'on'/'off' force it
+DB_WRITE_QUEUE = os.getenv('DB_WRITE_QUEUE', 'auto')
+
+
+class WriteQueue:
+    """
+    Runs this process's hot-path inserts (chat logs, token usage, memories,
+    conversation history) one at a time on a single writer thread. With
+    SQLite only one connection can write at once, so request threads that
+    each tried to write would queue on the file lock and retry; funnelling
+    them through one thread keeps the lock uncontended. Writes whose result
+    nobody needs (logging) don't hold up the caller at all.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer',
+                                        initializer=self._mark_writer) if enabled else None
+        self._writer = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, fn: Callable, *args, wait: bool = True, **kwargs) -> Any:
+        """
+        Run fn on the writer thread. With wait=True, block and return its result
+        (or raise its exception); otherwise return straight away. Without the
+        queue, fn simply runs in the calling thread.
+        """
+        # Writes made by a queued write run inline; waiting on the queue from its own thread would deadlock
+        if not self.enabled or threading.get_ident() == self._writer:
+            return fn(*args, **kwargs)
+        with self._lock:
+            self.pending += 1
+        # Keep the caller's context so the write's queries count towards its request trace
+        future = self._pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        future.add_done_callback(self._finished)
+        if wait:
+            return future.result()
+        future.add_done_callback(self._report_error)
+        return None
+
+    def _mark_writer(self):
+        self._writer = threading.get_ident()
+
+    def _finished(self, future: Future):
+        with self._lock:
+            self.pending -= 1
+            if future.exception() is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    @staticmethod
+    def _report_error(future: Future):
+        # Nobody waits on these, so errors would otherwise go unnoticed
+        if future.exception() is not None:
+            print(f"Error in queued database write: {future.exception()}")
+
+    def flush(self):
+        """Wait until every write queued so far has run"""
+        if self.enabled:
+            self._pool.submit(lambda: None).result()
+
+    def metrics(self) -> List[str]:
+        with self._lock:
+            pending, completed, failed = self.pending, self.completed, self.failed
+        return ['# TYPE luma_db_write_queue_pending gauge',
+                f'luma_db_write_queue_pending {pending}',
+                '# TYPE luma_db_queued_writes_total counter',
+                f'luma_db_queued_writes_total{{result="ok"}} {completed}',
+                f'luma_db_queued_writes_total{{result="error"}} {failed}']
+
+
+write_queue = WriteQueue(DB_WRITE_QUEUE == 'on' or (DB_WRITE_QUEUE == 'auto' and is_sqlite_url(DATABASE_URL)))
+register_collector(write_queue.metrics)
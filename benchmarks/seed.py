@@ -0,0 +1,123 @@
+"""
+Deterministic data seeder for benchmarks.
+
+Creates N users with M memories and K logs each (plus matching token usage
+rows) in the database pointed to by DATABASE_URL.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.seed --users 50 --memories 40 --logs 200
+"""
+from sqlalchemy.orm import sessionmaker
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import random
+from typing import Dict
+
+from shared.models import Base, Setting, Log, TokenUsage, Memory, create_database_engine
+
+WORDS = ("pizza cats dogs hiking music guitar coffee tea books movies anime games chess "
+         "running swimming python rust travel japan paris cooking baking painting photography "
+         "science space history gardening cycling football basketball jazz rock piano").split()
+
+
+def _sentence(rng: random.Random, words: int = 8) -> str:
+    return 'User ' + ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed_database(users: int = 10, memories: int = 20, logs: int = 50,
+                  seed: int = 42, database_url: str = None) -> Dict[str, int]:
+    """Insert users x memories and users x logs rows; returns the row counts written"""
+    engine = create_database_engine(database_url or os.environ['DATABASE_URL'])
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+
+    session = Session()
+    try:
+        for user_index in range(users):
+            user_id = f'bench-{user_index}'
+            rows = []
+            for memory_index in range(memories):
+                # Roughly one in five memories is a near-duplicate suggestion of an earlier one
+                if memory_index and rng.random() < 0.2:
+                    content = rows[rng.randrange(len(rows))].content + ' again'
+                else:
+                    content = _sentence(rng, rng.randint(5, 20))
+                suggested = rng.random() < 0.5
+                rows.append(Memory(
+                    user_id=user_id,
+                    memory_type='long',
+                    content=content,
+                    source='ai_suggested' if suggested else 'manual',
+                    importance=rng.randint(0, 10),
+                    tags=json.dumps(['suggested'] if suggested else ['bench']),
+                    approved=not suggested or rng.random() < 0.5,
+                    timestamp=now - timedelta(minutes=rng.randint(0, 60 * 24 * 120))
+                ))
+            session.add_all(rows)
+
+            for _ in range(logs):
+                input_tokens = rng.randint(50, 800)
+                output_tokens = rng.randint(10, 150)
+                timestamp = now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))
+                session.add(Log(
+                    user_id=user_id,
+                    username=f'bench_user_{user_index}',
+                    channel_id=str(1000 + user_index % 5),
+                    user_message=_sentence(rng, rng.randint(3, 40)),
+                    bot_response=_sentence(rng, rng.randint(10, 60)),
+                    timestamp=timestamp,
+                    input_tokens=input_tokens,
+                    output_tokens=output_tokens
+                ))
+                session.add(TokenUsage(
+                    total_tokens=input_tokens + output_tokens,
+                    input_tokens=input_tokens,
+                    output_tokens=output_tokens,
+                    timestamp=timestamp
+                ))
+            session.commit()
+
+        return {'users': users, 'memories': users * memories, 'logs': users * logs}
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def configure_provider(provider: str, stub_url: str, database_url: str = None):
+    """Point the stored LLM settings at the stub server"""
+    engine = create_database_engine(database_url or os.environ['DATABASE_URL'])
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    values = {
+        'model_provider': provider,
+        'deepseek_api_key': 'stub-key',
+        'ollama_endpoint': stub_url,
+        'ollama_model': 'stub-chat:latest',
+        'memory_suggestions_enabled': 'true'
+    }
+
+    session = Session()
+    try:
+        for key, value in values.items():
+            setting = session.query(Setting).filter_by(key=key).first()
+            if setting:
+                setting.value = value
+            else:
+                session.add(Setting(key=key, value=value))
+        session.commit()
+    finally:
+        session.close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seed the database with benchmark data')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--memories', type=int, default=20, help='Memories per user')
+    parser.add_argument('--logs', type=int, default=50, help='Logs per user')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    print(seed_database(args.users, args.memories, args.logs, args.seed))
@@ -0,0 +1,188 @@
+"""
+Local stand-in for the DeepSeek (OpenAI-compatible) and Ollama APIs.
+
+Responses are canned but timed like a real model: every call sleeps for a
+fixed first-token latency plus output_tokens / tokens_per_second, so chat
+benchmarks measure our own overhead on top of a predictable provider. The
+OpenAI-style endpoint also imitates DeepSeek's prefix context cache, reporting
+prompt_cache_hit_tokens for prompt prefixes it has seen recently.
+
+    python -m benchmarks.stub_llm --port 8089 --latency 0.2 --tokens-per-second 50
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from typing import List, Dict, Any
+
+STUB_REPLY = ("Thanks for sharing that! I will keep it in mind. Is there anything else "
+              "you would like to talk about today?")
+STUB_SUGGESTIONS = ["User enjoys talking about benchmarks", "User prefers short answers"]
+STUB_MODELS = [
+    {'name': 'stub-chat:latest', 'size': 4109865159,
+     'details': {'parameter_size': '7B', 'quantization_level': 'Q4_0', 'family': 'llama'}},
+    {'name': 'stub-small:latest', 'size': 1321082688,
+     'details': {'parameter_size': '1.5B', 'quantization_level': 'Q4_K_M', 'family': 'qwen2'}}
+]
+
+
+CACHE_UNIT_TOKENS = 64  # DeepSeek caches prompt prefixes in 64-token units
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _common_prefix(a: str, b: str) -> int:
+    size = min(len(a), len(b))
+    for i in range(size):
+        if a[i] != b[i]:
+            return i
+    return size
+
+
+class StubConfig:
+    def __init__(self, latency: float = 0.2, tokens_per_second: float = 50.0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._prompts = deque(maxlen=256)
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def cache_hit_tokens(self, messages: List[Dict[str, str]], prompt_tokens: int) -> int:
+        """Tokens of the longest prefix shared with a recent prompt, in whole cache units"""
+        prompt = ''.join(f"<{m.get('role')}>{m.get('content', '')}" for m in messages)
+        with self._lock:
+            longest = max((_common_prefix(prompt, seen) for seen in self._prompts), default=0)
+            self._prompts.append(prompt)
+        hit = (longest // 4) // CACHE_UNIT_TOKENS * CACHE_UNIT_TOKENS
+        return min(hit, prompt_tokens)
+
+
+def _reply_for(messages: List[Dict[str, str]]) -> str:
+    prompt = messages[-1].get('content', '') if messages else ''
+    if 'JSON array' in prompt:
+        return json.dumps(STUB_SUGGESTIONS)
+    return STUB_REPLY
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    config: StubConfig = StubConfig()
+
+    def _send_json(self, status: int, body: Dict[str, Any]):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _generate(self, messages: List[Dict[str, str]], max_tokens: int):
+        """Sleep like a model would and return (content, prompt_tokens, completion_tokens, seconds)"""
+        self.config.count()
+        content = _reply_for(messages)
+        prompt_tokens = sum(_estimate_tokens(m.get('content', '')) for m in messages)
+        completion_tokens = min(_estimate_tokens(content), max_tokens or 1 << 30)
+        duration = self.config.latency + completion_tokens / self.config.tokens_per_second
+        time.sleep(duration)
+        return content, prompt_tokens, completion_tokens, duration
+
+    def do_GET(self):
+        if self.path.rstrip('/') in ('/api/tags',):
+            self._send_json(200, {'models': STUB_MODELS})
+        elif self.path.rstrip('/') in ('/v1/models', '/models'):
+            self._send_json(200, {'object': 'list', 'data': [
+                {'id': 'deepseek-chat', 'object': 'model', 'owned_by': 'stub'}]})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        body = self._read_json()
+        path = self.path.rstrip('/')
+
+        if path in ('/v1/chat/completions', '/chat/completions'):
+            content, prompt_tokens, completion_tokens, _ = self._generate(
+                body.get('messages', []), body.get('max_tokens'))
+            cache_hit = self.config.cache_hit_tokens(body.get('messages', []), prompt_tokens)
+            self._send_json(200, {
+                'id': f'stub-{self.config.requests}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model', 'deepseek-chat'),
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': content}}],
+                'usage': {'prompt_tokens': prompt_tokens,
+                          'completion_tokens': completion_tokens,
+                          'total_tokens': prompt_tokens + completion_tokens,
+                          'prompt_cache_hit_tokens': cache_hit,
+                          'prompt_cache_miss_tokens': prompt_tokens - cache_hit}
+            })
+        elif path == '/api/chat':
+            content, prompt_tokens, completion_tokens, duration = self._generate(
+                body.get('messages', []), body.get('options', {}).get('num_predict'))
+            self._send_json(200, {
+                'model': body.get('model', 'stub-chat:latest'),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'message': {'role': 'assistant', 'content': content},
+                'done': True,
+                'total_duration': int(duration * 1e9),
+                'load_duration': 0,
+                'prompt_eval_count': prompt_tokens,
+                'prompt_eval_duration': int(self.config.latency * 1e9),
+                'eval_count': completion_tokens,
+                'eval_duration': int((duration - self.config.latency) * 1e9)
+            })
+        elif path == '/api/generate' and not body.get('prompt'):
+            # Ollama loads the model and returns straight away for an empty prompt
+            self.config.count()
+            self._send_json(200, {
+                'model': body.get('model', 'stub-chat:latest'),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'response': '',
+                'done': True,
+                'done_reason': 'load',
+                'load_duration': 0
+            })
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port: int = 0, latency: float = 0.2,
+                      tokens_per_second: float = 50.0) -> ThreadingHTTPServer:
+    """Start the stub on a background thread; port 0 picks a free port"""
+    handler = type('ConfiguredStubHandler', (StubHandler,),
+                   {'config': StubConfig(latency, tokens_per_second)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='stub-llm', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stub OpenAI/Ollama-compatible LLM server')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    args = parser.parse_args()
+
+    server = start_stub_server(args.port, args.latency, args.tokens_per_second)
+    print(f"Stub LLM listening on http://127.0.0.1:{server.server_address[1]} "
+          f"(OpenAI: /v1/chat/completions, Ollama: /api/chat, /api/tags)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,22 +1,21 @@
 import discord
 from discord import app_commands
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 import os
-from collections import deque
-from datetime import datetime
-from shared.models import Base, Setting, Log, TokenUsage, Memory
-from backend.llm_interface import create_llm_provider, get_current_provider
-from backend.memory_manager import MemoryManager
+import asyncio
+from collections import Counter
+from shared.models import ensure_schema, Setting, engine, Session
+from backend.chat_service import ChatService
+from backend.coalescer import chat_coalescer, MERGED_NOTICE
+from backend.rate_limiter import admission
+from backend.provider_warmup import start_model_keepalive
+from backend.profiler import start_slow_request_capture  # Also serves /admin/profiling next to /metrics
+from backend.sharding import resolve_shard_assignment, shard_monitor, ShardLeases, HEARTBEAT_INTERVAL
+from backend.metrics import trace_request, span, start_metrics_server, register_collector
 
 # DB setup
-DATABASE_URL = os.getenv('DATABASE_URL', 'postgresql://luma:lumapass@db:5432/luma')
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
-Base.metadata.create_all(engine)
-
-# Short-term memory: {user_id: deque([{'role': 'user', 'content': msg}, ...], maxlen=10)}
-short_memory = {}
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))  # 0 disables the /metrics server
+ensure_schema(engine)
+register_collector(shard_monitor.metrics)
 
 def get_setting(key):
     session = Session()
@@ -35,103 +34,115 @@ def set_setting(key, value):
     session.commit()
     session.close()
 
-def get_long_memory(user_id):
-    """Get relevant long-term memories for a user"""
-    memories = MemoryManager.get_relevant_memories(user_id, context_limit=5)
-    return '\n'.join([m.content for m in memories])
-
-def update_short_memory(user_id, role, content):
-    if user_id not in short_memory:
-        short_memory[user_id] = deque(maxlen=10)
-    short_memory[user_id].append({'role': role, 'content': content})
-
-def log_interaction(user_id, username, channel_id, user_msg, bot_resp, input_tokens, output_tokens):
-    session = Session()
-    log = Log(user_id=user_id, username=username, channel_id=channel_id,
-              user_message=user_msg, bot_response=bot_resp,
-              input_tokens=input_tokens, output_tokens=output_tokens)
-    session.add(log)
-    # Update token usage
-    usage = TokenUsage(total_tokens=input_tokens + output_tokens,
-                       input_tokens=input_tokens, output_tokens=output_tokens)
-    session.add(usage)
-    session.commit()
-    session.close()
-
-intents = discord.Intents.default()
-client = discord.Client(intents=intents)
-tree = app_commands.CommandTree(client)
-
-@tree.command(name="chat", description="Chat with the AI bot")
+@app_commands.command(name="chat", description="Chat with the AI bot")
 async def chat(interaction: discord.Interaction, message: str):
-    await interaction.response.defer()
     user_id = str(interaction.user.id)
     username = interaction.user.name
     channel_id = str(interaction.channel.id)
 
-    try:
-        # Get the current LLM provider based on settings
-        llm_provider = get_current_provider()
-
-        # Fetch personality from database on each request - updates are applied immediately
-        personality = get_setting('personality') or 'You are a helpful AI assistant.'
+    # Reject over-limit users straight away, before any LLM or memory work. A follow-up
+    # that will be merged into a turn already waiting doesn't use another rate token.
+    key = (user_id, channel_id)
+    joining = chat_coalescer.enabled and chat_coalescer.has_pending(key)
+    decision = await asyncio.to_thread(admission.check, user_id, channel_id, rate_limited=not joining)
+    if not decision['allowed']:
+        await interaction.response.send_message(decision['message'], ephemeral=True)
+        return
 
-        # Build prompt with long-term memory
-        long_term_memory = get_long_memory(user_id)
-        system_prompt = f"{personality}\n\nLong-term memory:\n{long_term_memory if long_term_memory else 'No previous memories.'}\n\nConversation history:"
-
-        messages = [{'role': 'system', 'content': system_prompt}]
-
-        # Add short-term memory if available
-        if user_id in short_memory:
-            messages.extend(list(short_memory[user_id]))
-
-        messages.append({'role': 'user', 'content': message})
-
-        # Get response from LLM
-        response_data = llm_provider.chat_completion(
-            messages=messages,
-            max_tokens=150,
-            temperature=0.7
-        )
-
-        bot_response = response_data['content']
-        input_tokens = response_data['input_tokens']
-        output_tokens = response_data['output_tokens']
-
-        # Generate memory suggestions
-        memory_suggestions = llm_provider.extract_memory_suggestions(message, bot_response)
-
-        # Add memory suggestions to the database as unapproved memories
-        for suggestion in memory_suggestions:
-            MemoryManager.add_memory_suggestion(
-                user_id=user_id,
-                content=suggestion,
-                importance=1,  # Default low importance for suggestions
-                tags=['suggested']
-            )
+    await interaction.response.defer()
 
-        # Update short-term memory
-        update_short_memory(user_id, 'user', message)
-        update_short_memory(user_id, 'assistant', bot_response)
+    # Coalescing: wait briefly for follow-ups and answer a burst of messages in one turn
+    ticket = None
+    if chat_coalescer.enabled:
+        ticket = chat_coalescer.add(key, message)
+        await asyncio.sleep(chat_coalescer.window)
+        message = chat_coalescer.take(key, ticket)
+        if message is None:
+            await interaction.followup.send(MERGED_NOTICE)
+            return
 
-        # Log the interaction
-        log_interaction(user_id, username, channel_id, message, bot_response, input_tokens, output_tokens)
+    try:
+        with trace_request('chat', 'bot'):
+            claim = (lambda: chat_coalescer.claim(key, ticket)) if ticket else None
+            # Blocking part of the turn runs in a worker thread so it never stalls the gateway
+            result = await asyncio.to_thread(ChatService.run_turn, user_id, username, channel_id,
+                                             message, decision, claim=claim)
 
-        await interaction.followup.send(bot_response)
+            with span('reply'):
+                await interaction.followup.send(result['response'] if result else MERGED_NOTICE)
 
     except Exception as e:
+        if ticket:
+            chat_coalescer.abandon(key, ticket)
         await interaction.followup.send(f"Error: {str(e)}")
         print(f"Error in chat command: {str(e)}")
 
-@client.event
-async def on_ready():
-    await tree.sync()
-    print(f'Bot logged in as {client.user}')
+class LumaClient(discord.AutoShardedClient):
+    """Sharded client; runs the shards assigned to this process by resolve_shard_assignment"""
+
+    def __init__(self, assignment):
+        super().__init__(intents=discord.Intents.default(),
+                         shard_count=assignment['shard_count'],
+                         shard_ids=assignment['shard_ids'])
+        self.assignment = assignment
+        self.tree = app_commands.CommandTree(self)
+        self.tree.add_command(chat)
+
+    async def setup_hook(self):
+        self.loop.create_task(self.report_shard_health())
+        # Load the model before the first /chat and keep it loaded while idle
+        start_model_keepalive()
+
+    async def report_shard_health(self):
+        """Record gateway latency and guild counts per shard and renew our replica lease"""
+        slot = self.assignment['slot']
+        while not self.is_closed():
+            guilds_per_shard = Counter(guild.shard_id for guild in self.guilds)
+            for shard_id, latency in self.latencies:
+                shard_monitor.update(shard_id, latency=latency,
+                                     guild_count=guilds_per_shard.get(shard_id, 0))
+            try:
+                await asyncio.to_thread(shard_monitor.persist)
+                if slot is not None and not await asyncio.to_thread(ShardLeases.heartbeat, slot):
+                    print(f"Lost replica slot {slot}, shutting down so another replica can take over")
+                    await self.close()
+                    return
+            except Exception as e:
+                print(f"Error reporting shard health: {str(e)}")
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def on_ready(self):
+        # Commands are global, so only the process running shard 0 syncs them
+        shard_ids = self.assignment['shard_ids']
+        if shard_ids is None or 0 in shard_ids:
+            await self.tree.sync()
+        print(f'Bot logged in as {self.user} running shards {self.shard_ids} of {self.shard_count}')
+
+    async def on_shard_connect(self, shard_id):
+        shard_monitor.update(shard_id, status='connecting')
+
+    async def on_shard_ready(self, shard_id):
+        shard_monitor.update(shard_id, status='ready')
+
+    async def on_shard_disconnect(self, shard_id):
+        shard_monitor.update(shard_id, status='disconnected')
+
+    async def on_shard_resumed(self, shard_id):
+        shard_monitor.update(shard_id, status='resumed')
 
 if __name__ == "__main__":
     discord_token = get_setting('discord_token')
     if not discord_token:
         print("Discord token not set.")
         exit(1)
-    client.run(discord_token)
+    assignment = resolve_shard_assignment()
+    print(f"Starting shards {assignment['shard_ids'] or 'all'} of {assignment['shard_count'] or 'recommended'}")
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    start_slow_request_capture()
+    client = LumaClient(assignment)
+    try:
+        client.run(discord_token)
+    finally:
+        if assignment['slot'] is not None:
+            ShardLeases.release(assignment['slot'])
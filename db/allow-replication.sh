@@ -0,0 +1,4 @@
+#!/bin/bash
+# Allow streaming replication connections (used by the optional db_replica service)
+set -e
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -1,7 +1,10 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean
+from sqlalchemy import (Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Float, inspect, text,
+                        create_engine, event)
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, sessionmaker
 from datetime import datetime
 import json
+import os
 
 Base = declarative_base()
 
@@ -19,9 +22,11 @@ class Log(Base):
     channel_id = Column(String(20), nullable=False)
     user_message = Column(Text, nullable=False)
     bot_response = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)  # Monthly partition key on Postgres
     input_tokens = Column(Integer, default=0)
     output_tokens = Column(Integer, default=0)
+    cache_hit_tokens = Column(Integer, default=0)  # Input tokens served from the provider's prompt cache
+    cache_miss_tokens = Column(Integer, default=0)
 
 class TokenUsage(Base):
     __tablename__ = 'token_usages'
@@ -29,7 +34,11 @@ class TokenUsage(Base):
     total_tokens = Column(Integer, default=0)
     input_tokens = Column(Integer, default=0)
     output_tokens = Column(Integer, default=0)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    cache_hit_tokens = Column(Integer, default=0)
+    cache_miss_tokens = Column(Integer, default=0)
+    task = Column(String(20), default='chat')  # 'chat', 'extraction' or 'summarization'
+    model = Column(String(100))
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)  # Monthly partition key on Postgres
 
 class Memory(Base):
     __tablename__ = 'memories'
@@ -41,4 +50,233 @@ class Memory(Base):
     source = Column(String(20), default='manual')  # 'manual' or 'ai_suggested'
     importance = Column(Integer, default=0)  # Score for memory relevance
     tags = Column(Text)  # JSON array for memory categorization
-    approved = Column(Boolean, default=True)  # For AI-suggested memories
\ No newline at end of file
+    approved = Column(Boolean, default=True)  # For AI-suggested memories
+
+class Document(Base):
+    __tablename__ = 'documents'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String(20), nullable=False, index=True)
+    filename = Column(String(255), nullable=False)
+    file_type = Column(String(20))  # File extension without the dot
+    content_hash = Column(String(64), nullable=False, index=True)  # SHA-256 of the full text
+    chunk_count = Column(Integer, default=0)
+    doc_metadata = Column(Text)  # JSON object with per-document metadata
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    chunks = relationship('DocumentChunk', back_populates='document',
+                          cascade='all, delete-orphan', order_by='DocumentChunk.chunk_index')
+
+class DocumentChunk(Base):
+    __tablename__ = 'document_chunks'
+    id = Column(Integer, primary_key=True)
+    document_id = Column(Integer, ForeignKey('documents.id', ondelete='CASCADE'), nullable=False, index=True)
+    memory_id = Column(Integer, ForeignKey('memories.id', ondelete='CASCADE'), nullable=False)
+    chunk_index = Column(Integer, nullable=False)  # 0-based position in the document
+    chunk_hash = Column(String(64), nullable=False)  # SHA-256 of the chunk text
+    document = relationship('Document', back_populates='chunks')
+
+class MemorySignature(Base):
+    """MinHash signature kept between consolidation passes so unchanged memories aren't rehashed"""
+    __tablename__ = 'memory_signatures'
+    memory_id = Column(Integer, ForeignKey('memories.id', ondelete='CASCADE'), primary_key=True)
+    content_hash = Column(String(40), nullable=False)  # SHA-1 of the content it was computed from
+    approved = Column(Boolean, nullable=False)  # Approval state when last clustered
+    signature = Column(Text, nullable=False)  # Comma-separated hex MinHash values
+
+class MemoryArchive(Base):
+    __tablename__ = 'memory_archive'
+    id = Column(Integer, primary_key=True)
+    original_id = Column(Integer, nullable=False)  # Id the row had in the memories table
+    user_id = Column(String(20), nullable=False, index=True)
+    memory_type = Column(String(10), nullable=False)
+    content = Column(Text, nullable=False)
+    timestamp = Column(DateTime)
+    source = Column(String(20))
+    importance = Column(Integer, default=0)
+    tags = Column(Text)
+    approved = Column(Boolean)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    reason = Column(String(20))  # 'merged' or 'stale'
+    merged_into = Column(Integer)  # Surviving memory id when reason is 'merged'
+
+class ShortTermMessage(Base):
+    __tablename__ = 'short_term_messages'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String(20), nullable=False, index=True)
+    channel_id = Column(String(20), nullable=False, default='', index=True)
+    role = Column(String(10), nullable=False)  # 'user' or 'assistant'
+    content = Column(Text, nullable=False)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+
+class ConversationSummary(Base):
+    __tablename__ = 'conversation_summaries'
+    user_id = Column(String(20), primary_key=True)
+    channel_id = Column(String(20), primary_key=True)
+    summary = Column(Text, nullable=False)
+    message_count = Column(Integer, default=0)  # Messages folded into the summary so far
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class BotShardLease(Base):
+    __tablename__ = 'bot_shard_leases'
+    slot = Column(Integer, primary_key=True)  # Replica slot, owns shards where shard_id % replicas == slot
+    owner = Column(String(100), nullable=False)  # hostname:pid of the claiming process
+    heartbeat = Column(DateTime, default=datetime.utcnow)
+
+class BotShardStatus(Base):
+    __tablename__ = 'bot_shard_status'
+    shard_id = Column(Integer, primary_key=True)
+    owner = Column(String(100))
+    status = Column(String(20))  # 'connecting', 'ready', 'disconnected' or 'resumed'
+    latency_ms = Column(Integer)
+    guild_count = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class DailyTokenUsage(Base):
+    __tablename__ = 'daily_token_usage'
+    day = Column(String(10), primary_key=True)  # UTC date, YYYY-MM-DD
+    scope = Column(String(40), primary_key=True)  # 'global' or 'user:<id>'
+    total_tokens = Column(Integer, default=0)
+    requests = Column(Integer, default=0)
+
+class RateLimitBucket(Base):
+    __tablename__ = 'rate_limit_buckets'
+    key = Column(String(60), primary_key=True)  # 'user:<id>' or 'channel:<id>'
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)  # Unix time of the last refill
+
+class MemoryCacheVersion(Base):
+    """Memory changes per user, polled by other processes on SQLite, which has no LISTEN/NOTIFY"""
+    __tablename__ = 'memory_cache_versions'
+    user_id = Column(String(20), primary_key=True)  # '*' holds the last version handed out
+    version = Column(Integer, nullable=False, default=0)
+
+class LogArchive(Base):
+    __tablename__ = 'log_archives'
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(50), nullable=False)  # 'logs' or 'token_usages'
+    partition_name = Column(String(63))  # Dropped partition, when archived from Postgres
+    period_start = Column(DateTime)
+    period_end = Column(DateTime, nullable=False)
+    row_count = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)  # Kept so all-time totals still include archived rows
+    path = Column(Text, nullable=False)  # Compressed JSON lines file on local disk
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+# Columns added to tables that may already exist; create_all only creates missing tables
+ADDED_COLUMNS = [
+    ('short_term_messages', 'channel_id', "VARCHAR(20) NOT NULL DEFAULT ''"),
+    ('logs', 'cache_hit_tokens', 'INTEGER DEFAULT 0'),
+    ('logs', 'cache_miss_tokens', 'INTEGER DEFAULT 0'),
+    ('token_usages', 'cache_hit_tokens', 'INTEGER DEFAULT 0'),
+    ('token_usages', 'cache_miss_tokens', 'INTEGER DEFAULT 0'),
+    ('token_usages', 'task', "VARCHAR(20) DEFAULT 'chat'"),
+    ('token_usages', 'model', 'VARCHAR(100)'),
+]
+
+# Embedded single-node mode: a DATABASE_URL like sqlite:////data/luma.db runs on a local SQLite
+# file in WAL mode, so readers never block the writer and nothing needs a database server
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '10000'))  # Wait this long for the write lock
+SQLITE_CACHE_MB = int(os.getenv('SQLITE_CACHE_MB', '64'))  # Page cache per connection
+SQLITE_MMAP_MB = int(os.getenv('SQLITE_MMAP_MB', '256'))  # Memory-mapped reads, 0 disables
+# NORMAL only syncs at WAL checkpoints: a power cut can lose the last commits but never corrupts
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+MEMORY_FTS_TABLE = 'memories_fts'
+
+def is_sqlite_url(database_url: str) -> bool:
+    return database_url.startswith('sqlite')
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA foreign_keys=ON')  # Enforced on Postgres too
+    finally:
+        cursor.close()
+
+def create_database_engine(database_url: str, **kwargs):
+    """create_engine, with WAL mode and tuned pragmas on every connection when the URL is SQLite"""
+    if not is_sqlite_url(database_url):
+        return create_engine(database_url, **kwargs)
+    connect_args = kwargs.setdefault('connect_args', {})
+    connect_args.setdefault('check_same_thread', False)  # Pooled connections move between threads
+    connect_args.setdefault('timeout', SQLITE_BUSY_TIMEOUT_MS / 1000)
+    engine = create_engine(database_url, **kwargs)
+    event.listen(engine, 'connect', _apply_sqlite_pragmas)
+    return engine
+
+def has_memory_search_index(engine) -> bool:
+    """Whether memories have an FTS5 index (embedded SQLite mode)"""
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                                  {'name': MEMORY_FTS_TABLE}).first() is not None
+
+def _ensure_memory_search_index(engine):
+    """
+    Trigram index over memory content, kept in sync by triggers (SQLite 3.34+
+    with FTS5 only). Trigrams let LIKE '%text%' use the index, so search keeps
+    matching any substring, as it does on Postgres.
+    """
+    with engine.connect() as connection:
+        definition = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = :name"),
+                                        {'name': MEMORY_FTS_TABLE}).scalar()
+    if definition and 'trigram' in definition:
+        return
+    try:
+        with engine.begin() as connection:
+            if definition:
+                # Word-based index from an earlier version; it only matched word prefixes
+                for trigger in ('insert', 'delete', 'update'):
+                    connection.execute(text(f"DROP TRIGGER IF EXISTS {MEMORY_FTS_TABLE}_{trigger}"))
+                connection.execute(text(f"DROP TABLE {MEMORY_FTS_TABLE}"))
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE {MEMORY_FTS_TABLE} USING fts5("
+                f"content, content='memories', content_rowid='id', tokenize='trigram')"
+            ))
+            connection.execute(text(
+                f"CREATE TRIGGER {MEMORY_FTS_TABLE}_insert AFTER INSERT ON memories BEGIN "
+                f"INSERT INTO {MEMORY_FTS_TABLE}(rowid, content) VALUES (new.id, new.content); END"
+            ))
+            connection.execute(text(
+                f"CREATE TRIGGER {MEMORY_FTS_TABLE}_delete AFTER DELETE ON memories BEGIN "
+                f"INSERT INTO {MEMORY_FTS_TABLE}({MEMORY_FTS_TABLE}, rowid, content) "
+                f"VALUES ('delete', old.id, old.content); END"
+            ))
+            connection.execute(text(
+                f"CREATE TRIGGER {MEMORY_FTS_TABLE}_update AFTER UPDATE OF content ON memories BEGIN "
+                f"INSERT INTO {MEMORY_FTS_TABLE}({MEMORY_FTS_TABLE}, rowid, content) "
+                f"VALUES ('delete', old.id, old.content); "
+                f"INSERT INTO {MEMORY_FTS_TABLE}(rowid, content) VALUES (new.id, new.content); END"
+            ))
+            # Index the memories that already exist
+            connection.execute(text(f"INSERT INTO {MEMORY_FTS_TABLE}({MEMORY_FTS_TABLE}) VALUES ('rebuild')"))
+    except Exception as e:
+        # SQLite without FTS5 or the trigram tokenizer, or another process created it at the same time
+        print(f"Could not create memory search index: {e}")
+
+def ensure_schema(engine):
+    """Create missing tables and add columns introduced since the database was created"""
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table, column, ddl in ADDED_COLUMNS:
+        if column in {c['name'] for c in inspector.get_columns(table)}:
+            continue
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+        except Exception as e:
+            # Another process may have added it at the same time
+            print(f"Could not add column {table}.{column}: {e}")
+    if engine.dialect.name == 'sqlite':
+        _ensure_memory_search_index(engine)
+
+DATABASE_URL = os.getenv('DATABASE_URL', 'postgresql://luma:lumapass@db:5432/luma')
+# One engine, and so one connection pool, per process; every module imports it from here
+engine = create_database_engine(DATABASE_URL)
+Session = sessionmaker(bind=engine)
@@ -2,32 +2,81 @@ import tempfile
 import PyPDF2
 import pandas as pd
 import json as json_module
-from flask import Flask, render_template, request, redirect, jsonify
-from shared.models import Base, Setting, Log, TokenUsage, Memory
-from sqlalchemy import create_engine, func, and_
-from sqlalchemy.orm import sessionmaker
+from flask import Flask, render_template, request, redirect, jsonify, g, Response
+from shared.models import Base, ensure_schema, Setting, Log, TokenUsage, Memory, engine, Session
+from sqlalchemy import func, and_
 import os
 import json
+import time
 from backend.memory_manager import MemoryManager
-from backend.llm_interface import get_current_provider
+from backend.document_manager import DocumentManager
+from backend.ollama_discovery import ollama_discovery, DEFAULT_OLLAMA_ENDPOINT
+from backend.sharding import get_shard_statuses
+from backend.rate_limiter import admission
+from backend.memory_consolidation import consolidate_memories, start_consolidation_scheduler
+from backend.coalescer import chat_coalescer, MERGED_NOTICE
+from backend.log_partitions import recent_cutoff, archived_token_total, start_log_maintenance_scheduler
+from backend.read_replica import read_router, LAST_WRITE_COOKIE
+from backend.profiler import handle_profiling_request, start_slow_request_capture
+from backend.chat_service import ChatService, PROMPT_LAYOUTS, DEFAULT_PROMPT_LAYOUT
+from backend.provider_warmup import (warm_up_in_background, start_model_keepalive, get_warm_up_status,
+                                     MODEL_PING_INTERVAL)
+from backend.metrics import begin_trace, end_trace, render_prometheus, latency_summary
 import openpyxl
-import requests
 
 app = Flask(__name__)
 
-DATABASE_URL = os.getenv('DATABASE_URL', 'postgresql://luma:lumapass@db:5432/luma')
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
-Base.metadata.create_all(engine)
+# Seconds between memory consolidation runs, 0 disables the background job
+MEMORY_CONSOLIDATION_INTERVAL = int(os.getenv('MEMORY_CONSOLIDATION_INTERVAL', '3600'))
+# Seconds between log partition upkeep and retention runs, 0 disables the background job
+LOG_MAINTENANCE_INTERVAL = int(os.getenv('LOG_MAINTENANCE_INTERVAL', '86400'))
+ensure_schema(engine)
+
+@app.before_request
+def start_request_trace():
+    g.trace_token = begin_trace(request.endpoint or 'unknown', 'webapp')
+    g.write_scope_token = read_router.begin_scope(request.cookies.get(LAST_WRITE_COOKIE))
+
+@app.after_request
+def remember_write(response):
+    # Keeps this browser's reads on the primary until the replica has its write
+    wrote_at = read_router.scope_write()
+    if wrote_at is not None and read_router.enabled:
+        response.set_cookie(LAST_WRITE_COOKIE, f'{wrote_at:.3f}', max_age=read_router.write_window,
+                            httponly=True, samesite='Lax')
+    return response
+
+@app.teardown_request
+def finish_request_trace(exception=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        end_trace(token)
+    scope_token = g.pop('write_scope_token', None)
+    if scope_token is not None:
+        read_router.end_scope(scope_token)
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiling', methods=['GET', 'POST'])
+@app.route('/admin/profiling/<path:action>', methods=['GET', 'POST'])
+def profiling(action=''):
+    status, content_type, body, filename = handle_profiling_request(
+        request.method, request.path, request.values.to_dict(), request.headers)
+    response = Response(body, status=status, mimetype=content_type)
+    if filename:
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 @app.route('/')
 def chat():
-    return render_template('chat.html')
+    return render_template('chat.html', coalescing=chat_coalescer.enabled)
 
 # Alias for chat route
 @app.route('/chat')
 def chat_alias():
-    return render_template('chat.html')
+    return render_template('chat.html', coalescing=chat_coalescer.enabled)
 
 def get_setting_value(key, default=None):
     """Helper function to get setting value from database"""
@@ -40,30 +89,61 @@ def get_setting_value(key, default=None):
 
 @app.route('/dashboard')
 def dashboard():
-    session = Session()
-    # Total token usage
-    from sqlalchemy import func
-    total_usage = session.query(func.sum(TokenUsage.total_tokens)).scalar() or 0
-    # Recent logs
-    recent_logs = session.query(Log).order_by(Log.timestamp.desc()).limit(10).all()
-    session.close()
-    return render_template('dashboard.html', total_tokens=total_usage, logs=recent_logs)
+    # Read-only, so served from the read replica when one is configured
+    def read_stats(session):
+        # Total token usage
+        total_usage = session.query(func.sum(TokenUsage.total_tokens)).scalar() or 0
+        # Share of prompt tokens the provider served from its prompt cache, over the recent window
+        cache_hit, cache_miss = session.query(
+            func.coalesce(func.sum(TokenUsage.cache_hit_tokens), 0),
+            func.coalesce(func.sum(TokenUsage.cache_miss_tokens), 0)
+        ).filter(TokenUsage.timestamp >= recent_cutoff()).one()
+        # Usage per task and model, to compare what chat, extraction and summarization cost
+        task_usage = session.query(
+            func.coalesce(TokenUsage.task, 'chat'), TokenUsage.model,
+            func.count(TokenUsage.id), func.coalesce(func.sum(TokenUsage.total_tokens), 0)
+        ).filter(TokenUsage.timestamp >= recent_cutoff()).group_by(
+            func.coalesce(TokenUsage.task, 'chat'), TokenUsage.model
+        ).order_by(func.coalesce(TokenUsage.task, 'chat'), TokenUsage.model).all()
+        # Recent logs, limited to the recent partitions
+        recent_logs = session.query(Log).filter(Log.timestamp >= recent_cutoff()) \
+            .order_by(Log.timestamp.desc()).limit(10).all()
+        return total_usage, cache_hit, cache_miss, task_usage, recent_logs
+
+    total_usage, cache_hit, cache_miss, task_usage, recent_logs = read_router.run(read_stats)
+    prompt_cache = {'hit_tokens': cache_hit, 'miss_tokens': cache_miss,
+                    'hit_ratio': cache_hit / (cache_hit + cache_miss) if cache_hit + cache_miss else None}
+    return render_template('dashboard.html', total_tokens=total_usage + archived_token_total(), logs=recent_logs,
+                           latency=latency_summary('chat_api'),
+                           memory_cache=MemoryManager.get_cache_stats(),
+                           shards=get_shard_statuses(),
+                           budget=admission.budget_status(),
+                           warm_up=get_warm_up_status(),
+                           prompt_cache=prompt_cache,
+                           task_usage=task_usage,
+                           replica=read_router.status())
 
 @app.route('/logs')
 def logs():
     page = request.args.get('page', 1, type=int)
     per_page = 50
-    session = Session()
+    # By default only the last LOG_QUERY_DAYS are scanned; ?range=all reads every partition
+    show_all = request.args.get('range') == 'all'
     offset = (page - 1) * per_page
-    logs_items = session.query(Log).order_by(Log.timestamp.desc()).offset(offset).limit(per_page).all()
-    total = session.query(Log).count()
-    session.close()
+
+    def read_page(session):
+        query = session.query(Log)
+        if not show_all:
+            query = query.filter(Log.timestamp >= recent_cutoff())
+        return query.order_by(Log.timestamp.desc()).offset(offset).limit(per_page).all(), query.count()
+
+    logs_items, total = read_router.run(read_page)
     # Simple pagination info
     has_prev = page > 1
     has_next = offset + per_page < total
     prev_num = page - 1 if has_prev else None
     next_num = page + 1 if has_next else None
-    return render_template('logs.html', logs=logs_items, page=page, pages=(total // per_page) + 1, has_prev=has_prev, has_next=has_next, prev_num=prev_num, next_num=next_num)
+    return render_template('logs.html', logs=logs_items, page=page, pages=(total // per_page) + 1, has_prev=has_prev, has_next=has_next, prev_num=prev_num, next_num=next_num, show_all=show_all)
 
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
@@ -76,6 +156,8 @@ def settings():
         model_provider = request.form.get('model_provider', 'deepseek')
         ollama_endpoint = request.form.get('ollama_endpoint')
         ollama_model = request.form.get('ollama_model')
+        ollama_keep_alive = request.form.get('ollama_keep_alive')
+        prompt_layout = request.form.get('prompt_layout')
 
         # Update DeepSeek API key
         if deepseek_key is not None:  # Allow empty string to clear the key
@@ -121,8 +203,8 @@ def settings():
                 setting = Setting(key='ollama_endpoint', value=ollama_endpoint)
                 session.add(setting)
 
-        # Update Ollama model
-        if ollama_model is not None:
+        # Update Ollama model; an empty value means the list wasn't loaded, so keep the saved model
+        if ollama_model:
             setting = session.query(Setting).filter_by(key='ollama_model').first()
             if setting:
                 setting.value = ollama_model
@@ -130,6 +212,24 @@ def settings():
                 setting = Setting(key='ollama_model', value=ollama_model)
                 session.add(setting)
 
+        # Update Ollama keep-alive
+        if ollama_keep_alive is not None:
+            setting = session.query(Setting).filter_by(key='ollama_keep_alive').first()
+            if setting:
+                setting.value = ollama_keep_alive.strip()
+            else:
+                setting = Setting(key='ollama_keep_alive', value=ollama_keep_alive.strip())
+                session.add(setting)
+
+        # Update prompt layout
+        if prompt_layout in PROMPT_LAYOUTS:
+            setting = session.query(Setting).filter_by(key='prompt_layout').first()
+            if setting:
+                setting.value = prompt_layout
+            else:
+                setting = Setting(key='prompt_layout', value=prompt_layout)
+                session.add(setting)
+
         # Update memory suggestions enabled setting
         memory_suggestions_enabled = request.form.get('memory_suggestions_enabled', 'false')
         setting = session.query(Setting).filter_by(key='memory_suggestions_enabled').first()
@@ -139,9 +239,45 @@ def settings():
             setting = Setting(key='memory_suggestions_enabled', value=memory_suggestions_enabled)
             session.add(setting)
 
+        # Update per-task models (empty means the same provider and model as chat)
+        for task in ('extraction', 'summarization'):
+            task_provider = request.form.get(f'{task}_provider')
+            if task_provider is not None and task_provider in ('', 'deepseek', 'ollama'):
+                setting = session.query(Setting).filter_by(key=f'{task}_provider').first()
+                if setting:
+                    setting.value = task_provider
+                else:
+                    setting = Setting(key=f'{task}_provider', value=task_provider)
+                    session.add(setting)
+            task_model = request.form.get(f'{task}_model')
+            if task_model is not None:
+                setting = session.query(Setting).filter_by(key=f'{task}_model').first()
+                if setting:
+                    setting.value = task_model.strip()
+                else:
+                    setting = Setting(key=f'{task}_model', value=task_model.strip())
+                    session.add(setting)
+
+        # Update daily token limits (empty or 0 means unlimited)
+        for key in ('daily_token_budget', 'user_daily_token_quota'):
+            value = request.form.get(key)
+            if value is not None:
+                setting = session.query(Setting).filter_by(key=key).first()
+                if setting:
+                    setting.value = value.strip()
+                else:
+                    setting = Setting(key=key, value=value.strip())
+                    session.add(setting)
+
         session.commit()
         success = True
 
+        if ollama_endpoint:
+            # Warm the model list for the (possibly new) endpoint before the page reloads it
+            ollama_discovery.refresh_in_background(ollama_endpoint)
+        # Load the (possibly new) model now rather than on the next chat turn
+        warm_up_in_background()
+
     # Get all settings
     deepseek_key = session.query(Setting).filter_by(key='deepseek_api_key').first()
     discord_token = session.query(Setting).filter_by(key='discord_token').first()
@@ -149,18 +285,36 @@ def settings():
     model_provider = session.query(Setting).filter_by(key='model_provider').first()
     ollama_endpoint = session.query(Setting).filter_by(key='ollama_endpoint').first()
     ollama_model = session.query(Setting).filter_by(key='ollama_model').first()
+    ollama_keep_alive = session.query(Setting).filter_by(key='ollama_keep_alive').first()
+    prompt_layout = session.query(Setting).filter_by(key='prompt_layout').first()
     memory_suggestions_setting = session.query(Setting).filter_by(key='memory_suggestions_enabled').first()
+    daily_token_budget = session.query(Setting).filter_by(key='daily_token_budget').first()
+    user_daily_token_quota = session.query(Setting).filter_by(key='user_daily_token_quota').first()
+    task_models = {key: value for key, value in session.query(Setting.key, Setting.value).filter(
+        Setting.key.in_(['extraction_provider', 'extraction_model',
+                         'summarization_provider', 'summarization_model'])).all()}
 
     session.close()
 
+    ollama_endpoint = (ollama_endpoint.value if ollama_endpoint else '') or DEFAULT_OLLAMA_ENDPOINT
+    # Render whatever model list is already cached so the page never waits on Ollama
+    cached_models = ollama_discovery.get_cached(ollama_endpoint)
+
     return render_template('settings.html',
+                           ollama_models=cached_models['models'] if cached_models else [],
                            deepseek_key=deepseek_key.value if deepseek_key else '',
                            discord_token=discord_token.value if discord_token else '',
                            personality=personality.value if personality else 'You are a helpful AI assistant.',
                            model_provider=model_provider.value if model_provider else 'deepseek',
-                           ollama_endpoint=ollama_endpoint.value if ollama_endpoint else 'http://localhost:11434',
+                           ollama_endpoint=ollama_endpoint,
+                           default_ollama_endpoint=DEFAULT_OLLAMA_ENDPOINT,
                            ollama_model=ollama_model.value if ollama_model else 'llama2',
+                           ollama_keep_alive=ollama_keep_alive.value if ollama_keep_alive else '',
+                           prompt_layout=prompt_layout.value if prompt_layout else DEFAULT_PROMPT_LAYOUT,
                            memory_suggestions_enabled=memory_suggestions_setting.value if memory_suggestions_setting else 'false',
+                           daily_token_budget=daily_token_budget.value if daily_token_budget else '',
+                           user_daily_token_quota=user_daily_token_quota.value if user_daily_token_quota else '',
+                           task_models=task_models,
                            success=success)
 
 @app.route('/memory', methods=['GET', 'POST'])
@@ -199,10 +353,10 @@ def memory():
             error = "User ID and content are required"
 
     # Get regular memories (approved)
-    memories = MemoryManager.get_memories(approved=True)
+    memories = MemoryManager.get_memories(approved=True, replica=True)
 
     # Get pending memory suggestions
-    memory_suggestions = MemoryManager.get_memories(source='ai_suggested', approved=False)
+    memory_suggestions = MemoryManager.get_memories(source='ai_suggested', approved=False, replica=True)
 
     session.close()
     return render_template('memory.html', memories=memories, memory_suggestions=memory_suggestions, success=success, error=error)
@@ -217,91 +371,70 @@ def approve_memory(memory_id):
     success = MemoryManager.approve_memory_suggestion(memory_id)
     return redirect('/memory')
 
+@app.route('/memory/consolidate', methods=['POST'])
+def consolidate_memory():
+    consolidate_memories()
+    return redirect('/memory')
+
 @app.route('/api/chat', methods=['POST'])
 def chat_api():
     data = request.get_json()
     user_message = data.get('message', '')
     user_id = data.get('user_id', 'web_user')  # Default user ID for web chat
-    include_memory_suggestions = data.get('include_memory_suggestions', False)  # Default to False
+    # Memory suggestions stay off for web chat unless the request asks for them
+    include_memory_suggestions = bool(data.get('include_memory_suggestions', False))
 
     if not user_message:
         return jsonify({'error': 'Message is required'}), 400
 
-    try:
-        # Get the current LLM provider based on settings
-        llm_provider = get_current_provider()
-
-        # Fetch personality from database
-        session = Session()
-        personality_setting = session.query(Setting).filter_by(key='personality').first()
-        personality = personality_setting.value if personality_setting else 'You are a helpful AI assistant.'
-
-        # Check if memory suggestions are enabled
-        memory_suggestions_enabled_setting = session.query(Setting).filter_by(key='memory_suggestions_enabled').first()
-        memory_suggestions_enabled = (memory_suggestions_enabled_setting.value == 'true') if memory_suggestions_enabled_setting else False
-
-        # Override with request parameter if provided, but default to False for web chat
-        # This ensures web chat is always disabled by default unless explicitly enabled
-        if 'include_memory_suggestions' in data:
-            include_memory_suggestions = data['include_memory_suggestions']
-        else:
-            # Default to False for web chat to ensure suggestions are off by default
-            include_memory_suggestions = False
-
-        session.close()
-
-        # Get relevant memories for the user
-        long_term_memory = get_long_memory(user_id)
-
-        # Build prompt with personality and memory context
-        system_prompt = f"{personality}\n\nLong-term memory:\n{long_term_memory if long_term_memory else 'No previous memories.'}\n\nConversation history:"
-
-        messages = [{'role': 'system', 'content': system_prompt}]
-        messages.append({'role': 'user', 'content': user_message})
-
-        # Get response from LLM
-        response_data = llm_provider.chat_completion(
-            messages=messages,
-            max_tokens=150,
-            temperature=0.7
-        )
-
-        bot_response = response_data['content']
-        input_tokens = response_data['input_tokens']
-        output_tokens = response_data['output_tokens']
-
-        # Generate memory suggestions only if enabled
-        if include_memory_suggestions:
-            memory_suggestions = llm_provider.extract_memory_suggestions(user_message, bot_response)
+    # Web clients share user ids, so the per-channel bucket is keyed by client address.
+    # A follow-up that will be merged into a turn already waiting doesn't use another rate token.
+    coalesce_key = (user_id, request.remote_addr)
+    joining = chat_coalescer.enabled and chat_coalescer.has_pending(coalesce_key)
+    decision = admission.check(user_id, f'web:{request.remote_addr}', rate_limited=not joining)
+    if not decision['allowed']:
+        response = jsonify({'error': decision['message'], 'retry_after': decision['retry_after'],
+                            'mode': decision['mode']})
+        response.headers['Retry-After'] = str(decision['retry_after'])
+        return response, 429
+
+    # Coalescing: wait briefly for follow-ups and answer a burst of messages in one turn
+    ticket = None
+    if chat_coalescer.enabled:
+        ticket = chat_coalescer.add(coalesce_key, user_message)
+        # Holds this worker thread for the window (see CHAT_COALESCE_WINDOW)
+        time.sleep(chat_coalescer.window)
+        user_message = chat_coalescer.take(coalesce_key, ticket)
+        if user_message is None:
+            return jsonify({'superseded': True, 'message': MERGED_NOTICE, 'mode': decision['mode']})
 
-            # Add memory suggestions to the database as unapproved memories
-            for suggestion in memory_suggestions:
-                MemoryManager.add_memory_suggestion(
-                    user_id=user_id,
-                    content=suggestion,
-                    importance=1,  # Default low importance for suggestions
-                    tags=['suggested', 'web-chat']
-                )
-
-        # Log the interaction
-        log_interaction(
+    try:
+        result = ChatService.run_turn(
             user_id=user_id,
             username='web_user',  # Default username for web interactions
             channel_id='web_chat',  # Default channel for web interactions
-            user_msg=user_message,
-            bot_resp=bot_response,
-            input_tokens=input_tokens,
-            output_tokens=output_tokens
+            message=user_message,
+            decision=decision,
+            include_history=False,  # Web chat keeps its history in the browser
+            suggestions=include_memory_suggestions,
+            suggestion_tags=['suggested', 'web-chat'],
+            claim=(lambda: chat_coalescer.claim(coalesce_key, ticket)) if ticket else None
         )
+        # A newer message arrived while generating; that turn answers both
+        if result is None:
+            return jsonify({'superseded': True, 'message': MERGED_NOTICE, 'mode': decision['mode']})
 
         return jsonify({
-            'response': bot_response,
-            'input_tokens': input_tokens,
-            'output_tokens': output_tokens,
-            'total_tokens': response_data['total_tokens'],
+            'mode': decision['mode'],
+            'response': result['response'],
+            'input_tokens': result['input_tokens'],
+            'output_tokens': result['output_tokens'],
+            'total_tokens': result['total_tokens'],
             'memory_suggestions_enabled': include_memory_suggestions
         })
     except Exception as e:
+        if ticket:
+            chat_coalescer.abandon(coalesce_key, ticket)
         return jsonify({'error': str(e)}), 500
 
 
@@ -358,26 +491,26 @@ def upload_document_api():
         # Clean up the temporary file
         os.unlink(temp_filename)
 
-        # Add the document content to memories
-        # We'll break large content into chunks to avoid overly long memories
-        max_chunk_size = 2000
-        chunks = [content[i:i+max_chunk_size] for i in range(0, len(content), max_chunk_size)]
-
-        for i, chunk in enumerate(chunks):
-            if chunk.strip():  # Only add non-empty chunks
-                memory_tags = ['document', f'doc-{file_extension[1:]}', f'chunk-{i+1}']
+        # Store the document as ordered chunks; identical re-uploads are skipped
+        # and changed documents are re-indexed chunk by chunk
+        result = DocumentManager.ingest_document(
+            user_id=user_id,
+            filename=file.filename,
+            content=content,
+            file_type=file_extension[1:],
+            metadata={'original_size': len(content)}
+        )
 
-                MemoryManager.add_memory(
-                    user_id=user_id,
-                    content=chunk,
-                    memory_type='long',
-                    source='document_upload',
-                    importance=0,
-                    tags=memory_tags,
-                    approved=True
-                )
+        if result['status'] == 'skipped':
+            message = 'Document already uploaded, skipped re-indexing'
+        elif result['status'] == 'updated':
+            message = (f"Document re-indexed: {result['chunks_added']} added, "
+                       f"{result['chunks_updated']} updated, {result['chunks_removed']} removed, "
+                       f"{result['chunks_unchanged']} unchanged chunks")
+        else:
+            message = f"Document processed and added to memories in {result['chunks_total']} chunks"
 
-        return jsonify({'success': True, 'message': f'Document processed and added to memories in {len(chunks)} chunks'})
+        return jsonify({'success': True, 'message': message, **result})
 
     except Exception as e:
         # Make sure to clean up the temp file in case of error
@@ -389,6 +522,43 @@ def upload_document_api():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/memory/cache_stats', methods=['GET'])
+def memory_cache_stats_api():
+    return jsonify(MemoryManager.get_cache_stats())
+
+
+@app.route('/api/documents', methods=['GET'])
+def list_documents_api():
+    user_id = request.args.get('user_id', None)
+
+    try:
+        documents = DocumentManager.get_documents(user_id=user_id)
+        documents_data = []
+        for document in documents:
+            documents_data.append({
+                'id': document.id,
+                'user_id': document.user_id,
+                'filename': document.filename,
+                'file_type': document.file_type,
+                'content_hash': document.content_hash,
+                'chunk_count': document.chunk_count,
+                'metadata': json.loads(document.doc_metadata) if document.doc_metadata else {},
+                'created_at': document.created_at.isoformat() if document.created_at else None,
+                'updated_at': document.updated_at.isoformat() if document.updated_at else None
+            })
+
+        return jsonify({'documents': documents_data})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/documents/<int:document_id>', methods=['DELETE'])
+def delete_document_api(document_id):
+    if not DocumentManager.delete_document(document_id):
+        return jsonify({'success': False, 'error': 'Document not found'}), 404
+    return jsonify({'success': True})
+
+
 @app.route('/api/memory/search', methods=['GET'])
 def search_memory_api():
     query = request.args.get('q', '')
@@ -418,77 +588,30 @@ def search_memory_api():
         return jsonify({'error': str(e)}), 500
 
 
-def get_long_memory(user_id):
-    """Get relevant long-term memories for a user"""
-    memories = MemoryManager.get_relevant_memories(user_id, context_limit=5)
-    return '\n'.join([m.content for m in memories])
-
-
-def get_ollama_models(ollama_endpoint):
-    """Fetch available models from Ollama"""
-    try:
-        # Try different common endpoints
-        endpoints_to_try = [
-            ollama_endpoint,
-            ollama_endpoint.rstrip('/'),
-            f"{ollama_endpoint}/api/tags",
-            f"{ollama_endpoint.rstrip('/')}/api/tags",
-            "http://ollama:11434/api/tags",  # Default internal docker name
-            "http://host.docker.internal:11434/api/tags"  # For Docker Desktop
-        ]
-
-        response = None
-        for ep in endpoints_to_try:
-            if ep.endswith('/api/tags'):
-                url = ep
-            else:
-                url = f"{ep}/api/tags"
-
-            try:
-                response = requests.get(url, timeout=5)
-                response.raise_for_status()
-                break
-            except:
-                continue
-
-        if response is None:
-            print(f"Could not connect to Ollama at {ollama_endpoint}")
-            return []
-
-        data = response.json()
-        # Extract model names from response
-        models = [model['name'] for model in data.get('models', [])]
-        return models
-    except Exception as e:
-        print(f"Error fetching Ollama models: {e}")
-        return []
-
 @app.route('/api/ollama_models', methods=['GET'])
 def get_available_ollama_models():
     """API endpoint to fetch available Ollama models"""
-    session = Session()
-    try:
-        ollama_endpoint_setting = session.query(Setting).filter_by(key='ollama_endpoint').first()
-        ollama_endpoint = ollama_endpoint_setting.value if ollama_endpoint_setting else 'http://ollama:11434'
-
-        models = get_ollama_models(ollama_endpoint)
-        return jsonify({'models': models})
-    finally:
-        session.close()
-
-def log_interaction(user_id, username, channel_id, user_msg, bot_resp, input_tokens, output_tokens):
-    """Log the interaction to the database"""
-    session = Session()
-    log = Log(user_id=user_id, username=username, channel_id=channel_id,
-              user_message=user_msg, bot_response=bot_resp,
-              input_tokens=input_tokens, output_tokens=output_tokens)
-    session.add(log)
-    # Update token usage
-    usage = TokenUsage(total_tokens=input_tokens + output_tokens,
-                       input_tokens=input_tokens, output_tokens=output_tokens)
-    session.add(usage)
-    session.commit()
-    session.close()
+    # Only the saved endpoint is probed, so callers can't point the server at arbitrary URLs
+    ollama_endpoint = get_setting_value('ollama_endpoint') or DEFAULT_OLLAMA_ENDPOINT
+    force_refresh = request.args.get('refresh') == '1'
+
+    result = ollama_discovery.get_models(ollama_endpoint, force_refresh=force_refresh)
+    return jsonify({
+        'models': [model['name'] for model in result['models']],
+        'details': result['models'],
+        'endpoint': result['endpoint'],
+        'cached': result['cached'],
+        'age': result['age'],
+        'error': result['error']
+    })
 
 if __name__ == '__main__':
+    # Only start the job in the serving process, not in the debug reloader's parent
+    if MEMORY_CONSOLIDATION_INTERVAL > 0 and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_consolidation_scheduler(MEMORY_CONSOLIDATION_INTERVAL)
+    if LOG_MAINTENANCE_INTERVAL > 0 and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_log_maintenance_scheduler(LOG_MAINTENANCE_INTERVAL)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_model_keepalive(MODEL_PING_INTERVAL)
+        start_slow_request_capture()
     app.run(host='0.0.0.0', port=5000, debug=True)